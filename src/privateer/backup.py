@@ -1,31 +1,504 @@
+import shlex
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
 import docker
+from pydantic import BaseModel
 
 from privateer.check import check_client
-from privateer.config import Config
-from privateer.util import match_value, mounts_str, run_container_with_command
+from privateer.config import Client, Config, LargeFiles, Transfer
+from privateer.generations import LATEST, has_generations
+from privateer.rsync import (
+    RSYNC_REPORTING,
+    RSYNC_STATS,
+    RsyncMonitor,
+    TransferStats,
+)
+from privateer.util import (
+    format_bytes,
+    log_file_path,
+    match_value,
+    mounts_str,
+    run_container_with_command,
+)
+
+
+class BackupResult(BaseModel):
+    """The result of a single backup job.
+
+    Attributes:
+        volume: The name of the volume that was backed up.
+
+        server: The name of the server that the volume was sent to
+            (comma-separated, if sent to several servers in batch
+            mode).
+
+        success: Did the backup complete successfully?
+
+        elapsed: Wall time taken for the job, in seconds.
+
+        error: If the backup failed, a description of the error.
 
+        stats: If the backup succeeded, statistics about the transfer.
+    """
 
-def backup_command(name: str, volume: str, server: str) -> list[str]:
+    volume: str
+    server: str
+    success: bool
+    elapsed: float
+    error: str | None = None
+    stats: TransferStats | None = None
+
+
+def backup_command(
+    name: str,
+    volume: str,
+    server: str,
+    *,
+    generations: bool = False,
+    parallel: int = 1,
+    large_files: LargeFiles | None = None,
+    transfer: Transfer | None = None,
+    reporting: bool = True,
+) -> list[str]:
+    if parallel > 1:
+        return _backup_parallel_command(
+            name,
+            volume,
+            server,
+            parallel,
+            generations=generations,
+            large_files=large_files,
+            transfer=transfer,
+            reporting=reporting,
+        )
+    if generations:
+        return _backup_generation_command(
+            name, volume, server, transfer, reporting=reporting
+        )
+    if large_files:
+        return _backup_large_files_command(
+            name, volume, server, large_files, transfer, reporting=reporting
+        )
     return [
         "rsync",
         "-av",
         "--delete",
+        *(RSYNC_REPORTING if reporting else RSYNC_STATS),
+        *(transfer.rsync_args() if transfer else []),
         f"/privateer/volumes/{volume}",
         f"{server}:/privateer/volumes/{name}",
     ]
 
 
+def backup_batch_command(
+    name: str,
+    volume: str,
+    servers: list[str],
+    *,
+    transfer: Transfer | None = None,
+) -> list[str]:
+    """Build a command to send one volume to several servers.
+
+    The delta is computed once, against the first server, and is
+    written to a batch file (`rsync --write-batch`) as it is sent.
+    That batch is then replayed on each of the other servers
+    (`rsync --read-batch`), so the volume is only walked and
+    checksummed once.  If replaying the batch fails on a server
+    (typically because its copy has drifted from the first server's),
+    we fall back on a normal rsync for that server.
+
+    Note that the batch file holds all of the changed data, so for an
+    initial backup it will be as large as the volume itself.
+
+    Args:
+        name: The name of the client machine.
+
+        volume: The name of the volume to back up.
+
+        servers: The names of the servers to back up to; the first
+            is used as the reference server.
+
+        transfer: Optionally, rsync tuning for the volume.
+
+    Return:
+        A command, suitable to run in the client container.
+    """
+    batch = "/tmp/privateer-batch"  # noqa: S108
+    src = shlex.quote(f"/privateer/volumes/{volume}")
+    dest = shlex.quote(f"/privateer/volumes/{name}")
+    ref, *others = servers
+    rsync = _rsync("-av --delete", transfer)
+    lines = [
+        "status=0",
+        f"{rsync} --write-batch={batch} {src} {ref}:{dest} || exit 1",
+        f"echo 'privateer: {ref}: sent, writing batch'",
+    ]
+    for server in others:
+        read_batch = f"rsync --read-batch=- -a --delete {dest} < {batch}"
+        lines += [
+            f"if ssh {server} {read_batch}; then",
+            f"  echo 'privateer: {server}: applied batch'",
+            "else",
+            f"  echo 'privateer: {server}: batch failed, running rsync'",
+            f"  {rsync} {src} {server}:{dest} || status=1",
+            "fi",
+        ]
+    lines.append(f"rm -f {batch} {batch}.sh")
+    lines.append("exit $status")
+    return ["bash", "-c", "\n".join(lines)]
+
+
+# Each backup goes into a new directory, via a '.partial' directory so
+# that an interrupted backup is never mistaken for a complete one.
+# Any '.partial' directories left behind by earlier failed backups
+# are removed before starting, as they would otherwise never be
+# cleaned up (pruning only considers complete generations).
+# The '--link-dest' path is relative to the destination directory, so
+# refers to the 'latest' link alongside it.  On the first backup this
+# does not exist yet, which rsync warns about but otherwise ignores.
+def _backup_generation_command(
+    name: str,
+    volume: str,
+    server: str,
+    transfer: Transfer | None,
+    *,
+    reporting: bool = True,
+) -> list[str]:
+    src = f"/privateer/volumes/{volume}/"
+    dest = f"/privateer/volumes/{name}/{volume}"
+    partial = f"{dest}/$ts.partial"
+    finish = f"mv {partial} {dest}/$ts && ln -sfn $ts {dest}/{LATEST}"
+    rsync = _rsync(
+        f"-av --link-dest=../{LATEST}", transfer, reporting=reporting
+    )
+    lines = [
+        "set -e",
+        "ts=$(date -u +%Y%m%d-%H%M%S)",
+        f'ssh {server} "rm -rf {dest}/*.partial && mkdir -p {dest}"',
+        f"{rsync} {src} {server}:{partial}/",
+        f'ssh {server} "{finish}"',
+    ]
+    return ["bash", "-c", "\n".join(lines)]
+
+
+# Files over the 'large_files' threshold are left out of the rsync
+# (excluded files are also protected from '--delete' on the server),
+# and are then sent in chunks by the 'privateer-large-files' script
+# that is installed in both the client and server images.
+def _large_files_lines(
+    server: str, dest: str, large_files: LargeFiles
+) -> tuple[list[str], str, str]:
+    lf = "privateer-large-files"
+    find = [
+        "large=$(mktemp -d)",
+        f'{lf} list . {large_files.threshold} > "$large/files"',
+        f'{lf} excludes < "$large/files" > "$large/exclude"',
+    ]
+    exclude = '--from0 --exclude-from="$large/exclude"'
+    send = (
+        f"{lf} send . {server} {dest} {large_files.chunk} "
+        f'{large_files.streams} < "$large/files"'
+    )
+    return find, exclude, send
+
+
+def _backup_large_files_command(
+    name: str,
+    volume: str,
+    server: str,
+    large_files: LargeFiles,
+    transfer: Transfer | None,
+    *,
+    reporting: bool = True,
+) -> list[str]:
+    dest = f"/privateer/volumes/{name}/{volume}"
+    find, exclude, send = _large_files_lines(server, dest, large_files)
+    rsync = _rsync("-av --delete", transfer, reporting=reporting)
+    lines = [
+        "set -e",
+        f"cd /privateer/volumes/{volume}",
+        *find,
+        f"ssh {server} mkdir -p {dest}",
+        f"{rsync} {exclude} ./ {server}:{dest}/",
+        send,
+        'rm -rf "$large"',
+    ]
+    return ["bash", "-c", "\n".join(lines)]
+
+
+# Split a volume over 'parallel' rsync processes.  A first pass
+# copies just the root of the volume: the top-level files, symlinks
+# and (empty) directories, and deletes any top-level entries that are
+# no longer present.  Then each top-level directory is assigned to one
+# of the workers, largest first, to whichever has least data so far
+# (by 'du'), and the workers each sync their share recursively with
+# '--files-from'.  Deletion within each directory is handled by the
+# worker that owns it, so '--delete' behaves as for a single rsync.
+def _backup_parallel_command(
+    name: str,
+    volume: str,
+    server: str,
+    parallel: int,
+    *,
+    generations: bool,
+    large_files: LargeFiles | None,
+    transfer: Transfer | None,
+    reporting: bool = True,
+) -> list[str]:
+    dest = f"/privateer/volumes/{name}/{volume}"
+    lines = ["set -e"]
+    if generations:
+        lines.append("ts=$(date -u +%Y%m%d-%H%M%S)")
+        target = f"{dest}/$ts.partial"
+        # As for '_backup_generation_command()'
+        prepare = f'ssh {server} "rm -rf {dest}/*.partial && mkdir -p {target}"'
+        rsync = _rsync(
+            f"-av --link-dest=../{LATEST}", transfer, reporting=reporting
+        )
+    else:
+        target = dest
+        prepare = f"ssh {server} mkdir -p {target}"
+        rsync = _rsync("-av --delete", transfer, reporting=reporting)
+    find: list[str] = []
+    if large_files:
+        find, exclude, send = _large_files_lines(server, dest, large_files)
+        rsync = f"{rsync} {exclude}"
+    from0 = "" if large_files else " --from0"
+    worker = f'{rsync} -r{from0} --files-from="$lists/$i" ./'
+    sizes = "find . -mindepth 1 -maxdepth 1 -type d -exec du -sk0 {} +"
+    lines += [
+        f"cd /privateer/volumes/{volume}",
+        *find,
+        "lists=$(mktemp -d)",
+        prepare,
+        f"{rsync} --no-recursive --dirs ./ {server}:{target}/",
+        "declare -a load",
+        f"for ((i = 0; i < {parallel}; i++)); do",
+        '  load[i]=0; : > "$lists/$i"',
+        "done",
+        "while IFS=$'\\t' read -r -d '' size path; do",
+        "  best=0",
+        f"  for ((i = 1; i < {parallel}; i++)); do",
+        "    if ((load[i] < load[best])); then best=$i; fi",
+        "  done",
+        "  load[best]=$((load[best] + size))",
+        "  printf '%s\\0' \"${path#./}\" >> \"$lists/$best\"",
+        f"done < <({sizes} | sort -zrn)",
+        "pids=()",
+        f"for ((i = 0; i < {parallel}; i++)); do",
+        '  if [ -s "$lists/$i" ]; then',
+        f"    {worker} {server}:{target}/ &",
+        "    pids+=($!)",
+        "  fi",
+        "done",
+        "status=0",
+        'for pid in "${pids[@]}"; do wait "$pid" || status=1; done',
+        'rm -rf "$lists"',
+    ]
+    if large_files:
+        lines += [f"{send} || status=1", 'rm -rf "$large"']
+    if generations:
+        finish = f"mv {target} {dest}/$ts && ln -sfn $ts {dest}/{LATEST}"
+        lines.append(f'if [ $status = 0 ]; then ssh {server} "{finish}"; fi')
+    lines.append("exit $status")
+    return ["bash", "-c", "\n".join(lines)]
+
+
 def backup(
     cfg: Config,
     name: str,
     volume: str,
     *,
     server: str | None = None,
+    log_dir: str | Path | None = None,
+    verify: bool = True,
     dry_run: bool = False,
-) -> None:
-    machine = check_client(cfg, name, quiet=True)
+) -> TransferStats | None:
+    """Back up a volume to a server.
+
+    Args:
+        cfg: The privateer configuration.
+
+        name: The name of the client machine.
+
+        volume: The name of the volume to back up.
+
+        server: The name of the server to back up to.  This can be
+            omitted if only one server is configured.  To send the
+            volume to every server, use
+            [privateer.backup.backup_to_all_servers][].
+
+        log_dir: Optionally, a directory on the host to write the
+            full log of the backup into.  Only the last few lines of
+            output are otherwise kept.
+
+        verify: Check that the key volume holds this client's
+            identity (see [privateer.check.check][]).  Pass `False` to
+            skip this when scripting many operations.
+
+        dry_run: Don't run anything, but print the commands that
+            would be needed to run the backup.
+
+    Return:
+        Statistics about the transfer, parsed from rsync's output.
+        Nothing is returned for a dry run.
+
+    """
+    machine = check_client(cfg, name, quiet=True, verify=verify)
+    volume = match_value(volume, machine.backup, "volume")
+    if server == "all":
+        msg = "Use 'backup_to_all_servers' to back up to server 'all'"
+        raise Exception(msg)
     server = match_value(server, cfg.list_servers(), "server")
+    return _backup_volume(
+        cfg, machine, volume, server, log_dir=log_dir, dry_run=dry_run
+    )
+
+
+def backup_to_all_servers(
+    cfg: Config,
+    name: str,
+    volume: str,
+    *,
+    batch: bool = False,
+    log_dir: str | Path | None = None,
+    verify: bool = True,
+    dry_run: bool = False,
+) -> list[BackupResult]:
+    """Back up a volume to every configured server at once.
+
+    Each server gets its own container so that a slow or unreachable
+    server does not hold up the others.
+
+    Args:
+        cfg: The privateer configuration.
+
+        name: The name of the client machine.
+
+        volume: The name of the volume to back up.
+
+        batch: Rather than sending the volume to each server
+            separately, compute the changes once and replay them on
+            every server (see [privateer.backup.backup_batch_command][]).
+
+        log_dir: Optionally, a directory on the host to write the
+            full log of each backup into.  Only the last few lines of
+            output are otherwise kept.
+
+        verify: Check that the key volume holds this client's
+            identity (see [privateer.check.check][]).  Pass `False` to
+            skip this when scripting many operations.
+
+        dry_run: Don't run anything, but print the commands that
+            would be needed to run each backup.
+
+    Return:
+        A list of results, one per server (or a single result in
+        batch mode).  If any backup fails, an error is thrown after
+        the summary has been printed.
+
+    """
+    machine = check_client(cfg, name, quiet=True, verify=verify)
     volume = match_value(volume, machine.backup, "volume")
+    servers = cfg.list_servers()
+    if batch:
+        work: list[tuple[str, str | list[str]]] = [(volume, servers)]
+    else:
+        work = [(volume, s) for s in servers]
+    if dry_run:
+        for v, s in work:
+            _backup_volume(cfg, machine, v, s, dry_run=True)
+        return []
+    results = _run_backup_jobs(cfg, machine, work, len(work), log_dir)
+    _report_backup_results(results)
+    return results
+
+
+def backup_all(
+    cfg: Config,
+    name: str,
+    *,
+    server: str | None = None,
+    jobs: int = 4,
+    batch: bool = False,
+    log_dir: str | Path | None = None,
+    verify: bool = True,
+    dry_run: bool = False,
+) -> list[BackupResult]:
+    """Back up all volumes for a client.
+
+    Every volume listed in the client's `backup` field is sent to
+    every configured server (or just to `server`, if given).  The
+    individual backups are run through a pool of at most `jobs`
+    workers, so that several containers transfer data at once.
+
+    Args:
+        cfg: The privateer configuration.
+
+        name: The name of the client machine.
+
+        server: Optionally, the single server to back up to.  If not
+            given (or given as `all`), we back up to every configured
+            server.
+
+        jobs: The maximum number of backups to run at once.
+
+        batch: Send each volume to all servers in batch mode (see
+            [privateer.backup.backup_batch_command][]), rather than
+            to each server separately.
+
+        log_dir: Optionally, a directory on the host to write the
+            full log of each backup into.  Only the last few lines of
+            output are otherwise kept.
+
+        verify: Check that the key volume holds this client's
+            identity (see [privateer.check.check][]).  Pass `False` to
+            skip this when scripting many operations.
+
+        dry_run: Don't run anything, but print the commands that
+            would be needed to run each backup.
+
+    Return:
+        A list of results, one per backup job.  If any job fails, an
+        error is thrown after the summary has been printed.
+
+    """
+    machine = check_client(cfg, name, quiet=True, verify=verify)
+    if not machine.backup:
+        msg = f"'{name}' does not back up any volumes"
+        raise Exception(msg)
+    if server is None or server == "all":
+        servers = cfg.list_servers()
+    else:
+        servers = [match_value(server, cfg.list_servers(), "server")]
+    if batch:
+        work: list[tuple[str, str | list[str]]] = [
+            (v, servers) for v in machine.backup
+        ]
+    else:
+        work = [(v, s) for v in machine.backup for s in servers]
+    if dry_run:
+        for volume, to in work:
+            _backup_volume(cfg, machine, volume, to, dry_run=True)
+        return []
+    results = _run_backup_jobs(cfg, machine, work, jobs, log_dir)
+    _report_backup_results(results)
+    return results
+
+
+def _backup_volume(
+    cfg: Config,
+    machine: Client,
+    volume: str,
+    server: str | list[str],
+    *,
+    log_dir: str | Path | None = None,
+    concurrent: bool = False,
+    dry_run: bool,
+) -> TransferStats | None:
+    name = machine.name
     image = f"mrcide/privateer-client:{cfg.tag}"
     src = f"/privateer/volumes/{volume}"
     mounts = [
@@ -34,12 +507,37 @@ def backup(
         ),
         docker.types.Mount(src, volume, type="volume", read_only=True),
     ]
-    command = backup_command(name, volume, server)
+    generations = has_generations(cfg, volume)
+    vol = cfg.volume_config(volume)
+    if isinstance(server, list):
+        if generations:
+            msg = f"Batch mode is not supported for '{volume}' (generations)"
+            raise Exception(msg)
+        if vol.parallel > 1:
+            msg = f"Batch mode is not supported for '{volume}' (parallel)"
+            raise Exception(msg)
+        if vol.large_files:
+            msg = f"Batch mode is not supported for '{volume}' (large_files)"
+            raise Exception(msg)
+        command = backup_batch_command(
+            name, volume, server, transfer=vol.transfer
+        )
+        server = _servers_str(server)
+    else:
+        command = backup_command(
+            name,
+            volume,
+            server,
+            generations=generations,
+            parallel=vol.parallel,
+            large_files=vol.large_files,
+            transfer=vol.transfer,
+        )
     if dry_run:
         cmd = ["docker", "run", "--rm", *mounts_str(mounts), image, *command]
         print("Command to manually run backup:")
         print()
-        print(f"  {' '.join(cmd)}")
+        print(f"  {shlex.join(cmd)}")
         print()
         print(
             f"This will copy the volume '{volume}' from '{name}' "
@@ -49,11 +547,100 @@ def backup(
         print("Note that this uses hostname/port information for the server")
         print("contained within (config), along with our identity (id_rsa)")
         print("in the directory /privateer/keys")
-    else:
-        print(f"Backing up '{volume}' from '{name}' to '{server}'")
+        return None
+    print(f"Backing up '{volume}' from '{name}' to '{server}'")
+    log_file = log_file_path(log_dir, "backup", name, volume, server)
+    # Progress lines from other jobs sharing the terminal would
+    # overwrite a live line, so these get periodic, labelled lines.
+    # The workers of a 'parallel' volume each report their own
+    # percentage, which can't be told apart, so we report no progress
+    # for them (but still total their stats).
+    monitor = RsyncMonitor(
+        label=f"{volume} -> {server}",
+        live=not concurrent,
+        quiet=vol.parallel > 1,
+    )
+    try:
         run_container_with_command(
-            "Backup", image, command=command, mounts=mounts
+            "Backup",
+            image,
+            command=command,
+            mounts=mounts,
+            follow=monitor,
+            log_file=log_file,
+        )
+    finally:
+        monitor.finish()
+    # TODO: also copy over some metadata at this point, via
+    # ssh; probably best to write tiny utility in the client
+    # container that will do this for us.
+    stats = monitor.stats()
+    if stats:
+        print(f"Backup of '{volume}' to '{server}': {stats}")
+    return stats
+
+
+def _run_backup_jobs(
+    cfg: Config,
+    machine: Client,
+    work: list[tuple[str, str | list[str]]],
+    jobs: int,
+    log_dir: str | Path | None,
+) -> list[BackupResult]:
+    def run_one(volume: str, server: str | list[str]) -> BackupResult:
+        t0 = time.monotonic()
+        stats = None
+        try:
+            stats = _backup_volume(
+                cfg,
+                machine,
+                volume,
+                server,
+                log_dir=log_dir,
+                concurrent=concurrent,
+                dry_run=False,
+            )
+            error = None
+        except Exception as e:
+            error = str(e)
+        return BackupResult(
+            volume=volume,
+            server=_servers_str(server),
+            success=error is None,
+            elapsed=time.monotonic() - t0,
+            error=error,
+            stats=stats,
         )
-        # TODO: also copy over some metadata at this point, via
-        # ssh; probably best to write tiny utility in the client
-        # container that will do this for us.
+
+    concurrent = jobs > 1 and len(work) > 1
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        futures = [pool.submit(run_one, v, s) for v, s in work]
+        return [f.result() for f in futures]
+
+
+def _report_backup_results(results: list[BackupResult]) -> None:
+    print("Backup summary:")
+    for r in results:
+        status = "OK" if r.success else "FAILED"
+        line = f"  '{r.volume}' -> '{r.server}': {status} ({r.elapsed:.1f}s)"
+        if r.stats:
+            line += f": {format_bytes(r.stats.bytes_sent)} sent"
+        if r.error:
+            line += f": {r.error}"
+        print(line)
+    n_failed = sum(not r.success for r in results)
+    if n_failed:
+        msg = f"{n_failed} of {len(results)} backup jobs failed"
+        raise Exception(msg)
+
+
+def _rsync(
+    options: str, transfer: Transfer | None, *, reporting: bool = True
+) -> str:
+    args = transfer.rsync_args() if transfer else []
+    reports = RSYNC_REPORTING if reporting else RSYNC_STATS
+    return shlex.join(["rsync", *options.split(), *reports, *args])
+
+
+def _servers_str(server: str | list[str]) -> str:
+    return server if isinstance(server, str) else ",".join(server)
@@ -1,34 +1,90 @@
+import json
+import os
+import tempfile
+from pathlib import Path
+
 import docker
+from docker.models.volumes import Volume
+from pydantic import BaseModel
 
 from privateer.config import Client, Config, Server
-from privateer.util import string_from_volume
+from privateer.session import docker_client
+from privateer.util import (
+    cache_dir,
+    format_bytes,
+    string_from_volume,
+    volume_if_exists,
+)
+
+# Amount of data sent to each server when measuring throughput
+BANDWIDTH_TEST_SIZE = 16 * 1024 * 1024
 
 
 def check(
-    cfg: Config, name: str, *, connection: bool = False, quiet: bool = False
+    cfg: Config,
+    name: str,
+    *,
+    connection: bool = False,
+    bandwidth: bool = False,
+    quiet: bool = False,
+    verify: bool = True,
 ) -> Server | Client:
+    """Check that this machine is configured as `name`.
+
+    Reading the name back from the key volume needs a container, so
+    once a volume has been verified this is remembered on the host
+    (see `cache_dir()`), keyed by the volume's name and creation
+    time.  Recreating the volume, or running `configure`, forces the
+    volume to be checked again.
+
+    Args:
+        cfg: The configuration
+
+        name: The name of the machine we expect to be
+
+        connection: Also check that we can connect to each server
+            (for clients only), printing a table of results
+
+        bandwidth: With `connection`, also measure the throughput to
+            each server
+
+        quiet: Don't print anything on success
+
+        verify: Check the name stored in the key volume.  If `False`
+            we check only that the key volume exists.
+
+    Return:
+        The configuration of the machine.
+    """
     machine = cfg.machine_config(name)
     vol = machine.key_volume
-    try:
-        docker.from_env().volumes.get(vol)
-    except docker.errors.NotFound:
+    volume = volume_if_exists(vol)
+    if volume is None:
         msg = f"'{name}' looks unconfigured"
-        raise Exception(msg) from None
-    found = string_from_volume(vol, "name")
-    if found != name:
-        msg = f"Configuration is for '{found}', not '{name}'"
         raise Exception(msg)
+    if verify:
+        _verify_identity(volume, name)
     if not quiet:
-        print(f"Volume '{vol}' looks configured as '{name}'")
+        if verify:
+            print(f"Volume '{vol}' looks configured as '{name}'")
+        else:
+            print(f"Volume '{vol}' exists (not verifying identity)")
     if connection and isinstance(machine, Client):
-        _check_connections(cfg, machine)
+        print_connections(check_connections(cfg, machine, bandwidth=bandwidth))
     return machine
 
 
 def check_client(
-    cfg: Config, name: str, *, connection: bool = False, quiet: bool = False
+    cfg: Config,
+    name: str,
+    *,
+    connection: bool = False,
+    quiet: bool = False,
+    verify: bool = True,
 ) -> Client:
-    machine = check(cfg, name, connection=connection, quiet=quiet)
+    machine = check(
+        cfg, name, connection=connection, quiet=quiet, verify=verify
+    )
     if not isinstance(machine, Client):
         msg = f"'{name}' is not a privateer client (it is listed as a server)"
         raise Exception(msg)
@@ -36,42 +92,228 @@ def check_client(
 
 
 def check_server(
-    cfg: Config, name: str, *, connection: bool = False, quiet: bool = False
+    cfg: Config,
+    name: str,
+    *,
+    connection: bool = False,
+    quiet: bool = False,
+    verify: bool = True,
 ) -> Server:
-    machine = check(cfg, name, connection=connection, quiet=quiet)
+    machine = check(
+        cfg, name, connection=connection, quiet=quiet, verify=verify
+    )
     if not isinstance(machine, Server):
         msg = f"'{name}' is not a privateer server (it is listed as a client)"
         raise Exception(msg)
     return machine
 
 
-def _check_connections(
-    cfg: Config, machine: Server | Client
-) -> dict[str, bool]:
+class ConnectionResult(BaseModel):
+    """The result of checking the connection to one server.
+
+    Attributes:
+        server: The name of the server.
+
+        hostname: The hostname of the server.
+
+        success: Whether we could connect and authenticate.
+
+        latency: Time taken to connect, authenticate and run a trivial
+            command, in seconds.
+
+        throughput: Rate at which data could be sent to the server, in
+            bytes per second, if measured.
+
+        error: The error from ssh, if the connection failed.
+    """
+
+    server: str
+    hostname: str
+    success: bool
+    latency: float | None = None
+    throughput: float | None = None
+    error: str | None = None
+
+
+def check_connections(
+    cfg: Config, machine: Client, *, bandwidth: bool = False
+) -> list[ConnectionResult]:
+    """Check that a client can connect to every server.
+
+    All servers are checked at once from a single client container,
+    so the whole check takes about as long as the slowest server
+    (or the ssh timeout, if a server is unreachable).
+
+    Args:
+        cfg: The configuration
+
+        machine: The client to check from
+
+        bandwidth: Also send a little data
+            (`BANDWIDTH_TEST_SIZE` bytes) to each server and report the
+            rate it was sent at.  This takes longer on slow links.
+
+    Return:
+        A list of results, one per server.
+    """
     image = f"mrcide/privateer-client:{cfg.tag}"
     mounts = [
         docker.types.Mount(
             "/privateer/keys", machine.key_volume, type="volume", read_only=True
         )
     ]
-    cl = docker.from_env()
-    result = {}
+    servers = [s.name for s in cfg.servers]
+    command = connection_check_command(servers, bandwidth=bandwidth)
+    output = docker_client().containers.run(
+        image, mounts=mounts, command=command, remove=True
+    )
+    found = _parse_connection_results(output.decode("utf-8"))
+    ret = []
     for server in cfg.servers:
-        print(
-            f"checking connection to '{server.name}' ({server.hostname})...",
-            end="",
-            flush=True,
-        )
-        try:
-            command = ["ssh", server.name, "cat", "/privateer/keys/name"]
-            cl.containers.run(
-                image, mounts=mounts, command=command, remove=True
+        missing = {"success": False, "error": "No result from check"}
+        res = found.get(server.name, missing)
+        ret.append(
+            ConnectionResult(
+                server=server.name, hostname=server.hostname, **res
             )
-            result[server.name] = True
-            print("OK")
-        except docker.errors.ContainerError as e:
-            result[server.name] = False
-            print("ERROR")
-            e_str = e.stderr.decode("utf-8").strip()  #  type: ignore
-            print(e_str)
-    return result
+        )
+    return ret
+
+
+# Each server is checked in the background, and writes a single
+# tab-separated line of results: name, status, latency (us),
+# throughput test time (us) and any error.
+def connection_check_command(
+    servers: list[str], *, bandwidth: bool = False
+) -> list[str]:
+    ssh = "ssh -o BatchMode=yes -o ConnectTimeout=10"
+    send = (
+        f"head -c {BANDWIDTH_TEST_SIZE} /dev/zero | "
+        f"{ssh} \"$1\" 'cat > /dev/null'"
+    )
+    lines = [
+        "now() { echo $(( $(date +%s%N) / 1000 )); }",
+        "check() {",
+        "    local start latency out elapsed=",
+        "    start=$(now)",
+        f'    if ! out=$({ssh} "$1" true 2>&1); then',
+        "        printf '%s\\tERROR\\t\\t\\t%s\\n' \"$1\" \\",
+        "            \"$(echo \"$out\" | tr '\\t\\n' '  ')\"",
+        "        return",
+        "    fi",
+        "    latency=$(( $(now) - start ))",
+    ]
+    if bandwidth:
+        lines += [
+            "    start=$(now)",
+            f"    if {send} 2>/dev/null; then",
+            "        elapsed=$(( $(now) - start ))",
+            "    fi",
+        ]
+    lines += [
+        "    printf '%s\\tOK\\t%s\\t%s\\t\\n' \\",
+        '        "$1" "$latency" "$elapsed"',
+        "}",
+        "results=$(mktemp -d)",
+        "i=0",
+        'for server in "$@"; do',
+        '    check "$server" > "$results/$i" &',
+        "    i=$((i + 1))",
+        "done",
+        "wait",
+        'cat "$results"/*',
+    ]
+    return ["bash", "-c", "\n".join(lines), "privateer", *servers]
+
+
+def print_connections(results: list[ConnectionResult]) -> None:
+    header = ["server", "hostname", "status", "latency", "throughput"]
+    rows = [header]
+    for r in results:
+        rows.append(
+            [
+                r.server,
+                r.hostname,
+                "OK" if r.success else "ERROR",
+                "" if r.latency is None else f"{r.latency * 1000:.0f} ms",
+                (
+                    ""
+                    if r.throughput is None
+                    else f"{format_bytes(r.throughput)}/s"
+                ),
+            ]
+        )
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    for row in rows:
+        cells = (x.ljust(w) for x, w in zip(row, widths, strict=True))
+        print("  ".join(cells).rstrip())
+    for r in results:
+        if r.error:
+            print(f"'{r.server}': {r.error}")
+
+
+def _parse_connection_results(output: str) -> dict[str, dict]:
+    ret = {}
+    for line in output.splitlines():
+        parts = line.split("\t")
+        if len(parts) != 5:  # noqa: PLR2004
+            continue
+        name, status, latency, elapsed, error = parts
+        res: dict = {"success": status == "OK"}
+        if latency:
+            res["latency"] = int(latency) / 1e6
+        if latency and elapsed:
+            # Don't count the time taken to set up the connection
+            seconds = max(int(elapsed) - int(latency), 1) / 1e6
+            res["throughput"] = BANDWIDTH_TEST_SIZE / seconds
+        if error.strip():
+            res["error"] = error.strip()
+        ret[name] = res
+    return ret
+
+
+def forget_identity(volume: str) -> None:
+    """Forget that a key volume was verified.
+
+    Args:
+        volume: The name of the key volume
+    """
+    cache = _read_identity_cache()
+    if cache.pop(volume, None) is not None:
+        _write_identity_cache(cache)
+
+
+def _verify_identity(volume: Volume, name: str) -> None:
+    created = volume.attrs.get("CreatedAt")
+    cache = _read_identity_cache()
+    if cache.get(volume.name) == {"created": created, "name": name}:
+        return
+    found = string_from_volume(volume.name, "name")
+    if found != name:
+        msg = f"Configuration is for '{found}', not '{name}'"
+        raise Exception(msg)
+    cache[volume.name] = {"created": created, "name": name}
+    _write_identity_cache(cache)
+
+
+def _identity_cache_path() -> Path:
+    return cache_dir() / "identity.json"
+
+
+# A missing or unreadable cache is just an empty one; the worst that
+# happens is that we check the volume again.
+def _read_identity_cache() -> dict[str, dict[str, str]]:
+    try:
+        with _identity_cache_path().open() as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _write_identity_cache(cache: dict[str, dict[str, str]]) -> None:
+    path = _identity_cache_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", dir=path.parent, delete=False) as f:
+        json.dump(cache, f)
+    os.replace(f.name, path)
@@ -1,17 +1,12 @@
+import json
 from pathlib import Path
 
 import click
-import docker
 
-from privateer.backup import backup
-from privateer.check import check
-from privateer.configure import configure, write_identity
-from privateer.keys import keygen, keygen_all
-from privateer.restore import restore
-from privateer.root import privateer_root
-from privateer.schedule import schedule_start, schedule_status, schedule_stop
-from privateer.server import server_start, server_status, server_stop
-from privateer.tar import export_tar, export_tar_local, import_tar
+# Command implementations are imported within each command, so that
+# starting the cli (e.g., for '--version' or '--help') does not pay
+# for importing docker, hvac, cryptography, pydantic and yacron.  See
+# tests/test_cli.py::test_cli_import_is_lightweight.
 
 
 class NaturalOrderGroup(click.Group):
@@ -28,14 +23,22 @@ class NaturalOrderGroup(click.Group):
 
 @click.group(cls=NaturalOrderGroup)
 @click.version_option()
-def cli() -> None:
+@click.option("--timings", is_flag=True, help="Report time spent in docker")
+@click.pass_context
+def cli(ctx: click.Context, *, timings: bool) -> None:
     """Interact with privateer."""
-    pass  # pragma: no cover
+    from privateer.session import docker_session
+
+    session = ctx.with_resource(docker_session())
+    if timings:
+        ctx.call_on_close(lambda: print("\n".join(session.summary())))
 
 
 help_path = "The path to the configuration, or directory with privateer.json"
 help_as = "The machine to run the command as"
 help_dry_run = "Do nothing, but print docker commands"
+help_log_dir = "Directory to write full container logs into"
+help_no_verify = "Don't check the identity stored in the key volume"
 type_path = click.Path(path_type=Path)
 
 
@@ -48,13 +51,16 @@ def cli_pull(path: Path | None) -> None:
     (privateer.json in the local directory), which falls back on
     `main` if not specified.
     """
+    from privateer.root import privateer_root
+    from privateer.session import docker_client
+
     root = privateer_root(path)
     tag = root.config.tag
     img = [
         f"mrcide/privateer-client:{tag}",
         f"mrcide/privateer-server:{tag}",
     ]
-    cl = docker.from_env()  # type: ignore
+    cl = docker_client()
     for nm in img:
         print(f"pulling '{nm}'")
         cl.images.pull(nm)
@@ -64,7 +70,16 @@ def cli_pull(path: Path | None) -> None:
 @click.argument("name", required=False)
 @click.option("--path", type=type_path, help=help_path)
 @click.option("--all", is_flag=True, help="Generate all keys")
-def cli_keygen(path: Path | None, name: str | None, *, all: bool) -> None:
+@click.option(
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=8,
+    show_default=True,
+    help="Number of keys to generate and write at once, with '--all'",
+)
+def cli_keygen(
+    path: Path | None, name: str | None, jobs: int, *, all: bool
+) -> None:
     """Generate keys for use with privateer.
 
     Keys will be stored in the vault, on creation, and this will
@@ -73,12 +88,15 @@ def cli_keygen(path: Path | None, name: str | None, *, all: bool) -> None:
     (passing `--all`).
 
     """
+    from privateer.keys import keygen, keygen_all
+    from privateer.root import privateer_root
+
     root = privateer_root(path)
     if all:
         if name is not None:
             msg = "Don't provide 'name' if '--all' is also provided"
             raise RuntimeError(msg)
-        keygen_all(root.config)
+        keygen_all(root.config, jobs=jobs)
     else:
         if not name:
             msg = "Expected a name to be provided (or pass --all)"
@@ -86,6 +104,30 @@ def cli_keygen(path: Path | None, name: str | None, *, all: bool) -> None:
         keygen(root.config, name)
 
 
+@cli.group("vault", cls=NaturalOrderGroup)
+def cli_vault() -> None:
+    """Manage access to the vault."""
+    pass  # pragma: no cover
+
+
+@cli_vault.command("logout")
+@click.option("--path", type=type_path, help=help_path)
+def cli_vault_logout(path: Path | None) -> None:
+    """Forget the cached vault token.
+
+    After logging into the vault with a GitHub token, the vault token
+    is cached on this machine until it expires, so that subsequent
+    commands do not need to log in again.  This removes it, so that
+    the next command that uses the vault will log in afresh.
+
+    """
+    from privateer.root import privateer_root
+    from privateer.vault import vault_logout
+
+    root = privateer_root(path)
+    vault_logout(root.config.vault.url)
+
+
 @cli.command("configure")
 @click.option("--path", type=type_path, help=help_path)
 @click.argument("name")
@@ -98,6 +140,9 @@ def cli_configure(path: Path | None, name: str) -> None:
     name.
 
     """
+    from privateer.configure import configure, write_identity
+    from privateer.root import privateer_root
+
     root = privateer_root(path)
     configure(root.config, name)
     write_identity(root.path, name)
@@ -107,33 +152,90 @@ def cli_configure(path: Path | None, name: str) -> None:
 @click.option("--path", type=type_path, help=help_path)
 @click.option("--as", "name", metavar="NAME", help=help_as)
 @click.option("--connection", is_flag=True, help="Check the connection")
-def cli_check(path: Path | None, name: str | None, *, connection: bool) -> None:
+@click.option(
+    "--bandwidth",
+    is_flag=True,
+    help="Also measure throughput to each server (implies --connection)",
+)
+@click.option(
+    "--json", "as_json", is_flag=True, help="Print connection results as JSON"
+)
+def cli_check(
+    path: Path | None,
+    name: str | None,
+    *,
+    connection: bool,
+    bandwidth: bool,
+    as_json: bool,
+) -> None:
     """Check privateer configuration and connections.
 
     This command checks that everything is appropriately configured
     for use as a particular machine.  If `--connection` is passed we
     also check that we can communicate with any servers and can make
-    connections with the keys that we hold.
+    connections with the keys that we hold.  All servers are checked
+    at once, and the time taken to connect to each is reported; with
+    `--bandwidth` we also send a little data to each server and report
+    the throughput.
 
     """
+    from privateer.check import check, check_client, check_connections
+    from privateer.root import privateer_root
+
     root = privateer_root(path)
     name = _find_identity(name, root.path)
-    check(cfg=root.config, name=name, connection=connection)
+    connection = connection or bandwidth
+    if as_json:
+        if not connection:
+            msg = "'--json' requires '--connection'"
+            raise RuntimeError(msg)
+        machine = check_client(cfg=root.config, name=name, quiet=True)
+        results = check_connections(root.config, machine, bandwidth=bandwidth)
+        print(json.dumps([r.model_dump() for r in results], indent=2))
+    else:
+        check(
+            cfg=root.config,
+            name=name,
+            connection=connection,
+            bandwidth=bandwidth,
+        )
 
 
 @cli.command("backup")
 @click.option("--path", type=type_path, help=help_path)
 @click.option("--as", "name", metavar="NAME", help=help_as)
 @click.option("--dry-run", is_flag=True, help=help_dry_run)
-@click.option("--server", metavar="NAME", help="Server to back up to")
-@click.argument("volume")
+@click.option(
+    "--server", metavar="NAME", help="Server to back up to (or 'all')"
+)
+@click.option("--all", is_flag=True, help="Back up all volumes")
+@click.option(
+    "--batch",
+    is_flag=True,
+    help="Compute changes once and replay them on each server",
+)
+@click.option(
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="Number of backups to run at once, with '--all'",
+)
+@click.option("--log-dir", type=type_path, help=help_log_dir)
+@click.option("--no-verify", is_flag=True, help=help_no_verify)
+@click.argument("volume", required=False)
 def cli_backup(
     path: Path | None,
     name: str | None,
-    volume: str,
+    volume: str | None,
     server: str | None,
     *,
+    jobs: int,
+    log_dir: Path | None,
     dry_run: bool,
+    all: bool,
+    batch: bool,
+    no_verify: bool,
 ) -> None:
     """Back up a volume to a server.
 
@@ -141,16 +243,66 @@ def cli_backup(
     `ssh`; first uses will be slow, but subsequent uses likely much
     faster.
 
+    Use `--server=all` to send `volume` to every configured server at
+    once, with a summary of the status and timing for each server.
+
+    With `--batch` (and sending to more than one server), the changes
+    are computed once against the first server, written as an rsync
+    batch and replayed on the other servers, falling back on a normal
+    rsync for any server whose copy has drifted.
+
+    If `--all` is given, then every volume that this machine backs up
+    is sent to every server (or just to `--server`, if given), running
+    up to `--jobs` backups at once.  A summary is printed at the end
+    and the command fails if any backup failed.
+
     """
+    from privateer.backup import backup, backup_all, backup_to_all_servers
+    from privateer.root import privateer_root
+
     root = privateer_root(path)
     name = _find_identity(name, root.path)
-    backup(
-        cfg=root.config,
-        name=name,
-        volume=volume,
-        server=server,
-        dry_run=dry_run,
-    )
+    if all:
+        if volume is not None:
+            msg = "Don't provide 'volume' if '--all' is also provided"
+            raise RuntimeError(msg)
+        backup_all(
+            cfg=root.config,
+            name=name,
+            server=server,
+            jobs=jobs,
+            batch=batch,
+            log_dir=log_dir,
+            verify=not no_verify,
+            dry_run=dry_run,
+        )
+    else:
+        if not volume:
+            msg = "Expected a volume to be provided (or pass --all)"
+            raise RuntimeError(msg)
+        if server == "all":
+            backup_to_all_servers(
+                cfg=root.config,
+                name=name,
+                volume=volume,
+                batch=batch,
+                log_dir=log_dir,
+                verify=not no_verify,
+                dry_run=dry_run,
+            )
+        elif batch:
+            msg = "'--batch' requires '--server=all' (or '--all')"
+            raise RuntimeError(msg)
+        else:
+            backup(
+                cfg=root.config,
+                name=name,
+                volume=volume,
+                server=server,
+                log_dir=log_dir,
+                verify=not no_verify,
+                dry_run=dry_run,
+            )
 
 
 @cli.command("restore")
@@ -162,6 +314,11 @@ def cli_backup(
 @click.option(
     "--to-volume", metavar="NAME", help="Alternate volume to restore to"
 )
+@click.option(
+    "--generation", metavar="TIMESTAMP", help="Generation to restore from"
+)
+@click.option("--log-dir", type=type_path, help=help_log_dir)
+@click.option("--no-verify", is_flag=True, help=help_no_verify)
 @click.argument("volume")
 def cli_restore(
     path: Path | None,
@@ -169,9 +326,12 @@ def cli_restore(
     volume: str,
     server: str | None,
     source: str | None,
-    to_volume: str | None,
     *,
+    to_volume: str | None,
+    generation: str | None,
+    log_dir: Path | None,
     dry_run: bool,
+    no_verify: bool,
 ) -> None:
     """Restore data to a volume.
 
@@ -183,7 +343,14 @@ def cli_restore(
     If you provide a volume name with `--to-volume`, you can restore into a
     volume that differs from the upstream name.
 
+    For volumes where the server keeps generations, the most recent
+    copy is restored by default; pass `--generation` with the
+    timestamp of an earlier backup to restore that instead.
+
     """
+    from privateer.restore import restore
+    from privateer.root import privateer_root
+
     root = privateer_root(path)
     name = _find_identity(name, root.path)
     restore(
@@ -193,6 +360,9 @@ def cli_restore(
         to_volume=to_volume,
         server=server,
         source=source,
+        generation=generation,
+        log_dir=log_dir,
+        verify=not no_verify,
         dry_run=dry_run,
     )
 
@@ -203,6 +373,33 @@ def cli_restore(
 @click.option("--dry-run", is_flag=True, help=help_dry_run)
 @click.option("--to-dir", type=type_path, help="Directory to export to")
 @click.option("--source", metavar="NAME", help="Source for the data")
+@click.option(
+    "--server",
+    metavar="NAME",
+    help="Server to export from over ssh (when run on a client)",
+)
+@click.option(
+    "--compress",
+    type=click.Choice(["gzip", "zstd"]),
+    help="Compress the tar file",
+)
+@click.option(
+    "--threads",
+    type=click.IntRange(min=1),
+    help="Number of threads to compress with (default: all cores)",
+)
+@click.option(
+    "--split",
+    type=click.IntRange(min=1),
+    metavar="MIB",
+    help="Write the tar file in chunks of this many MiB",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Export only files changed since the last incremental export",
+)
+@click.option("--no-verify", is_flag=True, help=help_no_verify)
 @click.argument("volume")
 def cli_export(
     path: Path | None,
@@ -211,36 +408,103 @@ def cli_export(
     source: str | None,
     to_dir: str | None,
     *,
+    server: str | None,
+    split: int | None,
+    compress: str | None,
+    threads: int | None,
+    incremental: bool,
     dry_run: bool,
+    no_verify: bool,
 ) -> None:
     """Export a volume as tar file.
 
     If using `--source=local` then no configuration is read, this will
     create a tar file of any docker volume.
 
+    With `--compress`, the tar file is compressed (with gzip or zstd)
+    as it is written, using several threads.
+
+    With `--split`, a directory is written instead, holding the tar
+    file in chunks (each compressed separately), along with a manifest
+    of their checksums.  This can be imported in the same way as a
+    single tar file.
+
+    With `--incremental`, a snapshot of the volume's state is kept in
+    the export directory (`<volume>.snar`, or `<source>-<volume>.snar`)
+    and only files changed since the previous incremental export are
+    written.  The first such export (or any export after the snapshot
+    is deleted) is a full one.
+
+    With `--server`, run on a client: `tar` runs on the server over
+    ssh, and the archive is streamed into a file here, along with its
+    sha256 checksum, so nothing is written on the server.  This cannot
+    be combined with `--split` or `--incremental`.
+
     """
-    if source == "local":
+    from privateer.root import privateer_root
+    from privateer.tar import export_tar, export_tar_local, export_tar_remote
+
+    if server:
+        if source == "local":
+            msg = "Can't use '--source=local' with '--server'"
+            raise RuntimeError(msg)
+        if split or incremental:
+            msg = "Can't use '--split' or '--incremental' with '--server'"
+            raise RuntimeError(msg)
+        root = privateer_root(path)
+        export_tar_remote(
+            cfg=root.config,
+            name=_find_identity(name, root.path),
+            volume=volume,
+            server=server,
+            to_dir=to_dir,
+            source=source,
+            compress=compress,
+            threads=threads,
+            verify=not no_verify,
+            dry_run=dry_run,
+        )
+    elif source == "local":
         # Disallow:
         #   --path (no use of root)
         #   --as [name] (requires config)
-        export_tar_local(volume=volume, to_dir=to_dir, dry_run=dry_run)
+        export_tar_local(
+            volume=volume,
+            to_dir=to_dir,
+            compress=compress,
+            threads=threads,
+            split=split,
+            incremental=incremental,
+            dry_run=dry_run,
+        )
     else:
         root = privateer_root(path)
+        if incremental and root.config.volume_config(volume).generations:
+            msg = (
+                f"Can't use '--incremental' with '{volume}', "
+                "as it keeps generations"
+            )
+            raise RuntimeError(msg)
         export_tar(
             cfg=root.config,
             name=name,
             volume=volume,
             to_dir=to_dir,
             source=source,
+            compress=compress,
+            threads=threads,
+            split=split,
+            incremental=incremental,
+            verify=not no_verify,
             dry_run=dry_run,
         )
 
 
 @cli.command("import")
 @click.option("--dry-run", is_flag=True, help=help_dry_run)
-@click.argument("tarfile")
+@click.argument("tarfile", nargs=-1, required=True)
 @click.argument("volume")
-def cli_import(tarfile: str, volume: str, *, dry_run: bool) -> None:
+def cli_import(tarfile: tuple[str, ...], volume: str, *, dry_run: bool) -> None:
     """Import a volume from a tarfile.
 
     Given a tarfile containing the exported contents of a volume,
@@ -250,17 +514,39 @@ def cli_import(tarfile: str, volume: str, *, dry_run: bool) -> None:
     If the volume exists already, this command will immediately fail,
     with no data written.
 
+    Compressed tar files (from `export --compress`) are detected and
+    decompressed as they are read.  To import a split export (from
+    `export --split`) pass its directory as `TARFILE`; each chunk is
+    checked against the manifest before it is used.
+
+    To restore from incremental exports (from `export --incremental`),
+    give the full export followed by each incremental export in the
+    order they were made; they are applied in turn.
+
     """
-    import_tar(volume=volume, tarfile=tarfile, dry_run=dry_run)
+    from privateer.tar import import_tar
+
+    import_tar(
+        volume=volume,
+        tarfile=tarfile[0],
+        incremental=list(tarfile[1:]),
+        dry_run=dry_run,
+    )
 
 
 @cli.command("server")
 @click.option("--as", "name", metavar="NAME", help=help_as)
 @click.option("--path", type=type_path, help=help_path)
 @click.option("--dry-run", is_flag=True, help=help_dry_run)
+@click.option("--no-verify", is_flag=True, help=help_no_verify)
 @click.argument("action", type=click.Choice(["start", "stop", "status"]))
 def cli_server(
-    path: Path | None, name: str, action: str, *, dry_run: bool
+    path: Path | None,
+    name: str,
+    action: str,
+    *,
+    dry_run: bool,
+    no_verify: bool,
 ) -> None:
     """Interact with the privateer server.
 
@@ -268,27 +554,76 @@ def cli_server(
     is required to receive backups and runs sshd.
 
     """
+    from privateer.root import privateer_root
+    from privateer.server import server_start, server_status, server_stop
+
     root = privateer_root(path)
     if action == "start":
-        server_start(cfg=root.config, name=name, dry_run=dry_run)
+        server_start(
+            cfg=root.config, name=name, verify=not no_verify, dry_run=dry_run
+        )
     elif action == "stop":
         server_stop(cfg=root.config, name=name)
     else:  # status
         server_status(cfg=root.config, name=name)
 
 
+@cli.command("prune")
+@click.option("--path", type=type_path, help=help_path)
+@click.option("--as", "name", metavar="NAME", help=help_as)
+@click.option("--dry-run", is_flag=True, help="Only list what would be removed")
+@click.option(
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="Number of concurrent deletes",
+)
+def cli_prune(
+    path: Path | None, name: str | None, jobs: int, *, dry_run: bool
+) -> None:
+    """Remove expired backup generations from the server.
+
+    For each volume with a `retention` policy, removes the generations
+    that are no longer kept, and reports how much disk space was
+    freed.  The server must be running.
+
+    """
+    from privateer.prune import prune
+    from privateer.root import privateer_root
+
+    root = privateer_root(path)
+    name = _find_identity(name, root.path)
+    prune(cfg=root.config, name=name, jobs=jobs, dry_run=dry_run)
+
+
 @cli.command("schedule")
 @click.option("--as", "name", metavar="NAME", help=help_as)
 @click.option("--path", type=type_path, help=help_path)
 @click.option("--dry-run", is_flag=True, help=help_dry_run)
+@click.option("--no-verify", is_flag=True, help=help_no_verify)
 @click.argument("action", type=click.Choice(["start", "stop", "status"]))
 def cli_schedule(
-    path: Path | None, name: str, action: str, *, dry_run: bool
+    path: Path | None,
+    name: str,
+    action: str,
+    *,
+    dry_run: bool,
+    no_verify: bool,
 ) -> None:
     """Interact with the privateer scheduled backups."""
+    from privateer.root import privateer_root
+    from privateer.schedule import (
+        schedule_start,
+        schedule_status,
+        schedule_stop,
+    )
+
     root = privateer_root(path)
     if action == "start":
-        schedule_start(cfg=root.config, name=name, dry_run=dry_run)
+        schedule_start(
+            cfg=root.config, name=name, verify=not no_verify, dry_run=dry_run
+        )
     elif action == "stop":
         schedule_stop(cfg=root.config, name=name)
     else:  # status
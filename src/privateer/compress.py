@@ -0,0 +1,192 @@
+# Compression of exported tar files.  Archives are compressed on the
+# host as they are streamed out of the container, and decompressed on
+# the host as they are streamed back in on import, so the only tools
+# needed in the container are those in a stock ubuntu image, and no
+# uncompressed copy is ever written to disk.
+import gzip
+import os
+import zlib
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Any
+
+COMPRESSION = ["gzip", "zstd"]
+
+# Each block of input is compressed independently (as a separate gzip
+# member) so that blocks can be compressed in parallel.
+GZIP_BLOCK_SIZE = 4 * 1024 * 1024
+
+_EXTENSIONS = {None: ".tar", "gzip": ".tar.gz", "zstd": ".tar.zst"}
+_MAGIC = {"gzip": b"\x1f\x8b", "zstd": b"\x28\xb5\x2f\xfd"}
+
+
+def check_compression(method: str | None) -> None:
+    if method is not None and method not in COMPRESSION:
+        valid = ", ".join(f"'{x}'" for x in COMPRESSION)
+        msg = f"Invalid compression '{method}', must be one of {valid}"
+        raise Exception(msg)
+
+
+def tar_extension(method: str | None) -> str:
+    return _EXTENSIONS[method]
+
+
+def detect_compression(path: str | Path) -> str | None:
+    """Detect how a file is compressed, from its first few bytes.
+
+    Args:
+        path: Path to the file
+
+    Return:
+        The compression method (one of `COMPRESSION`) or `None` if
+        the file does not look compressed.
+    """
+    with open(path, "rb") as f:
+        head = f.read(4)
+    for method, magic in _MAGIC.items():
+        if head.startswith(magic):
+            return method
+    return None
+
+
+@contextmanager
+def compressed_writer(
+    f: IO[bytes], method: str | None, *, threads: int | None = None
+) -> Iterator[Any]:
+    """Compress everything written, writing the result to `f`.
+
+    Args:
+        f: A file opened for writing in binary mode
+
+        method: The compression method, or `None` to write data
+            unchanged
+
+        threads: The number of threads to compress with; by default
+            use all available cores
+
+    Return:
+        A context manager, yielding an object with a `write` method.
+    """
+    check_compression(method)
+    threads = threads or os.cpu_count() or 1
+    if method is None:
+        yield f
+    elif method == "gzip":
+        writer = ParallelGzipWriter(f, threads=threads)
+        try:
+            yield writer
+        finally:
+            writer.close()
+    else:
+        zstandard = _import_zstandard()
+        # zstandard counts worker threads in addition to the calling
+        # thread, with 0 meaning compress on the calling thread.
+        cctx = zstandard.ZstdCompressor(threads=0 if threads == 1 else threads)
+        with cctx.stream_writer(f, closefd=False) as writer:
+            yield writer
+
+
+def decompressed_chunks(
+    path: str | Path, method: str | None, *, chunk_size: int = 1024 * 1024
+) -> Iterator[bytes]:
+    """Read a file, decompressing it if needed.
+
+    Args:
+        path: Path to the file
+
+        method: The compression method used (see
+            `detect_compression()`), or `None` if the file is not
+            compressed
+
+        chunk_size: The size of chunks to read
+
+    Return:
+        An iterator of chunks of decompressed data.
+    """
+    check_compression(method)
+    with open(path, "rb") as raw:
+        if method == "gzip":
+            f = gzip.GzipFile(fileobj=raw)
+        elif method == "zstd":
+            dctx = _import_zstandard().ZstdDecompressor()
+            f = dctx.stream_reader(raw, read_across_frames=True)
+        else:
+            f = raw
+        while chunk := f.read(chunk_size):
+            yield chunk
+
+
+class ParallelGzipWriter:
+    """Write gzip-compressed data, compressing on several threads.
+
+    Input is split into blocks of `block_size` bytes and each block is
+    compressed as a separate gzip member, as `pigz` does; the
+    concatenation of these is itself a valid gzip file, readable by
+    `gzip`, `tar` or python's `gzip` module.  At most two blocks per
+    thread are held in memory at once.
+    """
+
+    def __init__(
+        self,
+        f: IO[bytes],
+        *,
+        threads: int = 1,
+        level: int = 6,
+        block_size: int = GZIP_BLOCK_SIZE,
+    ):
+        self._f = f
+        self._level = level
+        self._block_size = block_size
+        self._max_pending = 2 * threads
+        self._pool = ThreadPoolExecutor(threads) if threads > 1 else None
+        self._pending: deque[Future[bytes]] = deque()
+        self._buf = bytearray()
+        self._blocks = 0
+
+    def write(self, data: bytes) -> int:
+        self._buf += data
+        while len(self._buf) >= self._block_size:
+            block = bytes(self._buf[: self._block_size])
+            del self._buf[: self._block_size]
+            self._submit(block)
+        return len(data)
+
+    def close(self) -> None:
+        if self._buf or self._blocks == 0:
+            self._submit(bytes(self._buf))
+            self._buf.clear()
+        while self._pending:
+            self._f.write(self._pending.popleft().result())
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _submit(self, block: bytes) -> None:
+        self._blocks += 1
+        if self._pool is None:
+            self._f.write(_gzip_block(block, self._level))
+            return
+        self._pending.append(self._pool.submit(_gzip_block, block, self._level))
+        while len(self._pending) > self._max_pending:
+            self._f.write(self._pending.popleft().result())
+
+
+def _gzip_block(block: bytes, level: int) -> bytes:
+    # wbits of 31 gives a gzip (rather than zlib) header and trailer
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(block) + compressor.flush()
+
+
+def _import_zstandard():
+    try:
+        import zstandard  # noqa: PLC0415
+    except ImportError:
+        msg = (
+            "zstd compression requires the 'zstandard' package; "
+            "install it with 'pip install privateer[zstd]'"
+        )
+        raise Exception(msg) from None
+    return zstandard
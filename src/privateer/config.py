@@ -1,10 +1,12 @@
-import json
 from pathlib import Path
-from typing import Any
+from typing import TYPE_CHECKING, Any
 
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 
-from privateer.vault import hvac, vault_client
+if TYPE_CHECKING:
+    import hvac
+
+KEY_TYPES = ["ed25519", "rsa"]
 
 
 class ScheduleJob(BaseModel):
@@ -117,6 +119,117 @@ class Client(BaseModel):
     schedule: Schedule | None = None
 
 
+class Retention(BaseModel):
+    """Configure which backup generations the server keeps.
+
+    Each rule selects generations to keep, and a generation is kept
+    if any rule selects it; all other generations are removed by
+    `privateer prune`.  The most recent generation is always kept.
+
+    Attributes:
+        keep_last: Keep this many of the most recent generations.
+
+        daily: Keep the most recent generation from each of this many
+            days (counting only days that have a generation).
+
+        weekly: Keep the most recent generation from each of this
+            many weeks.
+
+        monthly: Keep the most recent generation from each of this
+            many months.
+
+    """
+
+    keep_last: int = 0
+    daily: int = 0
+    weekly: int = 0
+    monthly: int = 0
+
+
+class LargeFiles(BaseModel):
+    """Configure transfer of very large files within a volume.
+
+    Large files are excluded from the volume's rsync, and are instead
+    split into fixed-size chunks.  The checksum of each chunk is
+    compared against the copy on the server, and only chunks that
+    differ are sent, over several ssh connections at once.
+
+    Attributes:
+        threshold: Files larger than this size, in MiB, are sent in
+            chunks.
+
+        chunk: The size of each chunk, in MiB.
+
+        streams: The number of chunks to checksum and send at once.
+
+    """
+
+    threshold: int = 1024
+    chunk: int = 64
+    streams: int = 4
+
+
+class Transfer(BaseModel):
+    """Tune how rsync transfers a volume.
+
+    Attributes:
+        compress: Optionally, the compression algorithm to use on the
+            wire (e.g., `zstd`, `lz4` or `zlib`).  Compression is off
+            by default, which is best on fast local links; on slower
+            (e.g., WAN) links it can help considerably.
+
+        compress_level: Optionally, the compression level.  Implies
+            compression, with rsync's default algorithm if `compress`
+            is not given.
+
+        checksum: Optionally, the checksum algorithm used to compare
+            files (e.g., `xxh128` or `md5`).
+
+        inplace: Update changed files in place, rather than writing a
+            new copy and moving it into place.  This saves disk space
+            and write traffic on the server for large files, at the
+            cost of leaving a partially-updated file if a transfer is
+            interrupted.
+
+        whole_file: Send changed files in full, without rsync's delta
+            algorithm.  This is often faster on fast links where the
+            delta computation is the bottleneck.
+
+        exclude: A list of rsync patterns for files that should not be
+            transferred.
+
+    """
+
+    compress: str | None = None
+    compress_level: int | None = None
+    checksum: str | None = None
+    inplace: bool = False
+    whole_file: bool = False
+    exclude: list[str] = []
+
+    def rsync_args(self) -> list[str]:
+        """Convert transfer settings into arguments for rsync.
+
+        Return:
+            A list of arguments to pass to rsync.
+        """
+        ret = []
+        if self.compress or self.compress_level is not None:
+            ret.append("--compress")
+        if self.compress:
+            ret.append(f"--compress-choice={self.compress}")
+        if self.compress_level is not None:
+            ret.append(f"--compress-level={self.compress_level}")
+        if self.checksum:
+            ret.append(f"--checksum-choice={self.checksum}")
+        if self.inplace:
+            ret.append("--inplace")
+        if self.whole_file:
+            ret.append("--whole-file")
+        ret += [f"--exclude={x}" for x in self.exclude]
+        return ret
+
+
 class Volume(BaseModel):
     """Describe a volume.
 
@@ -129,10 +242,47 @@ class Volume(BaseModel):
             where content arrives on the server through some other
             process (in our case it's a barman process that is doing
             continual backup of a Postgres server).
+
+        generations: An optional boolean indicating if the server
+            should keep a history of backups of this volume.  If
+            true, each backup is written to a new timestamped
+            directory on the server, with unchanged files hard-linked
+            against the previous backup (via rsync's `--link-dest`),
+            and a `latest` link pointing at the most recent copy.
+            This gives point-in-time history for very little
+            additional disk use or transfer.
+
+        retention: Optionally, a retention policy for the server's
+            generations of this volume, used by `privateer prune`.
+            Only valid if `generations` is true.  Without this, all
+            generations are kept.
+
+        parallel: The number of concurrent rsync processes used to
+            back up this volume.  With more than one, the top-level
+            directories of the volume are shared out between the
+            processes, balanced by size, which helps saturate fast
+            links where a single rsync (and its single ssh stream)
+            cannot.  This only helps if the volume has several
+            top-level directories of broadly similar size.  Not
+            supported with `--batch` backups.
+
+        large_files: Optionally, settings for sending very large
+            files (such as database files or disk images) in chunks
+            over several connections; see `LargeFiles`.  Not
+            supported with `generations` or `--batch` backups.
+
+        transfer: Optionally, settings for compression, checksums and
+            other rsync tuning, used for backups and restores of this
+            volume; see `Transfer`.
     """
 
     name: str
     local: bool = False
+    generations: bool = False
+    retention: Retention | None = None
+    parallel: int = 1
+    large_files: LargeFiles | None = None
+    transfer: Transfer | None = None
 
 
 class Vault(BaseModel):
@@ -158,7 +308,11 @@ class Vault(BaseModel):
     prefix: str
     token: str | None = None
 
-    def client(self) -> hvac.Client:
+    def client(self) -> "hvac.Client":
+        # Imported here so that commands that never touch the vault
+        # do not pay for importing hvac
+        from privateer.vault import vault_client  # noqa: PLC0415
+
         return vault_client(self.url, self.token)
 
 
@@ -179,6 +333,11 @@ class Config(BaseModel):
         tag: Optionally, the docker tag to use for `privateer` images.
             The default `latest` will be appropriate unless you are
             testing some new feature.
+
+        key_type: The type of ssh key created by `keygen`; either
+            `ed25519` (the default; fast to generate and small) or
+            `rsa`.  Existing keys are used whatever their type, so
+            this only matters when keys are (re)generated.
     """
 
     servers: list[Server]
@@ -186,9 +345,14 @@ class Config(BaseModel):
     volumes: list[Volume]
     vault: Vault
     tag: str = "latest"
+    key_type: str = "ed25519"
+
+    _machines: dict[str, Server | Client] = PrivateAttr(default_factory=dict)
+    _volumes: dict[str, Volume] = PrivateAttr(default_factory=dict)
 
     def model_post_init(self, __context) -> None:
         _check_config(self)
+        self._build_index()
 
     def list_servers(self) -> list[str]:
         """List known servers.
@@ -214,6 +378,21 @@ class Config(BaseModel):
         """
         return [x.name for x in self.volumes]
 
+    def volume_config(self, name: str) -> Volume:
+        """Fetch the configuration for a given volume.
+
+        Return:
+            Configuration for a volume.
+        """
+        el = self._volumes.get(name)
+        if el is None or el.name != name:
+            self._build_index()
+            el = self._volumes.get(name)
+        if el is not None:
+            return el
+        msg = f"Unknown volume '{name}'"
+        raise Exception(msg)
+
     def machine_config(self, name: str) -> Server | Client:
         """Fetch the configuration for a given machine.
 
@@ -222,14 +401,24 @@ class Config(BaseModel):
             clients and servers, with few overlapping fields.
 
         """
-        for el in self.servers + self.clients:
-            if el.name == name:
-                return el
+        el = self._machines.get(name)
+        if el is None or el.name != name:
+            self._build_index()
+            el = self._machines.get(name)
+        if el is not None:
+            return el
         valid = self.list_servers() + self.list_clients()
         valid_str = ", ".join(f"'{x}'" for x in valid)
         msg = f"Invalid configuration '{name}', must be one of {valid_str}"
         raise Exception(msg)
 
+    # Lookups go through these indexes, built once the configuration
+    # is validated.  The lists can still be modified afterwards (e.g.,
+    # renaming a volume) so a failed lookup rebuilds them first.
+    def _build_index(self) -> None:
+        self._machines = {x.name: x for x in self.servers + self.clients}
+        self._volumes = {x.name: x for x in self.volumes}
+
 
 def read_config(path: str | Path) -> Config:
     """Read configuration from disk.
@@ -242,21 +431,52 @@ def read_config(path: str | Path) -> Config:
     """
 
     with open(path) as f:
-        return Config(**json.loads(f.read().strip()))
+        return Config.model_validate_json(f.read())
 
 
 def _check_config(cfg: Config) -> None:
-    servers = cfg.list_servers()
-    clients = cfg.list_clients()
-    _check_not_duplicated(servers, "servers")
-    _check_not_duplicated(clients, "clients")
-    err = set(cfg.list_servers()).intersection(set(cfg.list_clients()))
+    servers = set(cfg.list_servers())
+    clients = set(cfg.list_clients())
+    _check_not_duplicated(cfg.list_servers(), "servers")
+    _check_not_duplicated(cfg.list_clients(), "clients")
+    if "all" in servers:
+        msg = "Invalid server name 'all', as this is reserved"
+        raise Exception(msg)
+    if cfg.key_type not in KEY_TYPES:
+        valid = ", ".join(f"'{x}'" for x in KEY_TYPES)
+        msg = f"Invalid key_type '{cfg.key_type}', must be one of {valid}"
+        raise Exception(msg)
+    err = servers & clients
     if err:
-        err_str = ", ".join(f"'{nm}'" for nm in err)
+        err_str = ", ".join(f"'{nm}'" for nm in sorted(err))
         msg = f"Invalid machine listed as both a client and a server: {err_str}"
         raise Exception(msg)
-    vols_local = [x.name for x in cfg.volumes if x.local]
-    vols_all = [x.name for x in cfg.volumes]
+    for v in cfg.volumes:
+        if v.local and v.generations:
+            msg = f"Local volume '{v.name}' cannot have generations"
+            raise Exception(msg)
+        if v.retention and not v.generations:
+            msg = f"Volume '{v.name}' has a retention policy but no generations"
+            raise Exception(msg)
+        if v.parallel < 1:
+            msg = f"Volume '{v.name}' must have 'parallel' of at least 1"
+            raise Exception(msg)
+        if v.large_files and v.generations:
+            msg = f"Volume '{v.name}' cannot use large_files with generations"
+            raise Exception(msg)
+        if v.transfer and v.transfer.inplace and v.generations:
+            msg = f"Volume '{v.name}' cannot use 'inplace' with generations"
+            raise Exception(msg)
+        if v.large_files:
+            for key, value in v.large_files.model_dump().items():
+                if value < 1:
+                    msg = (
+                        f"Volume '{v.name}' must have 'large_files.{key}' "
+                        "of at least 1"
+                    )
+                    raise Exception(msg)
+    vols_local = {x.name for x in cfg.volumes if x.local}
+    vols_all = {x.name for x in cfg.volumes}
     for cl in cfg.clients:
         for v in cl.backup:
             if v not in vols_all:
@@ -266,6 +486,7 @@ def _check_config(cfg: Config) -> None:
                 msg = f"Client '{cl.name}' backs up local volume '{v}'"
                 raise Exception(msg)
         if cl.schedule:
+            backup = set(cl.backup)
             for j in cl.schedule.jobs:
                 if j.server not in servers:
                     msg = (
@@ -273,7 +494,7 @@ def _check_config(cfg: Config) -> None:
                         f"unknown server '{j.server}'"
                     )
                     raise Exception(msg)
-                if j.volume not in cl.backup:
+                if j.volume not in backup:
                     msg = (
                         f"Client '{cl.name}' scheduling backup of "
                         f"volume '{j.volume}', which it does not back up"
@@ -1,48 +1,38 @@
 from pathlib import Path
 
-import docker
-
+from privateer.check import forget_identity
 from privateer.config import Config
 from privateer.keys import keys_data
-from privateer.util import string_to_volume
+from privateer.session import current_session
+from privateer.util import strings_to_volume
 from privateer.yacron import generate_yacron_yaml
 
 
 def configure(cfg: Config, name: str) -> None:
-    cl = docker.from_env()
     keys = keys_data(cfg, name)
     schedule = generate_yacron_yaml(cfg, name)
     vol = cfg.machine_config(name).key_volume
-    cl.volumes.create(vol)
+    current_session().create_volume(vol)
+    forget_identity(vol)
     print(f"Copying keypair for '{name}' to volume '{vol}'")
-    string_to_volume(
-        keys["public"], vol, "id_rsa.pub", uid=0, gid=0, mode=0o644
-    )
-    string_to_volume(keys["private"], vol, "id_rsa", uid=0, gid=0, mode=0o600)
+    files: list[tuple[str, str | list[str], dict[str, int]]] = [
+        ("id_rsa.pub", keys["public"], {"mode": 0o644}),
+        ("id_rsa", keys["private"], {"mode": 0o600}),
+    ]
     if keys["authorized_keys"]:
         print("Authorising public keys")
-        string_to_volume(
-            keys["authorized_keys"],
-            vol,
-            "authorized_keys",
-            uid=0,
-            gid=0,
-            mode=0o600,
-        )
+        files.append(("authorized_keys", keys["authorized_keys"], {}))
     if keys["known_hosts"]:
         print("Recognising servers")
-        string_to_volume(
-            keys["known_hosts"], vol, "known_hosts", uid=0, gid=0, mode=0o600
-        )
+        files.append(("known_hosts", keys["known_hosts"], {}))
     if keys["config"]:
         print("Adding ssh config")
-        string_to_volume(
-            keys["config"], vol, "config", uid=0, gid=0, mode=0o600
-        )
+        files.append(("config", keys["config"], {}))
     if schedule:
         print("Adding yacron schedule")
-        string_to_volume(schedule, vol, "yacron.yml", uid=0, gid=0)
-    string_to_volume(name, vol, "name", uid=0, gid=0)
+        files.append(("yacron.yml", schedule, {}))
+    files.append(("name", name, {}))
+    strings_to_volume(files, vol, uid=0, gid=0, mode=0o600)
 
 
 def write_identity(path: Path, name: str) -> None:
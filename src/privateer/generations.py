@@ -0,0 +1,77 @@
+# Support for keeping a history of backups on the server.  For a
+# volume with 'generations' enabled, the server holds
+#
+#   /privateer/volumes/<source>/<volume>/<timestamp>/
+#   /privateer/volumes/<source>/<volume>/latest -> <timestamp>
+#
+# where each timestamped directory is a complete copy of the volume,
+# with unchanged files hard-linked against the previous copy.
+import datetime as dt
+import re
+
+from privateer.config import Config, Retention
+
+LATEST = "latest"
+RE_GENERATION = re.compile("^[0-9]{8}-[0-9]{6}$")
+
+
+def has_generations(cfg: Config, volume: str) -> bool:
+    return cfg.volume_config(volume).generations
+
+
+def server_volume_path(
+    cfg: Config, source: str, volume: str, *, generation: str | None = None
+) -> str:
+    """Find the path to a volume's data on the server.
+
+    This is relative to the root of the server's data volume, and
+    points at the most recent copy of the data (or the copy from
+    `generation`, if given).
+    """
+    path = f"{source}/{volume}"
+    if has_generations(cfg, volume):
+        return f"{path}/{generation or LATEST}"
+    if generation is not None:
+        msg = f"Volume '{volume}' does not keep generations"
+        raise Exception(msg)
+    return path
+
+
+def is_generation(name: str) -> bool:
+    return bool(RE_GENERATION.match(name))
+
+
+def expired_generations(names: list[str], retention: Retention) -> list[str]:
+    """Find generations that a retention policy no longer keeps.
+
+    Args:
+        names: Names of directories holding generations; anything
+            that is not a generation timestamp is ignored.
+
+        retention: The retention policy.
+
+    Return:
+        The names of expired generations, oldest first.
+    """
+    found = sorted((x for x in names if is_generation(x)), reverse=True)
+    keep = set(found[: max(retention.keep_last, 1)])
+    buckets = [
+        (retention.daily, lambda t: t.date()),
+        (retention.weekly, lambda t: t.isocalendar()[:2]),
+        (retention.monthly, lambda t: (t.year, t.month)),
+    ]
+    for n, bucket in buckets:
+        seen = set()
+        for x in found:
+            if len(seen) >= n:
+                break
+            key = bucket(_generation_time(x))
+            if key not in seen:
+                seen.add(key)
+                keep.add(x)
+    return sorted(x for x in found if x not in keep)
+
+
+def _generation_time(name: str) -> dt.datetime:
+    # Generations are named by UTC time of creation
+    return dt.datetime.strptime(f"{name}+0000", "%Y%m%d-%H%M%S%z")
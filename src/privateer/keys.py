@@ -1,6 +1,8 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import hvac
 from cryptography.hazmat.primitives import serialization as crypto_serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
 
 from privateer.config import Config
 
@@ -8,8 +10,8 @@ from privateer.config import Config
 def keygen(cfg: Config, name: str) -> None:
     """Generate a key and store it in the vault.
 
-    The generated key is in rsa format.  Any previous key will be
-    silently overwritten.
+    The type of key is set by `key_type` in the configuration.  Any
+    previous key will be silently overwritten.
 
     Args:
 
@@ -18,23 +20,38 @@ def keygen(cfg: Config, name: str) -> None:
         name: The name of the machine to generate keys for.
 
     """
-    _keygen(cfg, name, cfg.vault.client())
+    _write_keypair(cfg, name, _create_keypair(cfg.key_type), cfg.vault.client())
 
 
-def keygen_all(cfg: Config) -> None:
+def keygen_all(cfg: Config, *, jobs: int = 8) -> None:
     """Generate keys for all machines.
 
-    The generated keys are in rsa format.  Any previous keys will be
-    silently overwritten.
+    The type of key is set by `key_type` in the configuration.  Any
+    previous keys will be silently overwritten.
+
+    RSA keys are slow to generate, so these are created in a pool of
+    processes; ed25519 keys are cheap enough that starting processes
+    would cost more than it saves.  The keys are then written to the
+    vault concurrently, sharing the vault client's connection pool.
 
     Args:
 
         cfg: The privateer configuration.
 
+        jobs: The maximum number of keys to generate, and of writes to
+            the vault, at once.
+
     """
+    names = cfg.list_servers() + cfg.list_clients()
+    keys = _create_keypairs(cfg.key_type, len(names), jobs)
     vault = cfg.vault.client()
-    for name in cfg.list_servers() + cfg.list_clients():
-        _keygen(cfg, name, vault)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [
+            pool.submit(_write_keypair, cfg, name, data, vault)
+            for name, data in zip(names, keys, strict=True)
+        ]
+        for f in futures:
+            f.result()
 
 
 # TODO: this should be renmaed to be more verby
@@ -79,8 +96,9 @@ def keys_data(cfg: Config, name: str) -> dict[str, str]:
     return ret
 
 
-def _keygen(cfg: Config, name: str, vault: hvac.Client):
-    data = _create_keypair()
+def _write_keypair(
+    cfg: Config, name: str, data: dict[str, str], vault: hvac.Client
+) -> None:
     path = f"{cfg.vault.prefix}/{name}"
     # TODO: The docs are here:
     # https://hvac.readthedocs.io/en/stable/usage/secrets_engines/kv_v1.html
@@ -89,21 +107,41 @@ def _keygen(cfg: Config, name: str, vault: hvac.Client):
     _r = vault.secrets.kv.v1.create_or_update_secret(path, secret=data)
 
 
+# Each key is a separate secret, so read them all at once rather than
+# waiting on a round-trip to the vault for each machine in turn.
 def _get_pubkeys(
-    vault: hvac.Client, prefix: str, nms: list[str]
+    vault: hvac.Client, prefix: str, nms: list[str], *, jobs: int = 8
 ) -> dict[str, str]:
-    return {
-        nm: vault.secrets.kv.v1.read_secret(f"{prefix}/{nm}")["data"]["public"]
-        for nm in nms
-    }
+    def _read(nm: str) -> str:
+        path = f"{prefix}/{nm}"
+        return vault.secrets.kv.v1.read_secret(path)["data"]["public"]
+
+    if len(nms) <= 1:
+        return {nm: _read(nm) for nm in nms}
+    with ThreadPoolExecutor(max_workers=min(jobs, len(nms))) as pool:
+        return dict(zip(nms, pool.map(_read, nms), strict=True))
+
+
+def _create_keypairs(key_type: str, n: int, jobs: int) -> list[dict[str, str]]:
+    if key_type == "rsa" and n > 1 and jobs > 1:
+        with ProcessPoolExecutor(max_workers=min(jobs, n)) as pool:
+            return list(pool.map(_create_keypair, [key_type] * n))
+    return [_create_keypair(key_type) for _ in range(n)]
 
 
-def _create_keypair() -> dict[str, str]:
-    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+def _create_keypair(key_type: str) -> dict[str, str]:
+    # OpenSSH cannot read ed25519 keys in PKCS8 format, so these use
+    # its own format; rsa keys stay as they always have been.
+    if key_type == "ed25519":
+        key = ed25519.Ed25519PrivateKey.generate()
+        private_format = crypto_serialization.PrivateFormat.OpenSSH
+    else:
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        private_format = crypto_serialization.PrivateFormat.PKCS8
 
     private = key.private_bytes(
         crypto_serialization.Encoding.PEM,
-        crypto_serialization.PrivateFormat.PKCS8,
+        private_format,
         crypto_serialization.NoEncryption(),
     ).decode("UTF-8")
 
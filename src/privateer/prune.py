@@ -0,0 +1,138 @@
+import shlex
+
+from docker.models.containers import Container
+from pydantic import BaseModel
+
+from privateer.check import check_server
+from privateer.config import Config
+from privateer.generations import expired_generations, is_generation
+from privateer.util import container_if_exists, format_bytes
+
+
+class PruneResult(BaseModel):
+    """The result of pruning generations of one volume.
+
+    Attributes:
+        source: The client that backed up the volume.
+
+        volume: The name of the volume.
+
+        removed: The generations that were removed.
+
+        freed: The disk space freed, in bytes.  Because unchanged
+            files are shared between generations, this counts only
+            the files that no remaining generation links to, so is
+            often much less than the apparent size of the removed
+            generations.
+    """
+
+    source: str
+    volume: str
+    removed: list[str]
+    freed: int
+
+
+def prune(
+    cfg: Config, name: str, *, jobs: int = 4, dry_run: bool = False
+) -> list[PruneResult]:
+    """Remove expired backup generations from the server.
+
+    For every volume with a `retention` policy, remove the generations
+    that the policy no longer keeps.  This runs within the (running)
+    server container.  Each generation is a tree of hard links, so
+    removing one file at a time is slow; instead we remove the
+    top-level entries of all expired generations with up to `jobs`
+    concurrent deletes.
+
+    Args:
+        cfg: The configuration
+
+        name: Name of the server to prune
+
+        jobs: The number of concurrent deletes to run.
+
+        dry_run: Don't remove anything, but print the generations
+            that would be removed.
+
+    Return:
+        A list of results, one per volume and source with expired
+        generations.
+    """
+    machine = check_server(cfg, name, quiet=True)
+    container = container_if_exists(machine.container)
+    if not container or container.status != "running":
+        msg = (
+            f"Server '{name}' is not running (container "
+            f"'{machine.container}'); start it with 'privateer server start'"
+        )
+        raise Exception(msg)
+    results = []
+    for v in cfg.volumes:
+        if not v.retention:
+            continue
+        sources = [cl.name for cl in cfg.clients if v.name in cl.backup]
+        for source in sources:
+            desc = f"'{v.name}' from '{source}'"
+            path = f"/privateer/volumes/{source}/{v.name}"
+            exit_code, output = container.exec_run(["ls", "-1", path])
+            if exit_code != 0:
+                continue
+            found = output.decode("utf-8").split()
+            expired = expired_generations(found, v.retention)
+            if not expired:
+                print(f"Nothing to prune for {desc}")
+                continue
+            if dry_run:
+                print(f"Would prune generations of {desc}:")
+                for x in expired:
+                    print(f"  {x}")
+                continue
+            print(f"Pruning {len(expired)} generations of {desc}")
+            kept = [x for x in found if is_generation(x) and x not in expired]
+            freed = _expired_size(container, path, kept, expired)
+            _remove_generations(container, path, expired, jobs)
+            print(f"Freed {format_bytes(freed)}")
+            results.append(
+                PruneResult(
+                    source=source, volume=v.name, removed=expired, freed=freed
+                )
+            )
+    return results
+
+
+def _remove_generations(
+    container: Container, path: str, expired: list[str], jobs: int
+) -> None:
+    dirs = shlex.join(expired)
+    script = (
+        f"find {dirs} -mindepth 1 -maxdepth 1 -print0 | "
+        f"xargs -0 -r -n 1 -P {jobs} rm -rf && rm -rf {dirs}"
+    )
+    exit_code, output = container.exec_run(["sh", "-c", script], workdir=path)
+    if exit_code != 0:
+        msg = f"Failed to prune '{path}': {output.decode('utf-8').strip()}"
+        raise Exception(msg)
+
+
+# When given several directories, du counts each hard-linked file only
+# once, against the first directory in which it is found.  So listing
+# the generations we keep first, the sizes reported for the expired
+# ones are of the files that only they hold, which is the space that
+# removing them will free.  Unlike comparing the filesystem's usage
+# before and after, this is not affected by anything else writing to
+# the disk meanwhile.
+def _expired_size(
+    container: Container, path: str, kept: list[str], expired: list[str]
+) -> int:
+    exit_code, output = container.exec_run(
+        ["du", "-sk", "--", *kept, *expired], workdir=path
+    )
+    if exit_code != 0:
+        msg = f"Failed to read disk usage of '{path}'"
+        raise Exception(msg)
+    size = 0
+    for line in output.decode("utf-8").strip().split("\n"):
+        kb, name = line.split("\t", 1)
+        if name in expired:
+            size += int(kb) * 1024
+    return size
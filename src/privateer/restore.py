@@ -1,9 +1,22 @@
+from pathlib import Path
+
 import docker
 
 from privateer.check import check
 from privateer.config import Config
+from privateer.generations import LATEST, is_generation, server_volume_path
 from privateer.root import find_source
-from privateer.util import match_value, mounts_str, run_container_with_command
+from privateer.rsync import (
+    RSYNC_REPORTING,
+    RsyncMonitor,
+    TransferStats,
+)
+from privateer.util import (
+    log_file_path,
+    match_value,
+    mounts_str,
+    run_container_with_command,
+)
 
 
 def restore(
@@ -14,9 +27,18 @@ def restore(
     to_volume: str | None = None,
     server: str | None = None,
     source: str | None = None,
+    generation: str | None = None,
+    log_dir: str | Path | None = None,
+    verify: bool = True,
     dry_run: bool = False,
-) -> None:
-    machine = check(cfg, name, quiet=True)
+) -> TransferStats | None:
+    if generation not in (None, LATEST) and not is_generation(generation):
+        msg = (
+            f"Invalid generation '{generation}': expected '{LATEST}' "
+            "or a timestamp like '20240101-120000'"
+        )
+        raise Exception(msg)
+    machine = check(cfg, name, quiet=True, verify=verify)
     server = match_value(server, cfg.list_servers(), "server")
     volume = match_value(volume, cfg.list_volumes(), "volume")
     to_volume = to_volume or volume
@@ -32,11 +54,24 @@ def restore(
         ),
     ]
     if source:
-        src = f"{server}:/privateer/volumes/{source}/{volume}/"
+        path = server_volume_path(cfg, source, volume, generation=generation)
+        src = f"{server}:/privateer/volumes/{path}/"
     else:
+        if generation is not None:
+            msg = f"'{volume}' is a local volume, so has no generations"
+            raise Exception(msg)
         src = f"{server}:/privateer/local/{volume}/"
         source = "(source)"  # just for printing now
-    command = ["rsync", "-av", "--delete", src, f"{dest_mount}/"]
+    transfer = cfg.volume_config(volume).transfer
+    command = [
+        "rsync",
+        "-av",
+        "--delete",
+        *RSYNC_REPORTING,
+        *(transfer.rsync_args() if transfer else []),
+        src,
+        f"{dest_mount}/",
+    ]
     if dry_run:
         cmd = ["docker", "run", "--rm", *mounts_str(mounts), image, *command]
         print("Command to manually run restore:")
@@ -52,9 +87,23 @@ def restore(
         print("Note that this uses hostname/port information for the server")
         print("contained within (config), along with our identity (id_rsa)")
         print("in the directory /privateer/keys")
-    else:
-        print(f"Restoring '{volume}' from '{server}' to '{to_volume}'")
-        print(f"Data originally from '{source}'")
+        return None
+    print(f"Restoring '{volume}' from '{server}' to '{to_volume}'")
+    print(f"Data originally from '{source}'")
+    log_file = log_file_path(log_dir, "restore", name, volume, server)
+    monitor = RsyncMonitor()
+    try:
         run_container_with_command(
-            "Restore", image, command=command, mounts=mounts
+            "Restore",
+            image,
+            command=command,
+            mounts=mounts,
+            follow=monitor,
+            log_file=log_file,
         )
+    finally:
+        monitor.finish()
+    stats = monitor.stats()
+    if stats:
+        print(f"Restore of '{volume}': {stats}")
+    return stats
@@ -43,14 +43,10 @@ def privateer_root(path: Path | None) -> Root:
 # this could be put elsewhere; we find the plausible sources (original
 # clients) that backed up a source to any server.
 def find_source(cfg: Config, volume: str, source: str | None) -> str | None:
-    if volume not in cfg.list_volumes():
-        msg = f"Unknown volume '{volume}'"
-        raise Exception(msg)
-    for v in cfg.volumes:
-        if v.name == volume and v.local:
-            if source is not None:
-                msg = f"'{volume}' is a local source, so 'source' must be empty"
-                raise Exception(msg)
-            return None
+    if cfg.volume_config(volume).local:
+        if source is not None:
+            msg = f"'{volume}' is a local source, so 'source' must be empty"
+            raise Exception(msg)
+        return None
     pos = [cl.name for cl in cfg.clients if volume in cl.backup]
     return match_value(source, pos, "source")
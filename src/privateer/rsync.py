@@ -0,0 +1,212 @@
+import re
+import sys
+import time
+
+from pydantic import BaseModel
+
+from privateer.util import format_bytes
+
+# Extra arguments for every rsync that we run, so that we can report
+# progress while it runs and summarise the transfer once it is done.
+# Where nothing follows the output as it runs (e.g., scheduled
+# backups) only the summary is wanted.
+RSYNC_STATS = ["--stats"]
+RSYNC_REPORTING = [*RSYNC_STATS, "--info=progress2"]
+
+# For example:
+#   "  1,234,567  45%   12.34MB/s    0:01:23 (xfr#12, to-chk=34/100)"
+RE_PROGRESS = re.compile(
+    r"^\s*([\d,]+)\s+(\d+)%\s+([\d.]+\S*/s)\s+(\d+:\d{2}:\d{2})"
+)
+
+RE_STATS = {
+    "files_transferred": re.compile(
+        r"^Number of regular files transferred: ([\d,]+)"
+    ),
+    "total_size": re.compile(r"^Total file size: ([\d,]+) bytes"),
+    "transferred_size": re.compile(
+        r"^Total transferred file size: ([\d,]+) bytes"
+    ),
+    "bytes_sent": re.compile(r"^Total bytes sent: ([\d,]+)"),
+    "bytes_received": re.compile(r"^Total bytes received: ([\d,]+)"),
+}
+
+
+class TransferProgress(BaseModel):
+    """Progress of a running rsync.
+
+    Attributes:
+        transferred: The number of bytes transferred so far.
+
+        percent: The percentage complete.
+
+        rate: The current transfer rate, as reported by rsync.
+
+        eta: The estimated time remaining, as reported by rsync.
+    """
+
+    transferred: int
+    percent: int
+    rate: str
+    eta: str
+
+    def __str__(self) -> str:
+        return (
+            f"{format_bytes(self.transferred)} ({self.percent}%), "
+            f"{self.rate}, ETA {self.eta}"
+        )
+
+
+class TransferStats(BaseModel):
+    """Summary statistics of a completed transfer.
+
+    If several rsync processes ran (e.g., for a volume with `parallel`
+    set) these are the totals over all of them.
+
+    Attributes:
+        files_transferred: The number of regular files transferred.
+
+        total_size: The total size of all files, in bytes.
+
+        transferred_size: The total size of the files that were
+            transferred, in bytes.
+
+        bytes_sent: The number of bytes sent over the connection.
+
+        bytes_received: The number of bytes received over the
+            connection.
+
+        speedup: The ratio of `total_size` to the bytes actually sent
+            and received; a measure of how much rsync saved over
+            copying everything.
+    """
+
+    files_transferred: int = 0
+    total_size: int = 0
+    transferred_size: int = 0
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    speedup: float = 0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.files_transferred} files transferred, "
+            f"{format_bytes(self.bytes_sent)} sent, "
+            f"{format_bytes(self.bytes_received)} received "
+            f"(speedup {self.speedup:.2f})"
+        )
+
+
+def parse_progress(line: str) -> TransferProgress | None:
+    """Parse a line of rsync's `--info=progress2` output.
+
+    Args:
+        line: A line of output.
+
+    Return:
+        The progress, or `None` if this is not a progress line.
+    """
+    m = RE_PROGRESS.match(line)
+    if not m:
+        return None
+    return TransferProgress(
+        transferred=_parse_int(m.group(1)),
+        percent=int(m.group(2)),
+        rate=m.group(3),
+        eta=m.group(4),
+    )
+
+
+def parse_stats(logs: str) -> TransferStats | None:
+    """Parse rsync's `--stats` output.
+
+    Args:
+        logs: Output from one or more rsync processes.
+
+    Return:
+        Totals over all `--stats` blocks found, or `None` if there
+        were none.
+    """
+    monitor = RsyncMonitor(quiet=True)
+    for line in re.split(r"[\r\n]+", logs):
+        monitor(line)
+    return monitor.stats()
+
+
+class RsyncMonitor:
+    """Follow the output of rsync as it runs.
+
+    Pass an instance as the `follow` argument to
+    `run_container_with_command`.  This prints a live progress line:
+    on a terminal the line is updated in place, otherwise a line is
+    printed at most every `interval` seconds so that logs stay
+    readable.  Pass `live=False` to print periodically on a terminal
+    too, which is needed when several transfers share a terminal, and
+    a `label` so their lines can be told apart.  It also totals up any
+    `--stats` output as it goes, so that the full log never needs to
+    be kept.  Call `finish()` once the command has completed.
+    """
+
+    def __init__(
+        self,
+        *,
+        label: str | None = None,
+        live: bool = True,
+        interval: float = 30,
+        quiet: bool = False,
+    ):
+        self._prefix = f"  [{label}] " if label else "  "
+        self._interval = interval
+        self._quiet = quiet
+        self._tty = live and sys.stdout.isatty()
+        self._last: float | None = None
+        self._dirty = False
+        self._totals = dict.fromkeys(RE_STATS, 0)
+        self._found = False
+
+    def __call__(self, line: str) -> None:
+        progress = parse_progress(line)
+        if progress is None:
+            self._add_stats(line)
+        elif not self._quiet:
+            self._print_progress(progress)
+
+    def finish(self) -> None:
+        if self._dirty:
+            print()
+            self._dirty = False
+
+    def stats(self) -> TransferStats | None:
+        """Summarise the transfer.
+
+        Return:
+            Totals over all `--stats` blocks seen, or `None` if there
+            were none.
+        """
+        if not self._found:
+            return None
+        totals = self._totals
+        wire = totals["bytes_sent"] + totals["bytes_received"]
+        speedup = totals["total_size"] / wire if wire else 0
+        return TransferStats(**totals, speedup=speedup)
+
+    def _add_stats(self, line: str) -> None:
+        for key, pattern in RE_STATS.items():
+            m = pattern.match(line)
+            if m:
+                self._totals[key] += _parse_int(m.group(1))
+                self._found = True
+
+    def _print_progress(self, progress: TransferProgress) -> None:
+        if self._tty:
+            print(f"\r{self._prefix}{progress}\033[K", end="", flush=True)
+            self._dirty = True
+        else:
+            now = time.monotonic()
+            if self._last is None or now - self._last >= self._interval:
+                print(f"{self._prefix}{progress}", flush=True)
+                self._last = now
+
+
+def _parse_int(x: str) -> int:
+    return int(x.replace(",", ""))
@@ -6,8 +6,10 @@ from privateer.service import service_start, service_status, service_stop
 from privateer.util import unique
 
 
-def schedule_start(cfg: Config, name: str, *, dry_run: bool = False) -> None:
-    machine = check_client(cfg, name, quiet=True)
+def schedule_start(
+    cfg: Config, name: str, *, verify: bool = True, dry_run: bool = False
+) -> None:
+    machine = check_client(cfg, name, quiet=True, verify=verify)
     if not machine.schedule:
         msg = f"A schedule is not defined in the configuration for '{name}'"
         raise Exception(msg)
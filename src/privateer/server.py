@@ -5,7 +5,9 @@ from privateer.config import Config
 from privateer.service import service_start, service_status, service_stop
 
 
-def server_start(cfg: Config, name: str, *, dry_run: bool = False) -> None:
+def server_start(
+    cfg: Config, name: str, *, verify: bool = True, dry_run: bool = False
+) -> None:
     """Start the privateer server.
 
     Args:
@@ -13,11 +15,14 @@ def server_start(cfg: Config, name: str, *, dry_run: bool = False) -> None:
 
         name: Name of the server to start
 
+        verify: Check that the key volume holds this server's
+            identity (see [privateer.check.check][]).
+
         dry_run: Don't actually start the server, but instead print
             the shell command that *would* start the server
 
     """
-    machine = check_server(cfg, name, quiet=True)
+    machine = check_server(cfg, name, quiet=True, verify=verify)
 
     mounts = [
         docker.types.Mount(
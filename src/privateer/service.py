@@ -1,5 +1,6 @@
 import docker
 
+from privateer.session import docker_client
 from privateer.util import (
     container_exists,
     container_if_exists,
@@ -59,7 +60,7 @@ def service_start(
 
     ensure_image(image)
     print(f"Starting server '{name}' as container '{container_name}'")
-    client = docker.from_env()
+    client = docker_client()
     client.containers.run(
         image,
         auto_remove=True,
@@ -0,0 +1,172 @@
+import re
+import threading
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, NamedTuple
+from urllib.parse import urlparse
+
+if TYPE_CHECKING:
+    import docker
+    from docker.models.containers import Container
+    from docker.models.volumes import Volume
+
+
+class DockerCall(NamedTuple):
+    """A single request made to the docker daemon.
+
+    Attributes:
+        method: The HTTP method, e.g., `GET`.
+
+        path: The API path, without version prefix or query.
+
+        elapsed: Time taken until the response arrived, in seconds.
+    """
+
+    method: str
+    path: str
+    elapsed: float
+
+
+class DockerSession:
+    """A connection to docker, shared for the length of a command.
+
+    This holds a single docker client, and remembers which images are
+    present and which volumes exist, so that a command that checks
+    the same thing several times only asks the daemon once.  The
+    first volume lookup lists all volumes in one request; volumes that
+    appear missing are confirmed with the daemon before we report
+    them missing, because running a container with a volume mount
+    creates that volume behind our back.  Containers are never cached
+    as their state changes too quickly.
+
+    Every request made through the client is recorded in `calls`, so
+    that `summary()` can show where the time in a command went.
+
+    Nothing is imported from docker until the client is first used,
+    so that commands that never talk to docker (e.g., `keygen` or
+    `--help`) can create a session for free.
+    """
+
+    def __init__(self):
+        self._client: docker.DockerClient | None = None
+        self._images: set[str] = set()
+        self._volumes: set[str] | None = None
+        self._lock = threading.Lock()
+        self.calls: list[DockerCall] = []
+
+    @property
+    def client(self) -> "docker.DockerClient":
+        with self._lock:
+            if self._client is None:
+                import docker  # noqa: PLC0415
+
+                self._client = docker.from_env()
+                self._client.api.hooks["response"].append(self._record)
+            return self._client
+
+    def ensure_image(self, name: str) -> None:
+        if name in self._images:
+            return
+        from docker.errors import ImageNotFound  # noqa: PLC0415
+
+        try:
+            self.client.images.get(name)
+        except ImageNotFound:
+            print(f"Pulling {name}")
+            self.client.images.pull(name)
+        self._images.add(name)
+
+    def container_if_exists(self, name: str) -> "Container | None":
+        from docker.errors import NotFound  # noqa: PLC0415
+
+        try:
+            return self.client.containers.get(name)
+        except NotFound:
+            return None
+
+    def volume_exists(self, name: str) -> bool:
+        if name in self._known_volumes():
+            return True
+        return self.volume_if_exists(name) is not None
+
+    def volume_if_exists(self, name: str) -> "Volume | None":
+        from docker.errors import NotFound  # noqa: PLC0415
+
+        try:
+            volume = self.client.volumes.get(name)
+        except NotFound:
+            return None
+        self._remember_volume(name)
+        return volume
+
+    def create_volume(self, name: str) -> "Volume":
+        volume = self.client.volumes.create(name)
+        self._remember_volume(name)
+        return volume
+
+    def summary(self) -> list[str]:
+        """Summarise the requests made to docker.
+
+        Return:
+            One line per distinct request, with the number of times it
+            was made and the total time taken, slowest first.
+        """
+        totals: dict[str, list[float]] = {}
+        for call in self.calls:
+            key = f"{call.method} {call.path}"
+            totals.setdefault(key, []).append(call.elapsed)
+        ret = [f"{len(self.calls)} docker requests"]
+        for key, times in sorted(totals.items(), key=lambda x: -sum(x[1])):
+            ret.append(f"  {sum(times):8.3f}s {len(times):4d} x {key}")
+        return ret
+
+    def close(self) -> None:
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    def _known_volumes(self) -> set[str]:
+        if self._volumes is None:
+            found = {v.name for v in self.client.volumes.list()}
+            with self._lock:
+                if self._volumes is None:
+                    self._volumes = found
+        return self._volumes
+
+    def _remember_volume(self, name: str) -> None:
+        if self._volumes is not None:
+            self._volumes.add(name)
+
+    def _record(self, response, *args, **kwargs) -> None:  # noqa: ARG002
+        request = response.request
+        path = re.sub(r"^/v[\d.]+", "", urlparse(request.url).path)
+        elapsed = response.elapsed.total_seconds()
+        self.calls.append(DockerCall(request.method, path, elapsed))
+
+
+_SESSIONS: list[DockerSession] = []
+
+
+@contextmanager
+def docker_session() -> Iterator[DockerSession]:
+    """Share one docker session for everything run within the block.
+
+    The CLI wraps each command in this.  Outside of such a block each
+    call to `current_session()` gets a fresh session, so nothing is
+    cached between calls.
+    """
+    session = DockerSession()
+    _SESSIONS.append(session)
+    try:
+        yield session
+    finally:
+        _SESSIONS.remove(session)
+        session.close()
+
+
+def current_session() -> DockerSession:
+    return _SESSIONS[-1] if _SESSIONS else DockerSession()
+
+
+def docker_client() -> "docker.DockerClient":
+    return current_session().client
@@ -0,0 +1,257 @@
+# Exports split into fixed-size chunks.  The tar stream is cut into
+# pieces of 'chunk_size' bytes, each of which is written (and
+# compressed) as a separate file, so that a chunk can be moved or
+# checked on its own and a failed copy only needs the affected chunks
+# sending again.  A manifest records the size and hash of each chunk,
+# along with an index of which chunk each file in the archive starts
+# in.  Concatenating the decompressed chunks gives back the tar file.
+import hashlib
+import os
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack
+from pathlib import Path
+from typing import IO
+
+from pydantic import BaseModel
+
+from privateer.compress import compressed_writer, decompressed_chunks
+
+MANIFEST = "manifest.json"
+CHECKSUMS = "SHA256SUMS"
+
+_EXTENSIONS = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+
+class ChunkInfo(BaseModel):
+    """A single chunk of a split export.
+
+    Attributes:
+        file: The name of the chunk's file, within the export directory.
+
+        size: The size of the chunk's file, in bytes.
+
+        raw_size: The size of the chunk before compression, in bytes.
+
+        sha256: The sha256 checksum of the chunk's file.
+    """
+
+    file: str
+    size: int
+    raw_size: int
+    sha256: str
+
+
+class FileInfo(BaseModel):
+    """The location of a file within a split export.
+
+    Attributes:
+        name: The name of the file, as listed by tar.
+
+        offset: The offset of the file's header within the tar stream.
+
+        chunk: The index of the chunk containing the file's header.
+    """
+
+    name: str
+    offset: int
+    chunk: int
+
+
+class SplitManifest(BaseModel):
+    """Describe a split export.
+
+    Attributes:
+        compress: The compression method used for each chunk, if any.
+
+        chunk_size: The size of each chunk (except perhaps the last)
+            before compression, in bytes.
+
+        chunks: The chunks, in order.
+
+        files: An index of the files in the archive.
+    """
+
+    compress: str | None
+    chunk_size: int
+    chunks: list[ChunkInfo] = []
+    files: list[FileInfo] = []
+
+
+class SplitWriter:
+    """Write a stream as a directory of chunks, with a manifest.
+
+    Each chunk is compressed as it is written (using several threads,
+    see `compress.compressed_writer()`) and its checksum is computed
+    from the compressed bytes on their way to disk, so no chunk is
+    ever read back.  The manifest, and a `SHA256SUMS` file that can be
+    checked with `sha256sum -c`, are written on `close()`.
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        *,
+        chunk_size: int,
+        compress: str | None = None,
+        threads: int | None = None,
+    ):
+        self.path = Path(path)
+        self.manifest = SplitManifest(compress=compress, chunk_size=chunk_size)
+        self._threads = threads
+        self._chunk: ExitStack | None = None
+        self._writer = None
+        self._hashing: _HashingFile | None = None
+        self._remaining = 0
+        self.path.mkdir(parents=True)
+
+    def write(self, data: bytes) -> int:
+        view = memoryview(data)
+        while view:
+            if self._remaining == 0:
+                self._start_chunk()
+            n = min(len(view), self._remaining)
+            self._writer.write(view[:n])
+            self._remaining -= n
+            view = view[n:]
+        return len(data)
+
+    def add_file(self, name: str, offset: int) -> None:
+        chunk = offset // self.manifest.chunk_size
+        self.manifest.files.append(
+            FileInfo(name=name, offset=offset, chunk=chunk)
+        )
+
+    def close(self) -> None:
+        self._finish_chunk()
+        with (self.path / MANIFEST).open("w") as f:
+            f.write(self.manifest.model_dump_json(indent=2))
+        with (self.path / CHECKSUMS).open("w") as f:
+            for chunk in self.manifest.chunks:
+                f.write(f"{chunk.sha256}  {chunk.file}\n")
+
+    def _start_chunk(self) -> None:
+        self._finish_chunk()
+        i = len(self.manifest.chunks)
+        name = f"chunk-{i:05d}{chunk_extension(self.manifest.compress)}"
+        self._chunk = ExitStack()
+        f = self._chunk.enter_context((self.path / name).open("wb"))
+        self._hashing = _HashingFile(f)
+        self._writer = self._chunk.enter_context(
+            compressed_writer(
+                self._hashing, self.manifest.compress, threads=self._threads
+            )
+        )
+        self._remaining = self.manifest.chunk_size
+        info = ChunkInfo(file=name, size=0, raw_size=0, sha256="")
+        self.manifest.chunks.append(info)
+
+    def _finish_chunk(self) -> None:
+        if self._chunk is None:
+            return
+        self._chunk.close()
+        info = self.manifest.chunks[-1]
+        info.size = self._hashing.size
+        info.raw_size = self.manifest.chunk_size - self._remaining
+        info.sha256 = self._hashing.hash.hexdigest()
+        self._chunk = None
+        self._remaining = 0
+
+
+def chunk_extension(method: str | None) -> str:
+    return _EXTENSIONS[method]
+
+
+def read_manifest(path: str | Path) -> SplitManifest:
+    """Read the manifest of a split export.
+
+    Args:
+        path: The export directory
+
+    Return:
+        The manifest.
+    """
+    path = Path(path)
+    if not (path / MANIFEST).exists():
+        msg = f"'{path}' is not a split export (no '{MANIFEST}' found)"
+        raise Exception(msg)
+    with (path / MANIFEST).open() as f:
+        return SplitManifest.model_validate_json(f.read())
+
+
+def split_chunks(
+    path: str | Path, *, threads: int | None = None
+) -> Iterator[bytes]:
+    """Read a split export back as a single tar stream.
+
+    Chunks are checked against the manifest ahead of being read, on a
+    pool of `threads` threads, so that checking the next few chunks
+    overlaps with decompressing and extracting the current one.  A
+    chunk is only ever returned after its checksum has been verified.
+    We check that all the chunks are present before returning.
+
+    Args:
+        path: The export directory
+
+        threads: The number of chunks to check at once; by default
+            the number of available cores
+
+    Return:
+        An iterator of chunks of decompressed data.
+    """
+    path = Path(path)
+    manifest = read_manifest(path)
+    missing = [x.file for x in manifest.chunks if not (path / x.file).exists()]
+    if missing:
+        missing_str = ", ".join(f"'{x}'" for x in missing)
+        msg = f"Missing chunks from '{path}': {missing_str}"
+        raise Exception(msg)
+    return _read_chunks(path, manifest, threads or os.cpu_count() or 1)
+
+
+def _read_chunks(
+    path: Path, manifest: SplitManifest, threads: int
+) -> Iterator[bytes]:
+    with ThreadPoolExecutor(threads) as pool:
+        pending: deque[tuple[ChunkInfo, Future[None]]] = deque()
+        todo = iter(manifest.chunks)
+        try:
+            while True:
+                while len(pending) < threads:
+                    chunk = next(todo, None)
+                    if chunk is None:
+                        break
+                    pending.append((chunk, pool.submit(_verify, path, chunk)))
+                if not pending:
+                    break
+                chunk, verified = pending.popleft()
+                verified.result()
+                yield from decompressed_chunks(
+                    path / chunk.file, manifest.compress
+                )
+        finally:
+            for _, verified in pending:
+                verified.cancel()
+
+
+def _verify(path: Path, chunk: ChunkInfo) -> None:
+    h = hashlib.sha256()
+    with (path / chunk.file).open("rb") as f:
+        while block := f.read(1024 * 1024):
+            h.update(block)
+    if h.hexdigest() != chunk.sha256:
+        msg = f"Chunk '{chunk.file}' is corrupt (checksum does not match)"
+        raise Exception(msg)
+
+
+class _HashingFile:
+    def __init__(self, f: IO[bytes]):
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self._f = f
+
+    def write(self, data: bytes) -> int:
+        self.hash.update(data)
+        self.size += len(data)
+        return self._f.write(data)
@@ -1,73 +1,337 @@
+import hashlib
 import os
+import re
+import shlex
+import shutil
 
 import docker
 
-from privateer.check import check
+from privateer.check import check, check_client
+from privateer.compress import (
+    check_compression,
+    decompressed_chunks,
+    detect_compression,
+    tar_extension,
+)
+from privateer.generations import has_generations, server_volume_path
 from privateer.root import find_source
+from privateer.session import current_session
+from privateer.split import (
+    CHECKSUMS,
+    SplitWriter,
+    chunk_extension,
+    read_manifest,
+    split_chunks,
+)
 from privateer.util import (
-    ensure_image,
+    bytes_from_container,
+    container_output,
+    format_bytes,
     isotimestamp,
+    match_value,
     mounts_str,
+    run_container_to_file,
     run_container_with_command,
+    run_container_with_input,
+    simple_tar,
     volume_exists,
 )
 
 
-def export_tar(cfg, name, volume, *, to_dir=None, source=None, dry_run=False):
-    machine = check(cfg, name, quiet=True)
+def export_tar(
+    cfg,
+    name,
+    volume,
+    *,
+    to_dir=None,
+    source=None,
+    compress=None,
+    threads=None,
+    split=None,
+    incremental=False,
+    verify=True,
+    dry_run=False,
+):
+    check_compression(compress)
+    machine = check(cfg, name, quiet=True, verify=verify)
     source = find_source(cfg, volume, source)
+    if incremental and has_generations(cfg, volume):
+        # Each backup is a new directory tree, with unchanged files
+        # hard-linked from the previous one; the new directories, and
+        # the files' changed link counts (so ctimes), make tar treat
+        # every file as changed, so each "incremental" would be full
+        msg = f"Can't export '{volume}' incrementally, as it keeps generations"
+        raise Exception(msg)
     if not source:
-        return export_tar_local(volume, to_dir=to_dir, dry_run=dry_run)
+        return export_tar_local(
+            volume,
+            to_dir=to_dir,
+            compress=compress,
+            threads=threads,
+            split=split,
+            incremental=incremental,
+            dry_run=dry_run,
+        )
 
     path = os.path.abspath(to_dir or "")
     mounts = [
-        docker.types.Mount("/export", path, type="bind"),
         docker.types.Mount(
             "/privateer", machine.data_volume, type="volume", read_only=True
         ),
     ]
-    tarfile = f"{source}-{volume}-{isotimestamp()}.tar"
-    src = f"/privateer/{source}/{volume}"
-    return _run_tar_create(mounts, src, path, tarfile, dry_run)
+    stem = f"{source}-{volume}"
+    snapshot = _snapshot_path(path, stem) if incremental else None
+    tarfile = _tarfile_name(stem, compress, snapshot)
+    src = f"/privateer/{server_volume_path(cfg, source, volume)}"
+    return _run_tar_create(
+        mounts,
+        src,
+        path,
+        tarfile,
+        dry_run,
+        compress=compress,
+        threads=threads,
+        split=split,
+        snapshot=snapshot,
+    )
 
 
-def export_tar_local(volume, *, to_dir=None, dry_run=False):
+def export_tar_local(
+    volume,
+    *,
+    to_dir=None,
+    compress=None,
+    threads=None,
+    split=None,
+    incremental=False,
+    dry_run=False,
+):
+    check_compression(compress)
     if not volume_exists(volume):
         msg = f"Volume '{volume}' does not exist"
         raise Exception(msg)
 
     path = os.path.abspath(to_dir or "")
     mounts = [
-        docker.types.Mount("/export", path, type="bind"),
         docker.types.Mount("/privateer", volume, type="volume", read_only=True),
     ]
-    tarfile = f"{volume}-{isotimestamp()}.tar"
+    snapshot = _snapshot_path(path, volume) if incremental else None
+    tarfile = _tarfile_name(volume, compress, snapshot)
     src = "/privateer"
-    return _run_tar_create(mounts, src, path, tarfile, dry_run)
+    return _run_tar_create(
+        mounts,
+        src,
+        path,
+        tarfile,
+        dry_run,
+        compress=compress,
+        threads=threads,
+        split=split,
+        snapshot=snapshot,
+    )
+
+
+def export_tar_remote(
+    cfg,
+    name,
+    volume,
+    *,
+    server=None,
+    to_dir=None,
+    source=None,
+    compress=None,
+    threads=None,
+    verify=True,
+    dry_run=False,
+):
+    """Export a volume from a server, onto a client.
+
+    Rather than mounting the server's data volume (which only works
+    on the server itself, see `export_tar()`), this runs `tar` on the
+    server over ssh, using the client's identity from its key volume,
+    and streams the archive straight into a local file.  Nothing is
+    written on the server.  The sha256 checksum of the file is
+    computed as it is written, and saved alongside it in a file that
+    can be checked with `sha256sum -c`.
+
+    Args:
+        cfg: The privateer configuration.
+
+        name: The name of the client machine.
+
+        volume: The name of the volume to export.
+
+        server: The name of the server to export from.  This can be
+            omitted if only one server is configured.
+
+        to_dir: The directory to write the export into; by default
+            the current directory.
+
+        source: The client that backed the volume up, as for
+            `restore`.
+
+        compress: Optionally, compress the tar file, with one of
+            `compress.COMPRESSION`.  With `gzip` the archive is
+            compressed by tar on the server, before it is sent; the
+            server has no `zstd`, so with `zstd` the archive is
+            compressed on this machine as it is written (and by ssh
+            while in transit, as it is when not compressed at all).
+
+        threads: The number of threads to compress with when
+            compressing with `zstd`; by default use all available
+            cores.
+
+        verify: Check that the key volume holds this client's
+            identity (see [privateer.check.check][]).
+
+        dry_run: Don't run anything, but print the commands that
+            would be needed to run the export.
+
+    Return:
+        The path to the tar file.
+    """
+    check_compression(compress)
+    machine = check_client(cfg, name, quiet=True, verify=verify)
+    server = match_value(server, cfg.list_servers(), "server")
+    volume = match_value(volume, cfg.list_volumes(), "volume")
+    source = find_source(cfg, volume, source)
+    if source:
+        src = f"/privateer/volumes/{server_volume_path(cfg, source, volume)}"
+        stem = f"{source}-{volume}"
+    else:
+        src = f"/privateer/local/{volume}"
+        stem = volume
+    image = f"mrcide/privateer-client:{cfg.tag}"
+    mounts = [
+        docker.types.Mount(
+            "/privateer/keys", machine.key_volume, type="volume", read_only=True
+        ),
+    ]
+    # The remote command is run by the server's shell, so is passed to
+    # ssh as a single (quoted) string.  Compressing on the server means
+    # less is sent over the network; otherwise ssh compresses it in
+    # transit, which is cheaper than sending the raw tar stream.
+    if compress == "gzip":
+        tar = shlex.join(["tar", "-czpf", "-", "-C", src, "."])
+        command = ["ssh", server, tar]
+        local = None
+    else:
+        tar = shlex.join(["tar", "-cpf", "-", "-C", src, "."])
+        command = ["ssh", "-C", server, tar]
+        local = compress
+    path = os.path.abspath(to_dir or "")
+    dest = os.path.join(path, _tarfile_name(stem, compress, None))
+    sums = f"{dest}.sha256"
+    if dry_run:
+        cmd = ["docker", "run", "--rm", *mounts_str(mounts), image, *command]
+        if local:
+            cmd = [shlex.join(cmd), _COMPRESS[local]]
+        else:
+            cmd = [shlex.join(cmd)]
+        print("Command to manually run export:")
+        print()
+        print(f"  {' | '.join(cmd)} > {dest}")
+        print(f"  (cd {path} && sha256sum {os.path.basename(dest)}) > {sums}")
+        print()
+        print(
+            f"This will export the volume '{volume}' from the server "
+            f"'{server}' to '{name}'"
+        )
+        print()
+        print("Note that this uses hostname/port information for the server")
+        print("contained within (config), along with our identity (id_rsa)")
+        print("in the directory /privateer/keys")
+        return dest
+
+    print(f"Exporting '{volume}' from '{server}' to '{dest}'")
+    h = hashlib.sha256()
+    size = run_container_to_file(
+        "Export",
+        image,
+        dest,
+        compress=local,
+        threads=threads,
+        checksum=h.update,
+        command=command,
+        mounts=mounts,
+    )
+    with open(sums, "w") as f:
+        f.write(f"{h.hexdigest()}  {os.path.basename(dest)}\n")
+    if local:
+        written = os.path.getsize(dest)
+        detail = f"{format_bytes(size)}, {format_bytes(written)} compressed"
+    elif compress:
+        detail = f"{format_bytes(size)} compressed on '{server}'"
+    else:
+        detail = format_bytes(size)
+    print(f"Tar file ready at '{dest}' ({detail})")
+    print(f"Checksum written to '{sums}'")
+    return dest
 
 
-def import_tar(volume, tarfile, *, dry_run=False):
+def import_tar(volume, tarfile, *, incremental=None, dry_run=False):
     if volume_exists(volume):
         msg = f"Volume '{volume}' already exists, please delete first"
         raise Exception(msg)
-    if not os.path.exists(tarfile):
-        msg = f"Input file '{tarfile}' does not exist"
-        raise Exception(msg)
+    archives = [tarfile, *(incremental or [])]
+    for path in archives:
+        if not os.path.exists(path):
+            msg = f"Input file '{path}' does not exist"
+            raise Exception(msg)
+    archives = [os.path.abspath(x) for x in archives]
 
+    if dry_run:
+        print("Command to manually run import:")
+        print()
+        print(f"  docker volume create {volume}")
+        for path in archives:
+            _import_archive(volume, path, chain=bool(incremental), dry_run=True)
+    else:
+        current_session().create_volume(volume)
+        for path in archives:
+            _import_archive(volume, path, chain=bool(incremental))
+        if incremental:
+            n = len(incremental)
+            print(f"Imported full archive and {n} incremental archive(s)")
+
+
+# Import a single archive into an existing volume.  When applying a
+# chain of incremental archives, tar needs '--listed-incremental' so
+# that it restores each directory's contents exactly as they were at
+# the time of that export, deleting files removed since the previous
+# one; the snapshot file is not read on extraction so '/dev/null'
+# will do.
+def _import_archive(volume, tarfile, *, chain=False, dry_run=False):
     # Use ubuntu (not alpine) because we will require the -p tag to
     # preserve permissions on tar
     image = "ubuntu"
-    tarfile = os.path.abspath(tarfile)
-    mounts = [
-        docker.types.Mount("/src.tar", tarfile, type="bind", read_only=True),
-        docker.types.Mount("/privateer", volume, type="volume"),
-    ]
+    split = os.path.isdir(tarfile)
+    if split:
+        compress = read_manifest(tarfile).compress
+    else:
+        compress = detect_compression(tarfile)
+    mounts = [docker.types.Mount("/privateer", volume, type="volume")]
     working_dir = "/privateer"
-    command = ["tar", "-xvpf", "/src.tar"]
+    incremental = ["--listed-incremental=/dev/null"] if chain else []
+    # Compressed or split archives are decompressed (and reassembled)
+    # on the host and streamed into tar, so no uncompressed copy of
+    # the whole archive is ever written
+    stream = split or compress is not None
+    if stream:
+        command = ["tar", "-xpf", "-", *incremental]
+    else:
+        mounts.insert(
+            0,
+            docker.types.Mount(
+                "/src.tar", tarfile, type="bind", read_only=True
+            ),
+        )
+        command = ["tar", "-xvpf", "/src.tar", *incremental]
     if dry_run:
         cmd = [
             "docker",
             "run",
+            *(["-i"] if stream else []),
             "--rm",
             *mounts_str(mounts),
             "-w",
@@ -75,12 +339,33 @@ def import_tar(volume, tarfile, *, dry_run=False):
             image,
             *command,
         ]
-        print("Command to manually run import:")
-        print()
-        print(f"  docker volume create {volume}")
-        print(f"  {' '.join(cmd)}")
+        if split:
+            print(f"  (cd {tarfile} && sha256sum -c {CHECKSUMS})")
+            read = [f"cat {tarfile}/chunk-*"]
+            if compress:
+                read.append(_DECOMPRESS[compress])
+            print(f"  {' | '.join([*read, ' '.join(cmd)])}")
+        elif compress:
+            print(f"  {_DECOMPRESS[compress]} {tarfile} | {' '.join(cmd)}")
+        else:
+            print(f"  {' '.join(cmd)}")
+    elif stream:
+        if split:
+            print(f"Importing split tar file from '{tarfile}'")
+            chunks = split_chunks(tarfile)
+        else:
+            print(f"Importing {compress}-compressed tar file '{tarfile}'")
+            chunks = decompressed_chunks(tarfile, compress)
+        run_container_with_input(
+            "Import",
+            image,
+            chunks,
+            command=command,
+            mounts=mounts,
+            working_dir=working_dir,
+        )
+        print("Import completed successfully")
     else:
-        docker.from_env().volumes.create(volume)
         run_container_with_command(
             "Import",
             image,
@@ -90,11 +375,95 @@ def import_tar(volume, tarfile, *, dry_run=False):
         )
 
 
-# This can be simplified by using 'docker cp' for the local version
-def _run_tar_create(mounts, src, path, tarfile, dry_run):
+# Commands to use in place of our own compression, when printing
+# instructions to run an export or import by hand
+_COMPRESS = {"gzip": "gzip", "zstd": "zstd -T0"}
+_DECOMPRESS = {"gzip": "gzip -dc", "zstd": "zstd -dc"}
+
+# Where tar reads and writes its snapshot file within the container
+# when creating an incremental archive
+_SNAPSHOT = "/tmp/privateer.snar"  # noqa: S108
+
+
+# GNU tar's snapshot ('.snar') file records the state of the volume at
+# the time of the last incremental export; we keep one per volume (and
+# source) alongside the exports themselves.  With no snapshot file,
+# tar writes a full archive and starts a new snapshot.
+def _snapshot_path(path, stem):
+    return os.path.join(path, f"{stem}.snar")
+
+
+def _tarfile_name(stem, compress, snapshot):
+    level = "-incremental" if snapshot and os.path.exists(snapshot) else ""
+    return f"{stem}-{isotimestamp()}{level}{tar_extension(compress)}"
+
+
+# The snapshot file is copied into the container before tar runs and
+# back out once it has succeeded, rather than bind-mounting the export
+# directory, so that the file stays owned by the calling user.  The
+# new snapshot only replaces the old one once the export is complete,
+# so a failed export leaves us able to retry from the same state.
+def _snapshot_hooks(snapshot):
+    result = {}
+
+    def before(container):
+        if os.path.exists(snapshot):
+            container.put_archive(
+                os.path.dirname(_SNAPSHOT),
+                simple_tar(snapshot, os.path.basename(_SNAPSHOT)),
+            )
+
+    def after(container):
+        result["snapshot"] = bytes_from_container(container, _SNAPSHOT)
+
+    return {"before": before, "after": after}, result
+
+
+def _save_snapshot(snapshot, data):
+    tmp = f"{snapshot}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, snapshot)
+
+
+# The archive is written to the container's stdout and streamed into
+# a file that we create, so it belongs to the calling user, compressing
+# it on the way if requested.  We don't use the docker API's
+# get_archive here, as that prefixes every entry with the name of the
+# directory archived, where we want entries relative to the volume
+# root (as 'import' expects).
+def _run_tar_create(
+    mounts,
+    src,
+    path,
+    tarfile,
+    dry_run,
+    *,
+    compress=None,
+    threads=None,
+    split=None,
+    snapshot=None,
+):
     image = "ubuntu"
-    command = ["tar", "-cpvf", f"/export/{tarfile}", "."]
+    options = []
+    if snapshot:
+        # Device numbers of docker volumes are not stable between
+        # containers, so must not be used to detect changed files
+        options = [f"--listed-incremental={_SNAPSHOT}", "--no-check-device"]
+    dest = os.path.join(path, tarfile)
+    if split:
+        dest = dest.removesuffix(tar_extension(compress))
     if dry_run:
+        if snapshot:
+            mounts = [
+                *mounts,
+                docker.types.Mount("/snapshot", path, type="bind"),
+            ]
+            name = os.path.basename(snapshot)
+            options = [
+                f"--listed-incremental=/snapshot/{name}",
+                "--no-check-device",
+            ]
         cmd = [
             "docker",
             "run",
@@ -103,59 +472,107 @@ def _run_tar_create(mounts, src, path, tarfile, dry_run):
             "-w",
             src,
             image,
-            *command,
+            "tar",
+            "-cpf",
+            "-",
+            *options,
+            ".",
         ]
         print("Command to manually run export:")
         print()
-        print(f"  {' '.join(cmd)}")
+        if split:
+            filter_str = ""
+            if compress:
+                ext = chunk_extension(compress)
+                filter_str = f" --filter='{_COMPRESS[compress]} > $FILE{ext}'"
+            cmd += [
+                "|",
+                f"split -b {split}M -d -a 5{filter_str} - {dest}/chunk-",
+            ]
+            print(f"  mkdir {dest}")
+            print(f"  {' '.join(cmd)}")
+        else:
+            if compress:
+                cmd += ["|", _COMPRESS[compress]]
+            print(f"  {' '.join(cmd)} > {dest}")
         print()
         print("(pay attention to the final '.' in the above command!)")
-        print()
-        print("Note that this file will have root ownership after creation")
-        print(f"You can fix that with 'sudo chown $(whoami) {tarfile}'")
-        print("or")
-        print()
-        cmd_own = take_ownership(tarfile, path, command_only=True)
-        print(f"  {' '.join(cmd_own)}")
-    else:
-        run_container_with_command(
-            "Export",
+        if split:
+            print("(this does not write a manifest, so cannot be imported)")
+        return dest
+
+    hooks, result = _snapshot_hooks(snapshot) if snapshot else ({}, {})
+    if split:
+        print(f"Writing tar file in chunks of {split} MiB to '{dest}'")
+        size, written = _run_tar_create_split(
+            dest,
+            split * 1024 * 1024,
             image,
-            command=command,
+            compress=compress,
+            threads=threads,
+            command=["tar", "-cpvRf", "-", *options, "."],
             mounts=mounts,
             working_dir=src,
+            **hooks,
         )
-        print("Taking ownership of file")
-        take_ownership(tarfile, path)
-        print(f"Tar file ready at '{path}/{tarfile}'")
-    return os.path.join(path, tarfile)
-
-
-# This ia hard to type because it either does something or produces
-# the list of commands to do it
-def take_ownership(filename, directory, *, command_only=False):  # tar
-    uid = os.geteuid()
-    gid = os.getegid()
-    mounts = [docker.types.Mount("/src", directory, type="bind")]
-    command = ["chown", f"{uid}.{gid}", filename]
-    if command_only:
-        return [
-            "docker",
-            "run",
-            "--rm",
-            *mounts_str(mounts),
-            "-w",
-            "/src",
-            "ubuntu",
-            *command,
-        ]
+        detail = format_bytes(size)
+        if compress:
+            detail += f", {format_bytes(written)} compressed"
+        print(f"Split tar file ready at '{dest}' ({detail})")
     else:
-        ensure_image("ubuntu")
-        cl = docker.from_env()
-        cl.containers.run(
-            "ubuntu",
+        print(f"Writing tar file to '{dest}'")
+        size = run_container_to_file(
+            "Export",
+            image,
+            dest,
+            compress=compress,
+            threads=threads,
+            command=["tar", "-cpf", "-", *options, "."],
             mounts=mounts,
-            working_dir="/src",
-            command=command,
-            remove=True,
+            working_dir=src,
+            **hooks,
         )
+        if compress:
+            written = os.path.getsize(dest)
+            detail = f"{format_bytes(size)}, {format_bytes(written)} compressed"
+        else:
+            detail = format_bytes(size)
+        print(f"Tar file ready at '{dest}' ({detail})")
+    if snapshot:
+        _save_snapshot(snapshot, result["snapshot"])
+        print(f"Updated snapshot '{snapshot}' for the next incremental export")
+    return dest
+
+
+# With '-vR', and the archive going to stdout, tar lists each file on
+# stderr along with the (512 byte) block at which its header starts,
+# which gives us the manifest's file index for free.
+def _run_tar_create_split(
+    dest, chunk_size, image, *, compress, threads, **kwargs
+):
+    if os.path.exists(dest):
+        msg = f"'{dest}' already exists"
+        raise Exception(msg)
+    writer = SplitWriter(
+        dest, chunk_size=chunk_size, compress=compress, threads=threads
+    )
+    size = 0
+    listing = b""
+    try:
+        for out, err in container_output("Export", image, **kwargs):
+            if out:
+                writer.write(out)
+                size += len(out)
+            if err:
+                *lines, listing = (listing + err).split(b"\n")
+                for line in lines:
+                    m = re.match(rb"^block (\d+): (.*)$", line)
+                    if m:
+                        name = m.group(2).decode("utf-8", "replace")
+                        writer.add_file(name, int(m.group(1)) * 512)
+    except BaseException:
+        writer.close()
+        shutil.rmtree(dest, ignore_errors=True)
+        raise
+    writer.close()
+    return size, sum(x.size for x in writer.manifest.chunks)
@@ -1,13 +1,19 @@
+import codecs
 import datetime
+import io
+import logging
 import os
 import os.path
 import random
 import re
+import socket
 import string
 import tarfile
-import tempfile
-from collections.abc import Iterator
+import time
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
 from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
 from pathlib import Path
 from typing import TypeVar
 
@@ -16,6 +22,9 @@ import tzlocal
 from docker.models.containers import Container
 from docker.models.volumes import Volume
 
+from privateer.compress import compressed_writer
+from privateer.session import current_session, docker_client
+
 T = TypeVar("T")
 
 
@@ -32,29 +41,55 @@ def unique(x: list[T]) -> list[T]:
 def string_to_volume(
     text: str | list[str], volume: str, path: str | Path, **kwargs
 ) -> None:
-    if isinstance(text, list):
-        text = "".join(x + "\n" for x in text)
+    strings_to_volume([(path, text, kwargs)], volume)
+
+
+# Write several files into a volume at once, using a single container
+# and a single archive.  Each element of 'files' is a path (relative to
+# the root of the volume), its contents and a dictionary of any of
+# 'mode', 'uid' and 'gid' for that file; further keyword arguments
+# give defaults for these.
+def strings_to_volume(
+    files: list[tuple[str | Path, str | list[str], dict[str, int]]],
+    volume: str,
+    **kwargs,
+) -> None:
     ensure_image("alpine")
-    dest = Path("/dest")
-    mounts = [docker.types.Mount(str(dest), volume, type="volume")]
-    cl = docker.from_env()
+    dest = "/dest"
+    mounts = [docker.types.Mount(dest, volume, type="volume")]
+    cl = docker_client()
     container = cl.containers.create("alpine", mounts=mounts, detach=True)
     try:
-        string_to_container(text, container, dest / path, **kwargs)
+        container.put_archive(dest, strings_to_tar(files, **kwargs))
     finally:
         container.remove()
 
 
+def strings_to_tar(
+    files: list[tuple[str | Path, str | list[str], dict[str, int]]],
+    **kwargs,
+) -> bytes:
+    buf = io.BytesIO()
+    now = int(time.time())
+    with tarfile.open(mode="w", fileobj=buf) as tar:
+        for path, text, permissions in files:
+            if isinstance(text, list):
+                data = bytes("".join(x + "\n" for x in text), "utf-8")
+            else:
+                data = bytes(text, "utf-8")
+            info = tarfile.TarInfo(str(path))
+            info.size = len(data)
+            info.mtime = now
+            info.mode = 0o600
+            info.uid = os.geteuid()
+            info.gid = os.getegid()
+            set_permissions(**{**kwargs, **permissions})(info)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
 def string_from_volume(volume: str, path: str | Path) -> str:
-    ensure_image("alpine")
-    src = Path("/src")
-    mounts = [docker.types.Mount(str(src), volume, type="volume")]
-    cl = docker.from_env()
-    container = cl.containers.create("alpine", mounts=mounts, detach=True)
-    try:
-        return string_from_container(container, str(src / path))
-    finally:
-        container.remove()
+    return b"".join(iter_from_volume(volume, path)).decode("utf-8")
 
 
 def string_to_container(
@@ -69,20 +104,67 @@ def string_from_container(container: Container, path: str) -> str:
 
 
 def bytes_from_container(container: Container, path: str) -> bytes:
-    stream, status = container.get_archive(path)
+    return b"".join(iter_from_container(container, path))
+
+
+# Stream the contents of a single file out of a container, in chunks
+# of at most 'chunk_size' bytes.  The archive that docker sends is
+# read as a stream too, so at no point is the whole file held in
+# memory (or spooled to disk).
+def iter_from_container(
+    container: Container, path: str, chunk_size: int = 1024 * 1024
+) -> Iterator[bytes]:
+    stream, _ = container.get_archive(path, chunk_size=chunk_size)
+    fileobj = io.BufferedReader(ChunkReader(stream), buffer_size=chunk_size)
+    with tarfile.open(mode="r|", fileobj=fileobj) as tar:
+        for member in tar:
+            if member.name != os.path.basename(path):
+                continue
+            f = tar.extractfile(member)
+            if f is None:
+                msg = f"'{path}' is not a regular file"
+                raise Exception(msg)
+            while chunk := f.read(chunk_size):
+                yield chunk
+            return
+    msg = f"'{path}' was not found in the archive"
+    raise Exception(msg)
+
+
+def iter_from_volume(
+    volume: str, path: str | Path, chunk_size: int = 1024 * 1024
+) -> Iterator[bytes]:
+    ensure_image("alpine")
+    src = Path("/src")
+    mounts = [docker.types.Mount(str(src), volume, type="volume")]
+    cl = docker_client()
+    container = cl.containers.create("alpine", mounts=mounts, detach=True)
     try:
-        fd, tmp = tempfile.mkstemp(text=False)
-        with os.fdopen(fd, "wb") as f:
-            for d in stream:
-                f.write(d)
-        with open(tmp, "rb") as f:
-            t = tarfile.open(mode="r", fileobj=f)
-            p = t.extractfile(os.path.basename(path))
-            # Probably this needs more care, but I think that the None
-            # path is effectively prevented by docker already
-            return p.read()  # type: ignore
+        yield from iter_from_container(container, str(src / path), chunk_size)
     finally:
-        os.remove(tmp)
+        container.remove()
+
+
+class ChunkReader(io.RawIOBase):
+    """Present an iterator of byte chunks as a readable file."""
+
+    def __init__(self, chunks: Iterator[bytes]):
+        self._chunks = iter(chunks)
+        self._buf = memoryview(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._buf:
+            try:
+                self._buf = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        return n
 
 
 def set_permissions(mode=None, uid=None, gid=None):
@@ -98,28 +180,19 @@ def set_permissions(mode=None, uid=None, gid=None):
     return ret
 
 
-def simple_tar_string(text: str, name: str, **kwargs):
-    data = bytes(text, "utf-8")
-    try:
-        fd, tmp = tempfile.mkstemp(text=True)
-        with os.fdopen(fd, "wb") as f:
-            f.write(data)
-        return simple_tar(tmp, name, **kwargs)
-    finally:
-        os.remove(tmp)
-
-
-def simple_tar(path: str, name: str, **kwargs):
-    f = tempfile.NamedTemporaryFile()
-    t = tarfile.open(mode="w", fileobj=f)
-    abs_path = os.path.abspath(path)
-    t.add(
-        abs_path,
-        arcname=name,
-        recursive=False,
-        filter=set_permissions(**kwargs),
-    )
-    t.close()
+def simple_tar_string(text: str, name: str, **kwargs) -> io.BytesIO:
+    return io.BytesIO(strings_to_tar([(name, text, {})], **kwargs))
+
+
+def simple_tar(path: str, name: str, **kwargs) -> io.BytesIO:
+    f = io.BytesIO()
+    with tarfile.open(mode="w", fileobj=f) as t:
+        t.add(
+            os.path.abspath(path),
+            arcname=name,
+            recursive=False,
+            filter=set_permissions(**kwargs),
+        )
     f.seek(0)
     return f
 
@@ -142,12 +215,7 @@ def transient_envvar(env: dict[str, str | None]) -> Iterator[None]:
 
 
 def ensure_image(name: str) -> None:
-    cl = docker.from_env()
-    try:
-        cl.images.get(name)
-    except docker.errors.ImageNotFound:
-        print(f"Pulling {name}")
-        cl.images.pull(name)
+    current_session().ensure_image(name)
 
 
 def container_exists(name: str) -> bool:
@@ -155,33 +223,111 @@ def container_exists(name: str) -> bool:
 
 
 def container_if_exists(name: str) -> Container | None:
-    try:
-        return docker.from_env().containers.get(name)
-    except docker.errors.NotFound:
-        return None
+    return current_session().container_if_exists(name)
 
 
 def volume_exists(name: str) -> bool:
-    return bool(volume_if_exists(name))
+    return current_session().volume_exists(name)
 
 
 def volume_if_exists(name: str) -> Volume | None:
-    try:
-        return docker.from_env().volumes.get(name)
-    except docker.errors.NotFound:
-        return None
+    return current_session().volume_if_exists(name)
 
 
 def rand_str(n: int = 8) -> str:
     return "".join(random.choices(string.ascii_lowercase + string.digits, k=n))
 
 
+def format_bytes(n: float) -> str:
+    units = ["B", "KiB", "MiB", "GiB", "TiB"]
+    i = 0
+    while abs(n) >= 1024 and i < len(units) - 1:  # noqa: PLR2004
+        n /= 1024
+        i += 1
+    return f"{n:.0f} B" if i == 0 else f"{n:.1f} {units[i]}"
+
+
+class LogCapture:
+    """Capture the output of a container, with bounded memory use.
+
+    Only the last `n` lines are kept in memory, in a ring buffer.
+    Optionally, every line is also written to a file on the host,
+    which is rotated once it reaches `max_bytes` (keeping `backups`
+    old files alongside it), so that memory and disk use stay bounded
+    however much a container prints.
+    """
+
+    def __init__(
+        self,
+        n: int,
+        *,
+        path: str | Path | None = None,
+        max_bytes: int = 100 * 1024 * 1024,
+        backups: int = 5,
+    ):
+        self.count = 0
+        self._lines: deque[str] = deque(maxlen=n)
+        self._handler = None
+        if path:
+            self._handler = RotatingFileHandler(
+                path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8"
+            )
+            self._handler.setFormatter(logging.Formatter("%(message)s"))
+
+    def __enter__(self) -> "LogCapture":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def add(self, line: str) -> None:
+        self.count += 1
+        self._lines.append(line)
+        if self._handler:
+            self._handler.emit(logging.makeLogRecord({"msg": line}))
+
+    def tail(self, n: int) -> list[str]:
+        lines = list(self._lines)[-n:]
+        omitted = self.count - len(lines)
+        if omitted > 0:
+            return [f"(ommitting {omitted} lines of logs)", *lines]
+        return lines
+
+    def close(self) -> None:
+        if self._handler:
+            self._handler.close()
+            self._handler = None
+
+
 def log_tail(container: Container, n: int) -> list[str]:
-    logs = container.logs().decode("utf-8").strip().split("\n")
-    if len(logs) > n:
-        return [f"(ommitting {len(logs) - n} lines of logs)", *logs[-n:]]
-    else:
-        return logs
+    with LogCapture(n) as logs:
+        for line, complete in log_lines(container.logs(stream=True)):
+            if complete:
+                logs.add(line)
+        return logs.tail(n)
+
+
+def log_lines(stream: Iterator[bytes]) -> Iterator[tuple[str, bool]]:
+    """Split a stream of output into lines.
+
+    Lines are split on carriage returns as well as newlines, so that
+    output that redraws a single line (as rsync's progress does) is
+    seen as it updates.  Each line is returned along with a flag
+    indicating if it was complete (ended by a newline, or at the end
+    of the output); only complete lines would remain visible on a
+    terminal.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    buf = ""
+    for chunk in stream:
+        buf += decoder.decode(chunk)
+        *parts, buf = re.split(r"(\r|\n)", buf)
+        for line, end in zip(parts[::2], parts[1::2], strict=True):
+            if line or end == "\n":
+                yield line, end == "\n"
+    buf += decoder.decode(b"", final=True)
+    if buf:
+        yield buf, True
 
 
 def mounts_str(mounts: list[docker.types.Mount] | None) -> list[str]:
@@ -227,24 +373,246 @@ def isotimestamp() -> str:
     return now.strftime("%Y%m%d-%H%M%S")
 
 
-def run_container_with_command(display: str, image: str, **kwargs) -> None:
+def run_container_with_command(
+    display: str,
+    image: str,
+    *,
+    follow: Callable[[str], None] | None = None,
+    log_file: str | Path | None = None,
+    **kwargs,
+) -> None:
     ensure_image(image)
-    client = docker.from_env()
+    client = docker_client()
     container = client.containers.run(image, **kwargs, detach=True)
     print(f"{display} command started. To stream progress, run:")
     print(f"  docker logs -f {container.name}")
+    if log_file:
+        print(f"Full logs will be written to '{log_file}'")
+    with LogCapture(20, path=log_file) as logs:
+        stream = container.logs(stream=True, follow=True)
+        for line, complete in log_lines(stream):
+            if follow:
+                follow(line)
+            if complete:
+                logs.add(line)
     result = container.wait()
     if result["StatusCode"] == 0:
         print(f"{display} completed successfully! Container logs:")
-        print("\n".join(log_tail(container, 10)))
+        print("\n".join(logs.tail(10)))
         container.remove()
     else:
         print("An error occured! Container logs:")
-        print("\n".join(log_tail(container, 20)))
+        print("\n".join(logs.tail(20)))
         msg = f"{display} failed; see {container.name} logs for details"
         raise Exception(msg)
 
 
+def container_output(
+    display: str,
+    image: str,
+    *,
+    before: Callable[[Container], None] | None = None,
+    after: Callable[[Container], None] | None = None,
+    **kwargs,
+) -> Iterator[tuple[bytes | None, bytes | None]]:
+    """Run a container, streaming its output.
+
+    The output comes straight from the docker API as it arrives, and
+    is never held in docker's logs (the container runs with logging
+    disabled), so this is suitable for commands that write a lot of
+    data to standard output.  The last lines of standard error are
+    shown if the command fails.
+
+    Args:
+        display: Name of the operation, for messages
+
+        image: The image to run
+
+        before: Optionally, a function to call with the container
+            once it has been created, but before it starts (e.g., to
+            copy files into it)
+
+        after: Optionally, a function to call with the container if
+            the command succeeds, before it is removed (e.g., to copy
+            files out of it)
+
+        kwargs: Additional arguments to `containers.create()`, such
+            as `command` and `mounts`
+
+    Return:
+        An iterator of pairs of chunks of standard output and standard
+        error; one of each pair will be `None`.  Once exhausted, this
+        raises an exception if the command failed.
+    """
+    ensure_image(image)
+    client = docker_client()
+    log_config = docker.types.LogConfig(type=docker.types.LogConfig.types.NONE)
+    container = client.containers.create(image, log_config=log_config, **kwargs)
+    errors: deque[bytes] = deque(maxlen=100)
+    try:
+        if before:
+            before(container)
+        # Attach before starting, so that no output is missed
+        stream = client.api.attach(container.id, stream=True, demux=True)
+        container.start()
+        for out, err in stream:
+            if err:
+                errors.append(err)
+            yield out, err
+        result = container.wait()
+        if after and result["StatusCode"] == 0:
+            after(container)
+    finally:
+        container.remove(force=True)
+    if result["StatusCode"] != 0:
+        with LogCapture(20) as logs:
+            for line, complete in log_lines(iter(errors)):
+                if complete:
+                    logs.add(line)
+            print("An error occured! Container logs:")
+            print("\n".join(logs.tail(20)))
+        msg = f"{display} failed"
+        raise Exception(msg)
+
+
+def run_container_to_file(
+    display: str,
+    image: str,
+    dest: str | Path,
+    *,
+    compress: str | None = None,
+    threads: int | None = None,
+    checksum: Callable[[bytes], None] | None = None,
+    **kwargs,
+) -> int:
+    """Run a container, writing its standard output to a file.
+
+    The output is streamed into `dest` as it arrives (see
+    `container_output()`), so the file is created by (and belongs to)
+    the calling user.  If the command fails the partial file is
+    removed.
+
+    Args:
+        display: Name of the operation, for messages
+
+        image: The image to run
+
+        dest: Path to the file to write
+
+        compress: Optionally, compress the output as it is written,
+            with one of the methods in `compress.COMPRESSION`
+
+        threads: The number of threads to compress with; by default
+            use all available cores
+
+        checksum: Optionally, a function to call with each block of
+            bytes as it is written to `dest` (after compression), such
+            as the `update` method of a `hashlib` object, so the file
+            does not need reading again to checksum it
+
+        kwargs: Additional arguments to `containers.create()`, such
+            as `command` and `mounts`
+
+    Return:
+        The number of bytes of output, before any compression.
+    """
+    size = 0
+    try:
+        with (
+            open(dest, "wb", buffering=1024 * 1024) as raw,
+            compressed_writer(
+                _ObservedFile(raw, checksum) if checksum else raw,
+                compress,
+                threads=threads,
+            ) as w,
+        ):
+            for out, _ in container_output(display, image, **kwargs):
+                if out:
+                    w.write(out)
+                    size += len(out)
+    except BaseException:
+        Path(dest).unlink(missing_ok=True)
+        raise
+    return size
+
+
+class _ObservedFile:
+    def __init__(self, f, observe: Callable[[bytes], None]):
+        self._f = f
+        self._observe = observe
+
+    def write(self, data: bytes) -> int:
+        self._observe(data)
+        return self._f.write(data)
+
+    def flush(self) -> None:
+        self._f.flush()
+
+
+def run_container_with_input(
+    display: str, image: str, chunks: Iterable[bytes], **kwargs
+) -> None:
+    """Run a container, streaming data into its standard input.
+
+    Args:
+        display: Name of the operation, for messages
+
+        image: The image to run
+
+        chunks: The data to send, as an iterable of bytes; this is
+            consumed as the container reads it
+
+        kwargs: Additional arguments to `containers.create()`, such
+            as `command` and `mounts`
+    """
+    ensure_image(image)
+    client = docker_client()
+    container = client.containers.create(
+        image, stdin_open=True, stdin_once=True, **kwargs
+    )
+    closed = False
+    try:
+        sock = container.attach_socket(params={"stdin": 1, "stream": 1})
+        # The docker client wraps the underlying socket, which we
+        # need in order to signal the end of input
+        raw = getattr(sock, "_sock", sock)
+        container.start()
+        try:
+            for chunk in chunks:
+                raw.sendall(chunk)
+            raw.shutdown(socket.SHUT_WR)
+        except BrokenPipeError:
+            # The container exited without reading all its input
+            closed = True
+        result = container.wait()
+        sock.close()
+        if result["StatusCode"] != 0 or closed:
+            print("An error occured! Container logs:")
+            print("\n".join(log_tail(container, 20)))
+            msg = f"{display} failed"
+            raise Exception(msg)
+    finally:
+        container.remove(force=True)
+
+
+def log_file_path(log_dir: str | Path | None, *parts: str) -> Path | None:
+    if log_dir is None:
+        return None
+    os.makedirs(log_dir, exist_ok=True)
+    return Path(log_dir) / f"{'-'.join([*parts, isotimestamp()])}.log"
+
+
+# Where we keep state on the host between commands; this can be
+# overridden with PRIVATEER_CACHE_DIR and otherwise follows the XDG
+# convention.
+def cache_dir() -> Path:
+    path = os.environ.get("PRIVATEER_CACHE_DIR")
+    if path:
+        return Path(path)
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "privateer"
+
+
 @contextmanager
 def transient_working_directory(path: str | Path) -> Iterator[None]:
     origin = os.getcwd()
@@ -1,8 +1,18 @@
+import json
 import os
 import re
+import tempfile
+import time
+from pathlib import Path
 
 import hvac
 
+from privateer.util import cache_dir
+
+# Stop using a cached token this long before it actually expires, so
+# that it does not run out part way through a command.
+TOKEN_EXPIRY_MARGIN = 60
+
 
 def vault_client(addr: str, token: str | None = None) -> hvac.Client:
     """Create a vault client.
@@ -22,18 +32,50 @@ def vault_client(addr: str, token: str | None = None) -> hvac.Client:
             `VAULT_AUTH_GITHUB_TOKEN` variables (in that order) and
             fall back on interactively prompting for a token.
 
+    Logging in with GitHub is slow and rate limited, so the vault
+    token that results is cached on the host (readable only by the
+    current user; see `cache_dir()`) and reused for `addr` until it
+    expires or `vault_logout` is called.  While a cached token is
+    valid we neither log in nor prompt.  If the vault refuses a
+    cached token (for example because it has been revoked), it is
+    dropped and we log in again.
+
     """
-    token = _get_vault_token(token)
+    token = _get_vault_token(token, prompt=False)
+    if token is not None and not _is_github_token(token):
+        return hvac.Client(addr, token=token)
+    cached = _cached_vault_token(addr)
+    if cached:
+        client = hvac.Client(addr, token=cached)
+        if _token_is_accepted(client):
+            return client
+        print("cached vault token was refused, logging in again")
+        _forget_vault_token(addr)
+    if token is None:
+        token = _prompt_vault_token()
     if _is_github_token(token):
         print("logging into vault using github")
         client = hvac.Client(addr)
-        client.auth.github.login(token)
+        auth = client.auth.github.login(token)["auth"]
+        _cache_vault_token(addr, auth["client_token"], auth["lease_duration"])
     else:
         client = hvac.Client(addr, token=token)
     return client
 
 
-def _get_vault_token(token: str | None) -> str:
+def vault_logout(addr: str) -> None:
+    """Forget any cached vault token.
+
+    Args:
+        addr: The vault address (url)
+    """
+    if _forget_vault_token(addr):
+        print(f"Removed cached vault token for '{addr}'")
+    else:
+        print(f"No cached vault token for '{addr}'")
+
+
+def _get_vault_token(token: str | None, *, prompt: bool = True) -> str | None:
     if token is not None:
         re_envvar = re.compile("^\\$[A-Z0-9_-]+$")
         if re_envvar.match(token):
@@ -43,6 +85,10 @@ def _get_vault_token(token: str | None) -> str:
     for token_type in check:
         if token_type in os.environ:
             return os.environ[token_type]
+    return _prompt_vault_token() if prompt else None
+
+
+def _prompt_vault_token() -> str:
     prompt = "Enter GitHub or Vault token to log into the vault:\n> "
     return input(prompt).strip()
 
@@ -50,3 +96,64 @@ def _get_vault_token(token: str | None) -> str:
 def _is_github_token(token: str) -> bool:
     re_gh = re.compile("^ghp_[A-Za-z0-9]{36}$")
     return bool(re_gh.match(token))
+
+
+def _cached_vault_token(addr: str) -> str | None:
+    entry = _read_token_cache().get(addr)
+    if not entry:
+        return None
+    expires = entry.get("expires")
+    if expires is not None and time.time() > expires - TOKEN_EXPIRY_MARGIN:
+        return None
+    return entry.get("token")
+
+
+# A cached token can stop working before it expires (it may have been
+# revoked, or its policies changed), in which case the vault responds
+# with 403 (permission denied) to everything we do with it.
+def _token_is_accepted(client: hvac.Client) -> bool:
+    try:
+        client.auth.token.lookup_self()
+    except hvac.exceptions.Forbidden:
+        return False
+    return True
+
+
+def _forget_vault_token(addr: str) -> bool:
+    tokens = _read_token_cache()
+    if tokens.pop(addr, None) is None:
+        return False
+    _write_token_cache(tokens)
+    return True
+
+
+def _cache_vault_token(addr: str, token: str, ttl: int) -> None:
+    tokens = _read_token_cache()
+    # A ttl of zero means that the token never expires
+    expires = time.time() + ttl if ttl else None
+    tokens[addr] = {"token": token, "expires": expires}
+    _write_token_cache(tokens)
+
+
+def _token_cache_path() -> Path:
+    return cache_dir() / "vault-tokens.json"
+
+
+def _read_token_cache() -> dict[str, dict]:
+    try:
+        with _token_cache_path().open() as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+# mkstemp creates the file readable only by us, so the token is never
+# visible to other users, even briefly.
+def _write_token_cache(tokens: dict[str, dict]) -> None:
+    path = _token_cache_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent)
+    with os.fdopen(fd, "w") as f:
+        json.dump(tokens, f)
+    os.replace(tmp, path)
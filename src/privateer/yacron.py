@@ -1,4 +1,6 @@
+import json
 import os
+import shlex
 import tempfile
 
 import yacron.config  # type: ignore
@@ -23,9 +25,21 @@ def generate_yacron_yaml(cfg: Config, name: str) -> None | list[str]:
     ret.append("jobs:")
     for i, job in enumerate(machine.schedule.jobs):
         job_name = f"job-{i + 1}"
-        cmd = " ".join(backup_command(name, job.volume, job.server))
+        vol = cfg.volume_config(job.volume)
+        cmd = backup_command(
+            name,
+            job.volume,
+            job.server,
+            generations=vol.generations,
+            parallel=vol.parallel,
+            large_files=vol.large_files,
+            transfer=vol.transfer,
+            # Nothing follows the output of a scheduled job, so live
+            # progress would only fill yacron's captured output
+            reporting=False,
+        )
         ret.append(f'  - name: "{job_name}"')
-        ret.append(f'    command: "{cmd}"')
+        ret.append(f"    command: {json.dumps(shlex.join(cmd))}")
         ret.append(f'    schedule: "{job.schedule}"')
 
     _validate_yacron_yaml(ret)
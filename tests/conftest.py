@@ -11,6 +11,12 @@ from privateer.util import (
 vault_dev.ensure_installed()
 
 
+@pytest.fixture(autouse=True)
+def isolated_cache_dir(tmp_path_factory, monkeypatch):
+    path = tmp_path_factory.mktemp("cache")
+    monkeypatch.setenv("PRIVATEER_CACHE_DIR", str(path))
+
+
 @pytest.fixture
 def managed_docker():
     created = {"container": [], "volume": []}
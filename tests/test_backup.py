@@ -1,14 +1,62 @@
-from unittest.mock import MagicMock, call
+import os
+import shlex
+import subprocess
+from unittest.mock import ANY, MagicMock, call
 
 import docker
+import pytest
 import vault_dev
 
 import privateer.server
-from privateer.backup import backup
-from privateer.config import read_config
+from privateer.backup import (
+    backup,
+    backup_all,
+    backup_batch_command,
+    backup_command,
+    backup_to_all_servers,
+)
+from privateer.config import LargeFiles, Transfer, read_config
 from privateer.configure import configure
 from privateer.keys import keygen_all
 
+RSYNC = "rsync -av --delete --stats --info=progress2"
+RSYNC_LINK = "rsync -av --link-dest=../latest --stats --info=progress2"
+
+
+@pytest.fixture
+def cfg():
+    return read_config("example/complex.json")
+
+
+@pytest.fixture
+def mock_run(monkeypatch, cfg):
+    # Act as client 'bob' (see privateer.backup.check_client) without
+    # touching docker, returning the mock that would run each backup
+    mock_check = MagicMock(return_value=cfg.clients[0])
+    monkeypatch.setattr(privateer.backup, "check_client", mock_check)
+    mock = MagicMock()
+    monkeypatch.setattr(privateer.backup, "run_container_with_command", mock)
+    return mock
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {},
+        {"generations": True},
+        {"large_files": LargeFiles()},
+        {"parallel": 2, "generations": True, "large_files": LargeFiles()},
+    ],
+)
+def test_can_build_backup_command_without_progress(kwargs):
+    cmd = shlex.join(backup_command("bob", "data", "alice", **kwargs))
+    assert "--info=progress2" in cmd
+    cmd = shlex.join(
+        backup_command("bob", "data", "alice", reporting=False, **kwargs)
+    )
+    assert "--stats" in cmd
+    assert "--info=progress2" not in cmd
+
 
 def test_can_print_instructions_to_run_backup(capsys, managed_docker):
     with vault_dev.Server() as server:
@@ -28,7 +76,7 @@ def test_can_print_instructions_to_run_backup(capsys, managed_docker):
             "  docker run --rm "
             f"-v {vol}:/privateer/keys:ro -v data:/privateer/volumes/data:ro "
             f"mrcide/privateer-client:{cfg.tag} "
-            "rsync -av --delete /privateer/volumes/data "
+            f"{RSYNC} /privateer/volumes/data "
             "alice:/privateer/volumes/bob"
         )
         assert cmd in lines
@@ -54,6 +102,8 @@ def test_can_run_backup(monkeypatch, managed_docker):
             "rsync",
             "-av",
             "--delete",
+            "--stats",
+            "--info=progress2",
             "/privateer/volumes/data",
             "alice:/privateer/volumes/bob",
         ]
@@ -67,5 +117,359 @@ def test_can_run_backup(monkeypatch, managed_docker):
         ]
         assert mock_run.call_count == 1
         assert mock_run.call_args == call(
-            "Backup", image, command=command, mounts=mounts
+            "Backup",
+            image,
+            command=command,
+            mounts=mounts,
+            follow=ANY,
+            log_file=None,
+        )
+
+
+def test_can_back_up_all_volumes_to_all_servers(cfg, capsys, mock_run):
+    cfg.clients[0].backup = ["data", "other"]
+    cfg.volumes[1].local = False
+    res = backup_all(cfg, "bob", jobs=2)
+    assert privateer.backup.check_client.call_count == 1
+    assert mock_run.call_count == 4
+    assert [(r.volume, r.server) for r in res] == [
+        ("data", "alice"),
+        ("data", "carol"),
+        ("other", "alice"),
+        ("other", "carol"),
+    ]
+    assert all(r.success for r in res)
+    out = capsys.readouterr().out
+    assert "Backup summary:" in out
+    assert "  'other' -> 'carol': OK" in out
+
+
+@pytest.mark.usefixtures("mock_run")
+def test_concurrent_backups_report_labelled_progress(cfg, monkeypatch):
+    cfg.clients[0].backup = ["data", "other"]
+    cfg.volumes[1].local = False
+    cfg.volumes[1].parallel = 4
+    mock_monitor = MagicMock()
+    mock_monitor.return_value.stats.return_value = None
+    monkeypatch.setattr(privateer.backup, "RsyncMonitor", mock_monitor)
+    backup_all(cfg, "bob", server="alice", jobs=2)
+    calls = mock_monitor.call_args_list
+    assert sorted(calls, key=lambda x: x.kwargs["label"]) == [
+        call(label="data -> alice", live=False, quiet=False),
+        call(label="other -> alice", live=False, quiet=True),
+    ]
+
+    mock_monitor.reset_mock()
+    backup_all(cfg, "bob", server="alice", jobs=1)
+    assert mock_monitor.call_args_list == [
+        call(label="data -> alice", live=True, quiet=False),
+        call(label="other -> alice", live=True, quiet=True),
+    ]
+
+
+def test_can_back_up_all_volumes_to_one_server(cfg, mock_run):
+    res = backup_all(cfg, "bob", server="carol")
+    assert len(res) == 1
+    assert res[0].server == "carol"
+    command = mock_run.call_args[1]["command"]
+    assert command[-1] == "carol:/privateer/volumes/bob"
+
+
+def test_backup_all_reports_failures(cfg, capsys, mock_run):
+    mock_run.side_effect = [None, Exception("Backup failed")]
+    with pytest.raises(Exception, match="1 of 2 backup jobs failed"):
+        backup_all(cfg, "bob", jobs=1)
+    out = capsys.readouterr().out
+    assert "  'data' -> 'alice': OK" in out
+    assert "  'data' -> 'carol': FAILED" in out
+    assert "Backup failed" in out
+
+
+@pytest.mark.usefixtures("mock_run")
+def test_backup_all_requires_volumes(cfg):
+    privateer.backup.check_client.return_value = cfg.clients[1]
+    with pytest.raises(Exception, match="'dan' does not back up any volumes"):
+        backup_all(cfg, "dan")
+
+
+def test_can_back_up_volume_to_all_servers(cfg, capsys, mock_run):
+    mock_run.side_effect = [None, Exception("Backup failed")]
+    with pytest.raises(Exception, match="1 of 2 backup jobs failed"):
+        backup_to_all_servers(cfg, "bob", "data")
+    assert mock_run.call_count == 2
+    targets = sorted(c[1]["command"][-1] for c in mock_run.call_args_list)
+    assert targets == [
+        "alice:/privateer/volumes/bob",
+        "carol:/privateer/volumes/bob",
+    ]
+    out = capsys.readouterr().out
+    assert "Backup summary:" in out
+    assert "Backup failed" in out
+
+
+@pytest.mark.usefixtures("mock_run")
+def test_can_print_instructions_to_back_up_to_all_servers(cfg, capsys):
+    assert backup_to_all_servers(cfg, "bob", "data", dry_run=True) == []
+    lines = capsys.readouterr().out.strip().split("\n")
+    assert lines.count("Command to manually run backup:") == 2
+
+
+def test_can_build_batch_command():
+    cmd = backup_batch_command("bob", "data", ["alice", "carol"])
+    assert cmd[:2] == ["bash", "-c"]
+    script = cmd[2].split("\n")
+    batch = "/tmp/privateer-batch"  # noqa: S108
+    assert script[1] == (
+        f"rsync -av --delete --stats --info=progress2 --write-batch={batch} "
+        "/privateer/volumes/data alice:/privateer/volumes/bob || exit 1"
+    )
+    assert (
+        "if ssh carol rsync --read-batch=- -a --delete "
+        f"/privateer/volumes/bob < {batch}; then"
+    ) in script
+    assert (
+        "  rsync -av --delete --stats --info=progress2 /privateer/volumes/data "
+        "carol:/privateer/volumes/bob || status=1"
+    ) in script
+    assert script[-1] == "exit $status"
+
+
+def test_can_back_up_to_all_servers_in_batch(cfg, capsys, mock_run):
+    res = backup_to_all_servers(cfg, "bob", "data", batch=True)
+    assert mock_run.call_count == 1
+    expected = backup_batch_command("bob", "data", ["alice", "carol"])
+    assert mock_run.call_args[1]["command"] == expected
+    assert len(res) == 1
+    assert res[0].server == "alice,carol"
+    assert "  'data' -> 'alice,carol': OK" in capsys.readouterr().out
+
+
+@pytest.mark.usefixtures("mock_run")
+def test_backup_to_all_servers_needs_its_own_function(cfg):
+    msg = "Use 'backup_to_all_servers' to back up to server 'all'"
+    with pytest.raises(Exception, match=msg):
+        backup(cfg, "bob", "data", server="all")
+
+
+def test_can_build_generation_command():
+    cmd = backup_command("bob", "data", "alice", generations=True)
+    assert cmd[:2] == ["bash", "-c"]
+    script = cmd[2].split("\n")
+    dest = "/privateer/volumes/bob/data"
+    src = "/privateer/volumes/data/"
+    finish = f"mv {dest}/$ts.partial {dest}/$ts && ln -sfn $ts {dest}/latest"
+    assert script == [
+        "set -e",
+        "ts=$(date -u +%Y%m%d-%H%M%S)",
+        f'ssh alice "rm -rf {dest}/*.partial && mkdir -p {dest}"',
+        f"{RSYNC_LINK} {src} alice:{dest}/$ts.partial/",
+        f'ssh alice "{finish}"',
+    ]
+
+
+def test_backup_uses_generations_if_configured(cfg, mock_run):
+    cfg.volumes[0].generations = True
+    backup(cfg, "bob", "data", server="alice")
+    expected = backup_command("bob", "data", "alice", generations=True)
+    assert mock_run.call_args[1]["command"] == expected
+    msg = "Batch mode is not supported for 'data'"
+    with pytest.raises(Exception, match=msg):
+        backup_all(cfg, "bob", batch=True, dry_run=True)
+
+
+def test_can_build_parallel_command():
+    cmd = backup_command("bob", "data", "alice", parallel=3)
+    assert cmd[:2] == ["bash", "-c"]
+    script = cmd[2].split("\n")
+    dest = "/privateer/volumes/bob/data"
+    assert "cd /privateer/volumes/data" in script
+    assert f"{RSYNC} --no-recursive --dirs ./ alice:{dest}/" in script
+    assert "for ((i = 0; i < 3; i++)); do" in script
+    assert (
+        f'    {RSYNC} -r --from0 --files-from="$lists/$i" ./ '
+        f"alice:{dest}/ &"
+    ) in script
+    assert script[-1] == "exit $status"
+    assert backup_command("bob", "data", "alice", parallel=1) == (
+        backup_command("bob", "data", "alice")
+    )
+
+
+def test_can_build_parallel_generation_command():
+    cmd = backup_command("bob", "data", "alice", generations=True, parallel=2)
+    script = cmd[2].split("\n")
+    dest = "/privateer/volumes/bob/data"
+    assert script[1] == "ts=$(date -u +%Y%m%d-%H%M%S)"
+    assert (
+        f'ssh alice "rm -rf {dest}/*.partial && mkdir -p {dest}/$ts.partial"'
+    ) in script
+    assert not any("--delete" in x for x in script)
+    assert script[-2].startswith("if [ $status = 0 ]; then ssh alice")
+
+
+def test_generation_backups_remove_stale_partial_directories():
+    dest = "/privateer/volumes/bob/data"
+    for parallel in [1, 2]:
+        cmd = backup_command(
+            "bob", "data", "alice", generations=True, parallel=parallel
         )
+        script = cmd[2].split("\n")
+        cleanup = [x for x in script if f"rm -rf {dest}/*.partial" in x]
+        assert len(cleanup) == 1
+        # Cleared out before anything is sent
+        first = min(i for i, x in enumerate(script) if "rsync" in x)
+        assert script.index(cleanup[0]) < first
+    script = backup_command("bob", "data", "alice", parallel=2)[2]
+    assert ".partial" not in script
+
+
+def test_backup_uses_parallel_if_configured(cfg, mock_run):
+    cfg.volumes[0].parallel = 4
+    backup(cfg, "bob", "data", server="alice")
+    expected = backup_command("bob", "data", "alice", parallel=4)
+    assert mock_run.call_args[1]["command"] == expected
+    msg = "Batch mode is not supported for 'data' \\(parallel\\)"
+    with pytest.raises(Exception, match=msg):
+        backup_to_all_servers(cfg, "bob", "data", batch=True, dry_run=True)
+
+
+def test_can_build_large_files_command():
+    lf = LargeFiles(threshold=100, chunk=8, streams=2)
+    cmd = backup_command("bob", "data", "alice", large_files=lf)
+    assert cmd[:2] == ["bash", "-c"]
+    script = cmd[2].split("\n")
+    dest = "/privateer/volumes/bob/data"
+    exclude = '--from0 --exclude-from="$large/exclude"'
+    assert 'privateer-large-files list . 100 > "$large/files"' in script
+    assert f"{RSYNC} {exclude} ./ alice:{dest}/" in script
+    assert (
+        f'privateer-large-files send . alice {dest} 8 2 < "$large/files"'
+        in script
+    )
+
+
+def test_can_build_parallel_large_files_command():
+    lf = LargeFiles()
+    cmd = backup_command("bob", "data", "alice", parallel=2, large_files=lf)
+    script = cmd[2].split("\n")
+    dest = "/privateer/volumes/bob/data"
+    exclude = '--from0 --exclude-from="$large/exclude"'
+    assert (
+        f'    {RSYNC} {exclude} -r --files-from="$lists/$i" ./ '
+        f"alice:{dest}/ &"
+    ) in script
+    assert (
+        f'privateer-large-files send . alice {dest} 64 4 < "$large/files" '
+        "|| status=1"
+    ) in script
+    assert script[-1] == "exit $status"
+
+
+def test_large_files_script_sends_every_file(tmp_path):
+    # Run the script's 'send' with a stand-in for ssh that runs the
+    # remote command locally, so the "server" is just another directory.
+    # Like ssh, it reads all of its stdin unless given '-n'.
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    script = os.path.abspath("images/privateer-large-files")
+    (bin_dir / "privateer-large-files").symlink_to(script)
+    ssh = bin_dir / "ssh"
+    ssh.write_text(
+        "#!/bin/bash\n"
+        'while [ "${1#-}" != "$1" ]; do\n'
+        '  if [ "$1" = -n ]; then exec < /dev/null; fi\n'
+        "  shift\n"
+        "done\n"
+        "shift\n"
+        'bash -c "$*"\n'
+        "rc=$?\n"
+        "cat > /dev/null\n"
+        "exit $rc\n"
+    )
+    ssh.chmod(0o755)
+    src = tmp_path / "src"
+    dest = tmp_path / "dest"
+    (src / "sub").mkdir(parents=True)
+    names = ["one", "sub/two", "three"]
+    for name in names:
+        (src / name).write_bytes(os.urandom(2 * 1024 * 1024 + 100))
+    env = {**os.environ, "PATH": f"{bin_dir}:{os.environ['PATH']}"}
+    res = subprocess.run(  # noqa: S603
+        [script, "send", str(src), "server", str(dest), "1", "2"],
+        input="".join(f"{x}\0" for x in names),
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert res.stdout.count("chunks") == 3
+    for name in names:
+        assert (dest / name).read_bytes() == (src / name).read_bytes()
+
+
+def test_backup_uses_large_files_if_configured(cfg, mock_run):
+    cfg.volumes[0].large_files = LargeFiles(threshold=10)
+    backup(cfg, "bob", "data", server="alice")
+    lf = LargeFiles(threshold=10)
+    expected = backup_command("bob", "data", "alice", large_files=lf)
+    assert mock_run.call_args[1]["command"] == expected
+    msg = "Batch mode is not supported for 'data' \\(large_files\\)"
+    with pytest.raises(Exception, match=msg):
+        backup_to_all_servers(cfg, "bob", "data", batch=True, dry_run=True)
+
+
+def test_backup_commands_use_transfer_settings():
+    t = Transfer(compress="zstd", exclude=["*.log", "tmp dir"])
+    args = ["--compress", "--compress-choice=zstd", "--exclude=*.log"]
+    cmd = backup_command("bob", "data", "alice", transfer=t)
+    assert cmd == [
+        "rsync",
+        "-av",
+        "--delete",
+        "--stats",
+        "--info=progress2",
+        *args,
+        "--exclude=tmp dir",
+        "/privateer/volumes/data",
+        "alice:/privateer/volumes/bob",
+    ]
+    opts = shlex.join([*args, "--exclude=tmp dir"])
+    cmd = backup_command("bob", "data", "alice", generations=True, transfer=t)
+    assert f"{RSYNC_LINK} {opts} " in cmd[2]
+    cmd = backup_command("bob", "data", "alice", parallel=2, transfer=t)
+    assert f"{RSYNC} {opts} --no-recursive" in cmd[2]
+    cmd = backup_batch_command("bob", "data", ["alice", "carol"], transfer=t)
+    assert f"{RSYNC} {opts} --write-batch" in cmd[2]
+
+
+def test_backup_uses_transfer_if_configured(cfg, mock_run):
+    cfg.volumes[0].transfer = Transfer(checksum="xxh128")
+    backup(cfg, "bob", "data", server="alice")
+    assert "--checksum-choice=xxh128" in mock_run.call_args[1]["command"]
+
+
+def test_backup_returns_transfer_stats(cfg, capsys, mock_run):
+    logs = ["Number of regular files transferred: 3", "Total bytes sent: 2,048"]
+
+    def run(*_args, follow, **_kwargs):
+        for line in logs:
+            follow(line)
+
+    mock_run.side_effect = run
+    res = backup(cfg, "bob", "data", server="alice")
+    assert res.files_transferred == 3
+    assert res.bytes_sent == 2048
+    assert "Backup of 'data' to 'alice': 3 files transferred" in (
+        capsys.readouterr().out
+    )
+    res = backup_to_all_servers(cfg, "bob", "data")
+    assert [x.stats.bytes_sent for x in res] == [2048, 2048]
+    assert "  'data' -> 'alice': OK" in capsys.readouterr().out
+
+
+def test_can_write_backup_logs_to_directory(cfg, tmp_path, mock_run):
+    backup(cfg, "bob", "data", server="alice", log_dir=tmp_path / "logs")
+    log_file = mock_run.call_args[1]["log_file"]
+    assert log_file.parent == tmp_path / "logs"
+    assert log_file.name.startswith("backup-bob-data-alice-")
+    assert log_file.parent.is_dir()
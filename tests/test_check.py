@@ -1,15 +1,17 @@
 from unittest.mock import MagicMock, call
 
-import docker
 import pytest
 import vault_dev
 
 import privateer.check
 from privateer.check import (
-    _check_connections,
+    ConnectionResult,
     check,
     check_client,
+    check_connections,
     check_server,
+    connection_check_command,
+    print_connections,
 )
 from privateer.config import read_config
 from privateer.configure import configure
@@ -54,84 +56,107 @@ def test_error_on_check_if_unknown_machine():
             check(cfg, "eve")
 
 
-def test_can_check_connections(capsys, monkeypatch, managed_docker):
+def test_can_check_connections(capsys, monkeypatch):
+    cfg = read_config("example/simple.json")
     mock_docker = MagicMock()
+    mock_client = MagicMock()
+    mock_client.return_value.containers.run.return_value = (
+        b"alice\tOK\t35000\t\t\n"
+    )
     monkeypatch.setattr(privateer.check, "docker", mock_docker)
-    with vault_dev.Server() as server:
-        cfg = read_config("example/simple.json")
-        cfg.vault.url = server.url()
-        cfg.vault.token = server.token
-        vol_keys_bob = managed_docker("volume")
-        cfg.servers[0].key_volume = managed_docker("volume")
-        cfg.clients[0].key_volume = vol_keys_bob
-        keygen_all(cfg)
-        configure(cfg, "bob")
-        capsys.readouterr()  # flush previous output
-        _check_connections(cfg, cfg.clients[0])
-
-        out = capsys.readouterr().out
-        assert (
-            out == "checking connection to 'alice' (alice.example.com)...OK\n"
-        )
-        assert mock_docker.from_env.called
-        client = mock_docker.from_env.return_value
-        mount = mock_docker.types.Mount
-        assert mount.call_count == 1
-        assert mount.call_args_list[0] == call(
-            "/privateer/keys", vol_keys_bob, type="volume", read_only=True
-        )
-        assert client.containers.run.call_count == 1
-        assert client.containers.run.call_args == call(
-            f"mrcide/privateer-client:{cfg.tag}",
-            mounts=[mount.return_value],
-            command=["ssh", "alice", "cat", "/privateer/keys/name"],
-            remove=True,
+    monkeypatch.setattr(privateer.check, "docker_client", mock_client)
+    res = check_connections(cfg, cfg.clients[0])
+    assert res == [
+        ConnectionResult(
+            server="alice",
+            hostname="alice.example.com",
+            success=True,
+            latency=0.035,
         )
+    ]
+    client = mock_client.return_value
+    mount = mock_docker.types.Mount
+    assert mount.call_count == 1
+    assert mount.call_args_list[0] == call(
+        "/privateer/keys", "privateer_keys", type="volume", read_only=True
+    )
+    assert client.containers.run.call_count == 1
+    assert client.containers.run.call_args == call(
+        f"mrcide/privateer-client:{cfg.tag}",
+        mounts=[mount.return_value],
+        command=connection_check_command(["alice"]),
+        remove=True,
+    )
 
+    print_connections(res)
+    assert capsys.readouterr().out == (
+        "server  hostname           status  latency  throughput\n"
+        "alice   alice.example.com  OK      35 ms\n"
+    )
 
-def test_can_report_connection_failure(capsys, monkeypatch, managed_docker):
-    mock_docker = MagicMock()
-    mock_docker.errors = docker.errors
-    err = docker.errors.ContainerError("nm", 1, "ssh", "img", b"the reason")
-    monkeypatch.setattr(privateer.check, "docker", mock_docker)
-    client = mock_docker.from_env.return_value
-    client.containers.run.side_effect = err
-    with vault_dev.Server() as server:
-        cfg = read_config("example/simple.json")
-        cfg.vault.url = server.url()
-        cfg.vault.token = server.token
-        vol_keys_bob = managed_docker("volume")
-        cfg.servers[0].key_volume = managed_docker("volume")
-        cfg.clients[0].key_volume = vol_keys_bob
-        keygen_all(cfg)
-        configure(cfg, "bob")
-        capsys.readouterr()  # flush previous output
-        _check_connections(cfg, cfg.clients[0])
 
-        out = capsys.readouterr().out
-        assert out == (
-            "checking connection to 'alice' (alice.example.com)...ERROR\n"
-            "the reason\n"
-        )
-        assert mock_docker.from_env.called
-        client = mock_docker.from_env.return_value
-        mount = mock_docker.types.Mount
-        assert mount.call_count == 1
-        assert mount.call_args_list[0] == call(
-            "/privateer/keys", vol_keys_bob, type="volume", read_only=True
-        )
-        assert client.containers.run.call_count == 1
-        assert client.containers.run.call_args == call(
-            f"mrcide/privateer-client:{cfg.tag}",
-            mounts=[mount.return_value],
-            command=["ssh", "alice", "cat", "/privateer/keys/name"],
-            remove=True,
-        )
+def test_can_report_connection_failure(capsys, monkeypatch):
+    cfg = read_config("example/simple.json")
+    mock_client = MagicMock()
+    mock_client.return_value.containers.run.return_value = (
+        b"alice\tERROR\t\t\tConnection refused \n"
+    )
+    monkeypatch.setattr(privateer.check, "docker", MagicMock())
+    monkeypatch.setattr(privateer.check, "docker_client", mock_client)
+    res = check_connections(cfg, cfg.clients[0])
+    assert res[0].success is False
+    assert res[0].latency is None
+    assert res[0].error == "Connection refused"
+    print_connections(res)
+    assert capsys.readouterr().out == (
+        "server  hostname           status  latency  throughput\n"
+        "alice   alice.example.com  ERROR\n"
+        "'alice': Connection refused\n"
+    )
+
+
+def test_can_measure_throughput(monkeypatch):
+    cfg = read_config("example/simple.json")
+    size = privateer.check.BANDWIDTH_TEST_SIZE
+    mock_client = MagicMock()
+    mock_client.return_value.containers.run.return_value = (
+        b"alice\tOK\t100000\t2100000\t\n"
+    )
+    monkeypatch.setattr(privateer.check, "docker", MagicMock())
+    monkeypatch.setattr(privateer.check, "docker_client", mock_client)
+    res = check_connections(cfg, cfg.clients[0], bandwidth=True)
+    assert res[0].latency == 0.1
+    assert res[0].throughput == size / 2
+    run = mock_client.return_value.containers.run
+    assert run.call_args.kwargs["command"] == connection_check_command(
+        ["alice"], bandwidth=True
+    )
+
+
+def test_missing_connection_result_is_an_error(monkeypatch):
+    cfg = read_config("example/simple.json")
+    mock_client = MagicMock()
+    mock_client.return_value.containers.run.return_value = b""
+    monkeypatch.setattr(privateer.check, "docker", MagicMock())
+    monkeypatch.setattr(privateer.check, "docker_client", mock_client)
+    res = check_connections(cfg, cfg.clients[0])
+    assert res[0].success is False
+    assert res[0].error == "No result from check"
+
+
+def test_connection_check_command_runs_in_background():
+    cmd = connection_check_command(["alice", "carol"])
+    assert cmd[:2] == ["bash", "-c"]
+    assert cmd[3:] == ["privateer", "alice", "carol"]
+    assert 'check "$server" > "$results/$i" &' in cmd[2]
+    assert "/dev/zero" not in cmd[2]
+    assert "/dev/zero" in connection_check_command(["a"], bandwidth=True)[2]
 
 
 def test_only_test_connection_for_clients(monkeypatch, managed_docker):
     mock_check = MagicMock()
-    monkeypatch.setattr(privateer.check, "_check_connections", mock_check)
+    monkeypatch.setattr(privateer.check, "check_connections", mock_check)
+    monkeypatch.setattr(privateer.check, "print_connections", MagicMock())
     with vault_dev.Server() as server:
         cfg = read_config("example/simple.json")
         cfg.vault.url = server.url()
@@ -150,7 +175,9 @@ def test_only_test_connection_for_clients(monkeypatch, managed_docker):
         assert mock_check.call_count == 0
         check(cfg, "bob", connection=True)
         assert mock_check.call_count == 1
-        assert mock_check.call_args == call(cfg, cfg.clients[0])
+        assert mock_check.call_args == call(
+            cfg, cfg.clients[0], bandwidth=False
+        )
 
 
 def test_servers_cannot_be_used_as_clients(managed_docker):
@@ -179,3 +206,67 @@ def test_clients_cannot_be_used_as_servers(managed_docker):
         configure(cfg, "bob")
         with pytest.raises(Exception, match="'bob' is not a privateer server"):
             check_server(cfg, "bob")
+
+
+def test_identity_is_cached_on_host(monkeypatch, tmp_path, capsys):
+    monkeypatch.setenv("PRIVATEER_CACHE_DIR", str(tmp_path))
+    cfg = read_config("example/simple.json")
+    volume = MagicMock()
+    volume.name = "privateer_keys"
+    volume.attrs = {"CreatedAt": "2024-01-01T00:00:00Z"}
+    mock_string_from_volume = MagicMock(return_value="bob")
+    monkeypatch.setattr(
+        privateer.check, "volume_if_exists", MagicMock(return_value=volume)
+    )
+    monkeypatch.setattr(
+        privateer.check, "string_from_volume", mock_string_from_volume
+    )
+    check(cfg, "bob")
+    check(cfg, "bob")
+    assert mock_string_from_volume.call_count == 1
+    assert (tmp_path / "identity.json").exists()
+    assert capsys.readouterr().out == (
+        "Volume 'privateer_keys' looks configured as 'bob'\n" * 2
+    )
+
+    # A recreated volume must be checked again
+    volume.attrs = {"CreatedAt": "2024-02-01T00:00:00Z"}
+    check(cfg, "bob", quiet=True)
+    assert mock_string_from_volume.call_count == 2
+
+    # As must one that has been reconfigured
+    privateer.check.forget_identity("privateer_keys")
+    check(cfg, "bob", quiet=True)
+    assert mock_string_from_volume.call_count == 3
+
+    # A mismatch is not cached
+    privateer.check.forget_identity("privateer_keys")
+    mock_string_from_volume.return_value = "alice"
+    with pytest.raises(Exception, match="Configuration is for 'alice'"):
+        check(cfg, "bob")
+    with pytest.raises(Exception, match="Configuration is for 'alice'"):
+        check(cfg, "bob")
+    assert mock_string_from_volume.call_count == 5
+
+
+def test_can_skip_identity_check(monkeypatch, tmp_path, capsys):
+    monkeypatch.setenv("PRIVATEER_CACHE_DIR", str(tmp_path))
+    cfg = read_config("example/simple.json")
+    mock_string_from_volume = MagicMock()
+    monkeypatch.setattr(privateer.check, "volume_if_exists", MagicMock())
+    monkeypatch.setattr(
+        privateer.check, "string_from_volume", mock_string_from_volume
+    )
+    check(cfg, "bob", verify=False)
+    assert mock_string_from_volume.call_count == 0
+    assert not (tmp_path / "identity.json").exists()
+    assert capsys.readouterr().out == (
+        "Volume 'privateer_keys' exists (not verifying identity)\n"
+    )
+
+
+def test_corrupt_identity_cache_is_ignored(monkeypatch, tmp_path):
+    monkeypatch.setenv("PRIVATEER_CACHE_DIR", str(tmp_path))
+    (tmp_path / "identity.json").write_text("{not json")
+    assert privateer.check._read_identity_cache() == {}
+    privateer.check.forget_identity("privateer_keys")
@@ -1,17 +1,32 @@
+import json
 import shutil
+import subprocess
+import sys
 from unittest.mock import call
 
 import pytest
 from click.testing import CliRunner
 
+import privateer.backup
+import privateer.check
+import privateer.configure
+import privateer.keys
+import privateer.prune
+import privateer.restore
+import privateer.schedule
+import privateer.server
+import privateer.session
+import privateer.tar
+import privateer.vault
 from privateer import cli
+from privateer.check import ConnectionResult
 from privateer.config import read_config
 from privateer.configure import write_identity
 
 
 def test_can_run_keygen(tmp_path, mocker):
-    mocker.patch("privateer.cli.keygen_all")
-    mocker.patch("privateer.cli.keygen")
+    mocker.patch("privateer.keys.keygen_all")
+    mocker.patch("privateer.keys.keygen")
     runner = CliRunner()
     shutil.copy("example/simple.json", tmp_path / "privateer.json")
 
@@ -19,24 +34,41 @@ def test_can_run_keygen(tmp_path, mocker):
     cfg = read_config(tmp_path / "privateer.json")
     assert res.exit_code == 1
     assert "Expected a name to be provided" in str(res.exception)
-    assert cli.keygen.call_count == 0
+    assert privateer.keys.keygen.call_count == 0
 
     res = runner.invoke(cli.cli_keygen, ["--path", tmp_path, "alice"])
     cfg = read_config(tmp_path / "privateer.json")
     assert res.exit_code == 0
-    assert cli.keygen.call_count == 1
-    assert cli.keygen.mock_calls[0] == call(cfg, "alice")
+    assert privateer.keys.keygen.call_count == 1
+    assert privateer.keys.keygen.mock_calls[0] == call(cfg, "alice")
 
     res = runner.invoke(cli.cli_keygen, ["--path", tmp_path, "--all"])
     cfg = read_config(tmp_path / "privateer.json")
     assert res.exit_code == 0
-    assert cli.keygen_all.call_count == 1
-    assert cli.keygen_all.mock_calls[0] == call(cfg)
+    assert privateer.keys.keygen_all.call_count == 1
+    assert privateer.keys.keygen_all.mock_calls[0] == call(cfg, jobs=8)
+
+    res = runner.invoke(
+        cli.cli_keygen, ["--path", tmp_path, "--all", "--jobs", "2"]
+    )
+    assert res.exit_code == 0
+    assert privateer.keys.keygen_all.mock_calls[1] == call(cfg, jobs=2)
+
+
+def test_can_logout_of_vault(tmp_path, mocker):
+    mocker.patch("privateer.vault.vault_logout")
+    runner = CliRunner()
+    shutil.copy("example/simple.json", tmp_path / "privateer.json")
+    cfg = read_config(tmp_path / "privateer.json")
+
+    res = runner.invoke(cli.cli_vault, ["logout", "--path", tmp_path])
+    assert res.exit_code == 0
+    assert privateer.vault.vault_logout.mock_calls == [call(cfg.vault.url)]
 
 
 def test_disallow_both_name_and_all(tmp_path, mocker):
-    mocker.patch("privateer.cli.keygen_all")
-    mocker.patch("privateer.cli.keygen")
+    mocker.patch("privateer.keys.keygen_all")
+    mocker.patch("privateer.keys.keygen")
     runner = CliRunner()
     shutil.copy("example/simple.json", tmp_path / "privateer.json")
 
@@ -47,14 +79,14 @@ def test_disallow_both_name_and_all(tmp_path, mocker):
 
 
 def test_can_run_pull(tmp_path, mocker):
-    mocker.patch("privateer.cli.docker")
+    mocker.patch("privateer.session.docker_client")
     runner = CliRunner()
     shutil.copy("example/simple.json", tmp_path / "privateer.json")
 
     res = runner.invoke(cli.cli_pull, ["--path", tmp_path])
     assert res.exit_code == 0
-    assert cli.docker.from_env.call_count == 1
-    client = cli.docker.from_env.return_value
+    assert privateer.session.docker_client.call_count == 1
+    client = privateer.session.docker_client.return_value
     assert client.images.pull.call_count == 2
     assert client.images.pull.mock_calls[0] == call(
         "mrcide/privateer-client:latest"
@@ -65,7 +97,7 @@ def test_can_run_pull(tmp_path, mocker):
 
 
 def test_can_run_configure(tmp_path, mocker):
-    mocker.patch("privateer.cli.configure")
+    mocker.patch("privateer.configure.configure")
     runner = CliRunner()
     shutil.copy("example/simple.json", tmp_path / "privateer.json")
 
@@ -78,12 +110,12 @@ def test_can_run_configure(tmp_path, mocker):
     with dest.open() as f:
         assert f.read().strip() == "alice"
 
-    assert cli.configure.call_count == 1
-    assert cli.configure.mock_calls[0] == call(cfg, "alice")
+    assert privateer.configure.configure.call_count == 1
+    assert privateer.configure.configure.mock_calls[0] == call(cfg, "alice")
 
 
 def test_can_call_check(tmp_path, mocker):
-    mocker.patch("privateer.cli.check")
+    mocker.patch("privateer.check.check")
     runner = CliRunner()
     shutil.copy("example/simple.json", tmp_path / "privateer.json")
     write_identity(tmp_path, "alice")
@@ -92,14 +124,64 @@ def test_can_call_check(tmp_path, mocker):
 
     res = runner.invoke(cli.cli_check, ["--path", tmp_path, "--connection"])
     assert res.exit_code == 0
-    assert cli.check.call_count == 1
-    assert cli.check.mock_calls[0] == call(
-        cfg=cfg, name="alice", connection=True
+    assert privateer.check.check.call_count == 1
+    assert privateer.check.check.mock_calls[0] == call(
+        cfg=cfg, name="alice", connection=True, bandwidth=False
+    )
+
+    res = runner.invoke(cli.cli_check, ["--path", tmp_path, "--bandwidth"])
+    assert res.exit_code == 0
+    assert privateer.check.check.mock_calls[1] == call(
+        cfg=cfg, name="alice", connection=True, bandwidth=True
     )
 
 
+def test_can_print_connection_check_as_json(tmp_path, mocker):
+    mocker.patch("privateer.check.check_client")
+    mocker.patch(
+        "privateer.check.check_connections",
+        return_value=[
+            ConnectionResult(
+                server="alice",
+                hostname="alice.example.com",
+                success=True,
+                latency=0.035,
+            )
+        ],
+    )
+    runner = CliRunner()
+    shutil.copy("example/simple.json", tmp_path / "privateer.json")
+    write_identity(tmp_path, "bob")
+    cfg = read_config(tmp_path / "privateer.json")
+
+    res = runner.invoke(
+        cli.cli_check, ["--path", tmp_path, "--connection", "--json"]
+    )
+    assert res.exit_code == 0
+    assert privateer.check.check_client.mock_calls[0] == call(
+        cfg=cfg, name="bob", quiet=True
+    )
+    assert privateer.check.check_connections.mock_calls[0] == call(
+        cfg, privateer.check.check_client.return_value, bandwidth=False
+    )
+    assert json.loads(res.output) == [
+        {
+            "server": "alice",
+            "hostname": "alice.example.com",
+            "success": True,
+            "latency": 0.035,
+            "throughput": None,
+            "error": None,
+        }
+    ]
+
+    res = runner.invoke(cli.cli_check, ["--path", tmp_path, "--json"])
+    assert res.exit_code == 1
+    assert "'--json' requires '--connection'" in str(res.exception)
+
+
 def test_can_call_backup(tmp_path, mocker):
-    mocker.patch("privateer.cli.backup")
+    mocker.patch("privateer.backup.backup")
     runner = CliRunner()
     shutil.copy("example/simple.json", tmp_path / "privateer.json")
     write_identity(tmp_path, "alice")
@@ -107,14 +189,97 @@ def test_can_call_backup(tmp_path, mocker):
 
     res = runner.invoke(cli.cli_backup, ["--path", tmp_path, "data"])
     assert res.exit_code == 0
-    assert cli.backup.call_count == 1
-    assert cli.backup.mock_calls[0] == call(
-        cfg=cfg, name="alice", volume="data", server=None, dry_run=False
+    assert privateer.backup.backup.call_count == 1
+    assert privateer.backup.backup.mock_calls[0] == call(
+        cfg=cfg,
+        name="alice",
+        volume="data",
+        server=None,
+        log_dir=None,
+        verify=True,
+        dry_run=False,
+    )
+
+    logs = tmp_path / "logs"
+    res = runner.invoke(
+        cli.cli_backup, ["--path", tmp_path, "--log-dir", logs, "data"]
+    )
+    assert res.exit_code == 0
+    assert privateer.backup.backup.mock_calls[1].kwargs["log_dir"] == logs
+
+    res = runner.invoke(
+        cli.cli_backup, ["--path", tmp_path, "--no-verify", "data"]
+    )
+    assert res.exit_code == 0
+    assert privateer.backup.backup.mock_calls[2].kwargs["verify"] is False
+
+
+def test_can_call_backup_to_all_servers(tmp_path, mocker):
+    mocker.patch("privateer.backup.backup")
+    mocker.patch("privateer.backup.backup_to_all_servers")
+    runner = CliRunner()
+    shutil.copy("example/simple.json", tmp_path / "privateer.json")
+    write_identity(tmp_path, "alice")
+    cfg = read_config(tmp_path / "privateer.json")
+
+    args = ["--path", tmp_path, "--server", "all", "--batch", "data"]
+    res = runner.invoke(cli.cli_backup, args)
+    assert res.exit_code == 0
+    assert privateer.backup.backup.call_count == 0
+    assert privateer.backup.backup_to_all_servers.call_count == 1
+    assert privateer.backup.backup_to_all_servers.mock_calls[0] == call(
+        cfg=cfg,
+        name="alice",
+        volume="data",
+        batch=True,
+        log_dir=None,
+        verify=True,
+        dry_run=False,
+    )
+
+    args = ["--path", tmp_path, "--server", "alice", "--batch", "data"]
+    res = runner.invoke(cli.cli_backup, args)
+    assert res.exit_code == 1
+    assert "'--batch' requires '--server=all'" in str(res.exception)
+    assert privateer.backup.backup.call_count == 0
+
+
+def test_can_call_backup_all(tmp_path, mocker):
+    mocker.patch("privateer.backup.backup")
+    mocker.patch("privateer.backup.backup_all")
+    runner = CliRunner()
+    shutil.copy("example/simple.json", tmp_path / "privateer.json")
+    write_identity(tmp_path, "bob")
+    cfg = read_config(tmp_path / "privateer.json")
+
+    res = runner.invoke(
+        cli.cli_backup, ["--path", tmp_path, "--all", "--jobs", "2"]
+    )
+    assert res.exit_code == 0
+    assert privateer.backup.backup.call_count == 0
+    assert privateer.backup.backup_all.call_count == 1
+    assert privateer.backup.backup_all.mock_calls[0] == call(
+        cfg=cfg,
+        name="bob",
+        server=None,
+        jobs=2,
+        batch=False,
+        log_dir=None,
+        verify=True,
+        dry_run=False,
     )
 
+    res = runner.invoke(cli.cli_backup, ["--path", tmp_path, "--all", "data"])
+    assert res.exit_code == 1
+    assert "Don't provide 'volume'" in str(res.exception)
+
+    res = runner.invoke(cli.cli_backup, ["--path", tmp_path])
+    assert res.exit_code == 1
+    assert "Expected a volume to be provided" in str(res.exception)
+
 
 def test_can_call_restore(tmp_path, mocker):
-    mocker.patch("privateer.cli.restore")
+    mocker.patch("privateer.restore.restore")
     runner = CliRunner()
     shutil.copy("example/simple.json", tmp_path / "privateer.json")
     write_identity(tmp_path, "bob")
@@ -122,31 +287,40 @@ def test_can_call_restore(tmp_path, mocker):
 
     res = runner.invoke(cli.cli_restore, ["--path", tmp_path, "data"])
     assert res.exit_code == 0
-    assert cli.restore.call_count == 1
-    assert cli.restore.mock_calls[0] == call(
+    assert privateer.restore.restore.call_count == 1
+    assert privateer.restore.restore.mock_calls[0] == call(
         cfg=cfg,
         name="bob",
         volume="data",
         server=None,
         source=None,
         to_volume=None,
+        generation=None,
+        log_dir=None,
+        verify=True,
         dry_run=False,
     )
 
 
 def test_can_call_export_of_local_volume(mocker):
-    mocker.patch("privateer.cli.export_tar_local")
+    mocker.patch("privateer.tar.export_tar_local")
     runner = CliRunner()
     res = runner.invoke(cli.cli_export, ["--source", "local", "data"])
     assert res.exit_code == 0
-    assert cli.export_tar_local.call_count == 1
-    assert cli.export_tar_local.mock_calls[0] == call(
-        volume="data", to_dir=None, dry_run=False
+    assert privateer.tar.export_tar_local.call_count == 1
+    assert privateer.tar.export_tar_local.mock_calls[0] == call(
+        volume="data",
+        to_dir=None,
+        compress=None,
+        threads=None,
+        split=None,
+        incremental=False,
+        dry_run=False,
     )
 
 
 def test_can_export_a_volume(tmp_path, mocker):
-    mocker.patch("privateer.cli.export_tar")
+    mocker.patch("privateer.tar.export_tar")
     runner = CliRunner()
     shutil.copy("example/simple.json", tmp_path / "privateer.json")
     write_identity(tmp_path, "bob")
@@ -154,33 +328,120 @@ def test_can_export_a_volume(tmp_path, mocker):
 
     res = runner.invoke(cli.cli_export, ["--path", tmp_path, "data"])
     assert res.exit_code == 0
-    assert cli.export_tar.call_count == 1
-    assert cli.export_tar.mock_calls[0] == call(
+    assert privateer.tar.export_tar.call_count == 1
+    assert privateer.tar.export_tar.mock_calls[0] == call(
         cfg=cfg,
         name=None,
         volume="data",
         to_dir=None,
         source=None,
+        compress=None,
+        threads=None,
+        split=None,
+        incremental=False,
+        verify=True,
         dry_run=False,
     )
 
+    args = ["--path", tmp_path, "--compress", "zstd", "--threads", "4", "data"]
+    res = runner.invoke(cli.cli_export, args)
+    assert res.exit_code == 0
+    assert privateer.tar.export_tar.mock_calls[1].kwargs["compress"] == "zstd"
+    assert privateer.tar.export_tar.mock_calls[1].kwargs["threads"] == 4
+
+    args = ["--path", tmp_path, "--split", "1024", "data"]
+    res = runner.invoke(cli.cli_export, args)
+    assert res.exit_code == 0
+    assert privateer.tar.export_tar.mock_calls[2].kwargs["split"] == 1024
+
+    args = ["--path", tmp_path, "--incremental", "data"]
+    res = runner.invoke(cli.cli_export, args)
+    assert res.exit_code == 0
+    assert privateer.tar.export_tar.mock_calls[3].kwargs["incremental"]
+
+    res = runner.invoke(cli.cli_export, ["--compress", "xz", "data"])
+    assert res.exit_code == 2
+    assert privateer.tar.export_tar.call_count == 4
+
+
+def test_cant_export_volume_with_generations_incrementally(tmp_path, mocker):
+    mocker.patch("privateer.tar.export_tar")
+    runner = CliRunner()
+    with open("example/simple.json") as f:
+        data = json.load(f)
+    data["volumes"][0]["generations"] = True
+    with open(tmp_path / "privateer.json", "w") as f:
+        json.dump(data, f)
+    write_identity(tmp_path, "bob")
+    args = ["--path", tmp_path, "--incremental", "data"]
+    res = runner.invoke(cli.cli_export, args)
+    assert res.exit_code == 1
+    assert "Can't use '--incremental' with 'data'" in str(res.exception)
+    assert privateer.tar.export_tar.call_count == 0
+
+
+def test_can_export_a_volume_from_a_server(tmp_path, mocker):
+    mocker.patch("privateer.tar.export_tar_remote")
+    runner = CliRunner()
+    shutil.copy("example/simple.json", tmp_path / "privateer.json")
+    write_identity(tmp_path, "bob")
+    cfg = read_config(tmp_path / "privateer.json")
+
+    args = ["--path", tmp_path, "--server", "alice", "--compress", "gzip"]
+    res = runner.invoke(cli.cli_export, [*args, "data"])
+    assert res.exit_code == 0
+    assert privateer.tar.export_tar_remote.call_count == 1
+    assert privateer.tar.export_tar_remote.mock_calls[0] == call(
+        cfg=cfg,
+        name="bob",
+        volume="data",
+        server="alice",
+        to_dir=None,
+        source=None,
+        compress="gzip",
+        threads=None,
+        verify=True,
+        dry_run=False,
+    )
+
+    args = ["--path", tmp_path, "--server", "alice", "--split", "10", "data"]
+    res = runner.invoke(cli.cli_export, args)
+    assert res.exit_code == 1
+    assert "Can't use '--split' or '--incremental'" in str(res.exception)
+    assert privateer.tar.export_tar_remote.call_count == 1
+
 
 def test_can_import_a_volume(mocker):
-    mocker.patch("privateer.cli.import_tar")
+    mocker.patch("privateer.tar.import_tar")
     runner = CliRunner()
 
     res = runner.invoke(cli.cli_import, ["file.tar", "data"])
     assert res.exit_code == 0
-    assert cli.import_tar.call_count == 1
-    assert cli.import_tar.mock_calls[0] == call(
-        volume="data", tarfile="file.tar", dry_run=False
+    assert privateer.tar.import_tar.call_count == 1
+    assert privateer.tar.import_tar.mock_calls[0] == call(
+        volume="data", tarfile="file.tar", incremental=[], dry_run=False
     )
 
+    args = ["full.tar", "inc1.tar", "inc2.tar", "data"]
+    res = runner.invoke(cli.cli_import, args)
+    assert res.exit_code == 0
+    assert privateer.tar.import_tar.call_count == 2
+    assert privateer.tar.import_tar.mock_calls[1] == call(
+        volume="data",
+        tarfile="full.tar",
+        incremental=["inc1.tar", "inc2.tar"],
+        dry_run=False,
+    )
+
+    res = runner.invoke(cli.cli_import, ["data"])
+    assert res.exit_code == 2
+    assert privateer.tar.import_tar.call_count == 2
+
 
 def test_can_interact_with_server(tmp_path, mocker):
-    mocker.patch("privateer.cli.server_start")
-    mocker.patch("privateer.cli.server_stop")
-    mocker.patch("privateer.cli.server_status")
+    mocker.patch("privateer.server.server_start")
+    mocker.patch("privateer.server.server_stop")
+    mocker.patch("privateer.server.server_status")
     runner = CliRunner()
     shutil.copy("example/simple.json", tmp_path / "privateer.json")
     write_identity(tmp_path, "alice")
@@ -188,26 +449,45 @@ def test_can_interact_with_server(tmp_path, mocker):
 
     res = runner.invoke(cli.cli_server, ["--path", tmp_path, "start"])
     assert res.exit_code == 0
-    assert cli.server_start.call_count == 1
-    assert cli.server_start.mock_calls[0] == call(
-        cfg=cfg, name=None, dry_run=False
+    assert privateer.server.server_start.call_count == 1
+    assert privateer.server.server_start.mock_calls[0] == call(
+        cfg=cfg, name=None, verify=True, dry_run=False
     )
 
     res = runner.invoke(cli.cli_server, ["--path", tmp_path, "status"])
     assert res.exit_code == 0
-    assert cli.server_status.call_count == 1
-    assert cli.server_status.mock_calls[0] == call(cfg=cfg, name=None)
+    assert privateer.server.server_status.call_count == 1
+    assert privateer.server.server_status.mock_calls[0] == call(
+        cfg=cfg, name=None
+    )
 
     res = runner.invoke(cli.cli_server, ["--path", tmp_path, "stop"])
     assert res.exit_code == 0
-    assert cli.server_stop.call_count == 1
-    assert cli.server_stop.mock_calls[0] == call(cfg=cfg, name=None)
+    assert privateer.server.server_stop.call_count == 1
+    assert privateer.server.server_stop.mock_calls[0] == call(
+        cfg=cfg, name=None
+    )
+
+
+def test_can_call_prune(tmp_path, mocker):
+    mocker.patch("privateer.prune.prune")
+    runner = CliRunner()
+    shutil.copy("example/simple.json", tmp_path / "privateer.json")
+    write_identity(tmp_path, "alice")
+    cfg = read_config(tmp_path / "privateer.json")
+
+    res = runner.invoke(cli.cli_prune, ["--path", tmp_path, "--dry-run"])
+    assert res.exit_code == 0
+    assert privateer.prune.prune.call_count == 1
+    assert privateer.prune.prune.mock_calls[0] == call(
+        cfg=cfg, name="alice", jobs=4, dry_run=True
+    )
 
 
 def test_can_interact_with_schedule(tmp_path, mocker):
-    mocker.patch("privateer.cli.schedule_start")
-    mocker.patch("privateer.cli.schedule_stop")
-    mocker.patch("privateer.cli.schedule_status")
+    mocker.patch("privateer.schedule.schedule_start")
+    mocker.patch("privateer.schedule.schedule_stop")
+    mocker.patch("privateer.schedule.schedule_status")
     runner = CliRunner()
     shutil.copy("example/simple.json", tmp_path / "privateer.json")
     write_identity(tmp_path, "alice")
@@ -215,20 +495,24 @@ def test_can_interact_with_schedule(tmp_path, mocker):
 
     res = runner.invoke(cli.cli_schedule, ["--path", tmp_path, "start"])
     assert res.exit_code == 0
-    assert cli.schedule_start.call_count == 1
-    assert cli.schedule_start.mock_calls[0] == call(
-        cfg=cfg, name=None, dry_run=False
+    assert privateer.schedule.schedule_start.call_count == 1
+    assert privateer.schedule.schedule_start.mock_calls[0] == call(
+        cfg=cfg, name=None, verify=True, dry_run=False
     )
 
     res = runner.invoke(cli.cli_schedule, ["--path", tmp_path, "status"])
     assert res.exit_code == 0
-    assert cli.schedule_status.call_count == 1
-    assert cli.schedule_status.mock_calls[0] == call(cfg=cfg, name=None)
+    assert privateer.schedule.schedule_status.call_count == 1
+    assert privateer.schedule.schedule_status.mock_calls[0] == call(
+        cfg=cfg, name=None
+    )
 
     res = runner.invoke(cli.cli_schedule, ["--path", tmp_path, "stop"])
     assert res.exit_code == 0
-    assert cli.schedule_stop.call_count == 1
-    assert cli.schedule_stop.mock_calls[0] == call(cfg=cfg, name=None)
+    assert privateer.schedule.schedule_stop.call_count == 1
+    assert privateer.schedule.schedule_stop.mock_calls[0] == call(
+        cfg=cfg, name=None
+    )
 
 
 def test_can_read_identity(tmp_path):
@@ -239,3 +523,24 @@ def test_can_read_identity(tmp_path):
     with path.open("w") as f:
         f.write("alice\n")
     assert cli._find_identity(None, tmp_path) == "alice"
+
+
+@pytest.mark.parametrize(
+    "args",
+    [None, ["--help"], ["keygen", "--help"], ["vault", "logout", "--help"]],
+)
+def test_cli_import_is_lightweight(args):
+    # Run in a fresh interpreter, as this one has imported everything.
+    # Running a command enters the cli group, which sets up the docker
+    # session, so this must not import docker either.
+    code = "import sys, privateer.cli"
+    if args is not None:
+        code += f"; privateer.cli.cli({args!r}, standalone_mode=False)"
+    code += "; print(' '.join(sorted(m for m in sys.modules if '.' not in m)))"
+    res = subprocess.run(  # noqa: S603
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    # Any help text comes first; the modules are on the last line
+    loaded = set(res.stdout.splitlines()[-1].split())
+    heavy = {"docker", "hvac", "cryptography", "yacron", "pydantic"}
+    assert not heavy & loaded
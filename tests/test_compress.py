@@ -0,0 +1,76 @@
+import gzip
+import io
+import os
+
+import pytest
+import zstandard
+
+from privateer.compress import (
+    ParallelGzipWriter,
+    check_compression,
+    compressed_writer,
+    decompressed_chunks,
+    detect_compression,
+    tar_extension,
+)
+
+
+def test_can_validate_compression():
+    check_compression(None)
+    check_compression("gzip")
+    check_compression("zstd")
+    msg = "Invalid compression 'xz', must be one of 'gzip', 'zstd'"
+    with pytest.raises(Exception, match=msg):
+        check_compression("xz")
+
+
+def test_can_get_extension():
+    assert tar_extension(None) == ".tar"
+    assert tar_extension("gzip") == ".tar.gz"
+    assert tar_extension("zstd") == ".tar.zst"
+
+
+@pytest.mark.parametrize("threads", [1, 4])
+def test_parallel_gzip_output_is_valid_gzip(threads):
+    data = os.urandom(1000) * 50
+    buf = io.BytesIO()
+    w = ParallelGzipWriter(buf, threads=threads, block_size=4096)
+    for i in range(0, len(data), 3000):
+        w.write(data[i : i + 3000])
+    w.close()
+    assert gzip.decompress(buf.getvalue()) == data
+    # One gzip member per block
+    assert buf.getvalue().count(b"\x1f\x8b\x08") >= len(data) // 4096
+
+
+def test_parallel_gzip_of_nothing_is_valid_gzip():
+    buf = io.BytesIO()
+    ParallelGzipWriter(buf).close()
+    assert gzip.decompress(buf.getvalue()) == b""
+
+
+@pytest.mark.parametrize("method", [None, "gzip", "zstd"])
+@pytest.mark.parametrize("threads", [1, 2])
+def test_can_round_trip_through_compression(tmp_path, method, threads):
+    data = b"".join(f"line {i}\n".encode() for i in range(100000))
+    path = tmp_path / "file"
+    with (
+        open(path, "wb") as f,
+        compressed_writer(f, method, threads=threads) as w,
+    ):
+        w.write(data[:1000])
+        w.write(data[1000:])
+    assert detect_compression(path) == method
+    if method:
+        assert path.stat().st_size < len(data)
+    chunks = list(decompressed_chunks(path, method, chunk_size=65536))
+    assert max(len(x) for x in chunks) <= 65536
+    assert b"".join(chunks) == data
+
+
+def test_can_read_concatenated_zstd_frames(tmp_path):
+    cctx = zstandard.ZstdCompressor()
+    path = tmp_path / "file.zst"
+    path.write_bytes(cctx.compress(b"hello ") + cctx.compress(b"world"))
+    assert detect_compression(path) == "zstd"
+    assert b"".join(decompressed_chunks(path, "zstd")) == b"hello world"
@@ -4,7 +4,13 @@ from pathlib import Path
 import pytest
 import vault_dev
 
-from privateer.config import _check_config, read_config
+from privateer.config import (
+    LargeFiles,
+    Retention,
+    Transfer,
+    _check_config,
+    read_config,
+)
 from privateer.root import find_source, privateer_root
 from privateer.util import transient_working_directory
 
@@ -40,8 +46,7 @@ def test_can_create_vault_client():
 def test_validation_is_run_on_load(tmp_path):
     path = tmp_path / "privateer.json"
     with path.open("w") as f:
-        f.write(
-            """{
+        f.write("""{
     "servers": [
         {
             "name": "alice",
@@ -68,8 +73,7 @@ def test_validation_is_run_on_load(tmp_path):
         "url": "http://localhost:8200",
         "prefix": "/secret/privateer"
     }
-}"""
-        )
+}""")
     msg = "Invalid machine listed as both a client and a server: 'alice'"
     with pytest.raises(Exception, match=msg):
         read_config(path)
@@ -85,6 +89,17 @@ def test_machines_cannot_be_duplicated():
         _check_config(cfg)
 
 
+def test_key_type_is_validated():
+    cfg = read_config("example/simple.json")
+    assert cfg.key_type == "ed25519"
+    cfg.key_type = "rsa"
+    _check_config(cfg)
+    cfg.key_type = "dsa"
+    msg = "Invalid key_type 'dsa', must be one of 'ed25519', 'rsa'"
+    with pytest.raises(Exception, match=msg):
+        _check_config(cfg)
+
+
 def test_machines_cannot_be_client_and_server():
     cfg = read_config("example/simple.json")
     tmp = cfg.clients[0].model_copy()
@@ -95,6 +110,14 @@ def test_machines_cannot_be_client_and_server():
         _check_config(cfg)
 
 
+def test_servers_cannot_be_called_all():
+    cfg = read_config("example/simple.json")
+    cfg.servers[0].name = "all"
+    msg = "Invalid server name 'all', as this is reserved"
+    with pytest.raises(Exception, match=msg):
+        _check_config(cfg)
+
+
 def test_backup_volumes_are_known():
     cfg = read_config("example/simple.json")
     cfg.clients[0].backup.append("other")
@@ -111,6 +134,102 @@ def test_local_volumes_cannot_be_backed_up():
         _check_config(cfg)
 
 
+def test_local_volumes_cannot_have_generations():
+    cfg = read_config("example/local.json")
+    cfg.volumes[1].generations = True
+    msg = "Local volume 'other' cannot have generations"
+    with pytest.raises(Exception, match=msg):
+        _check_config(cfg)
+
+
+def test_retention_requires_generations():
+    cfg = read_config("example/simple.json")
+    cfg.volumes[0].retention = Retention(daily=7)
+    msg = "Volume 'data' has a retention policy but no generations"
+    with pytest.raises(Exception, match=msg):
+        _check_config(cfg)
+    cfg.volumes[0].generations = True
+    _check_config(cfg)
+
+
+def test_parallel_must_be_positive():
+    cfg = read_config("example/simple.json")
+    cfg.volumes[0].parallel = 0
+    msg = "Volume 'data' must have 'parallel' of at least 1"
+    with pytest.raises(Exception, match=msg):
+        _check_config(cfg)
+
+
+def test_large_files_are_validated():
+    cfg = read_config("example/simple.json")
+    cfg.volumes[0].large_files = LargeFiles(chunk=0)
+    msg = "Volume 'data' must have 'large_files.chunk' of at least 1"
+    with pytest.raises(Exception, match=msg):
+        _check_config(cfg)
+    cfg.volumes[0].large_files = LargeFiles()
+    _check_config(cfg)
+    cfg.volumes[0].generations = True
+    msg = "Volume 'data' cannot use large_files with generations"
+    with pytest.raises(Exception, match=msg):
+        _check_config(cfg)
+
+
+def test_can_convert_transfer_to_rsync_args():
+    assert Transfer().rsync_args() == []
+    t = Transfer(
+        compress="zstd",
+        compress_level=3,
+        checksum="xxh128",
+        inplace=True,
+        whole_file=True,
+        exclude=["*.tmp", "cache/"],
+    )
+    assert t.rsync_args() == [
+        "--compress",
+        "--compress-choice=zstd",
+        "--compress-level=3",
+        "--checksum-choice=xxh128",
+        "--inplace",
+        "--whole-file",
+        "--exclude=*.tmp",
+        "--exclude=cache/",
+    ]
+    assert Transfer(compress_level=1).rsync_args() == [
+        "--compress",
+        "--compress-level=1",
+    ]
+
+
+def test_inplace_transfer_not_allowed_with_generations():
+    cfg = read_config("example/simple.json")
+    cfg.volumes[0].transfer = Transfer(inplace=True)
+    _check_config(cfg)
+    cfg.volumes[0].generations = True
+    msg = "Volume 'data' cannot use 'inplace' with generations"
+    with pytest.raises(Exception, match=msg):
+        _check_config(cfg)
+
+
+def test_can_get_volume_config():
+    cfg = read_config("example/local.json")
+    assert cfg.volume_config("other").local
+    with pytest.raises(Exception, match="Unknown volume 'missing'"):
+        cfg.volume_config("missing")
+
+
+def test_lookups_follow_changes_to_config():
+    cfg = read_config("example/local.json")
+    cfg.volumes[1].name = "renamed"
+    assert cfg.volume_config("renamed") is cfg.volumes[1]
+    with pytest.raises(Exception, match="Unknown volume 'other'"):
+        cfg.volume_config("other")
+    tmp = cfg.clients[0].model_copy()
+    tmp.name = "carol"
+    cfg.clients.append(tmp)
+    assert cfg.machine_config("carol") is tmp
+    assert cfg.machine_config("alice") is cfg.servers[0]
+
+
 def test_can_find_appropriate_source():
     cfg = read_config("example/simple.json")
     tmp = cfg.clients[0].model_copy()
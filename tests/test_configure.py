@@ -1,7 +1,10 @@
+from unittest.mock import MagicMock, call
+
 import docker
 import pytest
 import vault_dev
 
+import privateer.configure
 from privateer.check import check
 from privateer.config import read_config
 from privateer.configure import configure
@@ -99,3 +102,38 @@ def test_can_write_schedule_for_client(managed_docker):
         schedule = string_from_volume(vol, "yacron.yml")
         expected = generate_yacron_yaml(cfg, "bob")
         assert schedule == "".join([x + "\n" for x in expected])
+
+
+def test_configure_writes_all_files_at_once(monkeypatch):
+    cfg = read_config("example/simple.json")
+    keys = {
+        "public": "pub",
+        "private": "priv",
+        "authorized_keys": None,
+        "known_hosts": "hosts",
+        "config": "cfg",
+    }
+    mock_session = MagicMock()
+    mock_write = MagicMock()
+    monkeypatch.setattr(
+        privateer.configure,
+        "current_session",
+        MagicMock(return_value=mock_session),
+    )
+    monkeypatch.setattr(
+        privateer.configure, "keys_data", MagicMock(return_value=keys)
+    )
+    monkeypatch.setattr(privateer.configure, "strings_to_volume", mock_write)
+    configure(cfg, "bob")
+    assert mock_write.call_count == 1
+    files, vol = mock_write.call_args[0]
+    assert vol == "privateer_keys"
+    assert files == [
+        ("id_rsa.pub", "pub", {"mode": 0o644}),
+        ("id_rsa", "priv", {"mode": 0o600}),
+        ("known_hosts", "hosts", {}),
+        ("config", "cfg", {}),
+        ("name", "bob", {}),
+    ]
+    assert mock_write.call_args[1] == {"uid": 0, "gid": 0, "mode": 0o600}
+    assert mock_session.create_volume.call_args == call("privateer_keys")
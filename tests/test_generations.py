@@ -0,0 +1,66 @@
+import datetime as dt
+
+import pytest
+
+from privateer.config import Retention, read_config
+from privateer.generations import (
+    expired_generations,
+    has_generations,
+    server_volume_path,
+)
+
+
+def test_can_find_path_to_volume_without_generations():
+    cfg = read_config("example/simple.json")
+    assert not has_generations(cfg, "data")
+    assert server_volume_path(cfg, "bob", "data") == "bob/data"
+    msg = "Volume 'data' does not keep generations"
+    with pytest.raises(Exception, match=msg):
+        server_volume_path(cfg, "bob", "data", generation="20240101-120000")
+
+
+def test_can_find_path_to_volume_with_generations():
+    cfg = read_config("example/simple.json")
+    cfg.volumes[0].generations = True
+    assert has_generations(cfg, "data")
+    assert server_volume_path(cfg, "bob", "data") == "bob/data/latest"
+    assert (
+        server_volume_path(cfg, "bob", "data", generation="20240101-120000")
+        == "bob/data/20240101-120000"
+    )
+
+
+def test_expire_nothing_without_rules():
+    names = ["20240101-000000", "20240102-000000", "latest", "other"]
+    assert expired_generations(names, Retention()) == ["20240101-000000"]
+    assert expired_generations([], Retention()) == []
+    assert expired_generations(["latest"], Retention()) == []
+
+
+def test_can_keep_last_generations():
+    names = [f"202401{d:02}-120000" for d in range(1, 11)]
+    res = expired_generations(names, Retention(keep_last=3))
+    assert res == names[:7]
+
+
+def test_can_keep_daily_weekly_and_monthly_generations():
+    # Four backups a day, every day through January and February 2024
+    days = [
+        dt.date(2024, 1, 1) + dt.timedelta(days=i)
+        for i in range(60)
+    ]
+    names = [
+        f"{d.strftime('%Y%m%d')}-{h:02}0000" for d in days for h in (0, 6, 12)
+    ]
+    res = expired_generations(names, Retention(daily=3))
+    kept = sorted(set(names) - set(res))
+    assert kept == ["20240227-120000", "20240228-120000", "20240229-120000"]
+
+    res = expired_generations(names, Retention(monthly=2))
+    kept = sorted(set(names) - set(res))
+    assert kept == ["20240131-120000", "20240229-120000"]
+
+    res = expired_generations(names, Retention(keep_last=2, weekly=2))
+    kept = sorted(set(names) - set(res))
+    # 2024-02-29 is a Thursday, 2024-02-25 a Sunday
+    assert kept == ["20240225-120000", "20240229-060000", "20240229-120000"]
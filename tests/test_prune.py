@@ -0,0 +1,100 @@
+from unittest.mock import MagicMock, call
+
+import pytest
+
+import privateer.prune
+from privateer.config import Retention, read_config
+from privateer.prune import prune
+
+
+def _du(sizes):
+    return "".join(f"{kb}\t{name}\n" for name, kb in sizes).encode()
+
+
+def _prune_config():
+    cfg = read_config("example/simple.json")
+    cfg.volumes[0].generations = True
+    cfg.volumes[0].retention = Retention(keep_last=2)
+    return cfg
+
+
+def test_can_prune_generations(capsys, monkeypatch):
+    cfg = _prune_config()
+    container = MagicMock()
+    container.status = "running"
+    gens = ["20240101-000000", "20240102-000000", "20240103-000000"]
+    ls = "\n".join([*gens, "latest"]).encode()
+    du = [(gens[1], 9000), (gens[2], 100), (gens[0], 2000)]
+    container.exec_run.side_effect = [
+        (0, ls),
+        (0, _du(du)),
+        (0, b""),
+    ]
+    monkeypatch.setattr(
+        privateer.prune, "check_server", MagicMock(return_value=cfg.servers[0])
+    )
+    monkeypatch.setattr(
+        privateer.prune,
+        "container_if_exists",
+        MagicMock(return_value=container),
+    )
+    res = prune(cfg, "alice", jobs=8)
+    assert len(res) == 1
+    assert res[0].source == "bob"
+    assert res[0].volume == "data"
+    assert res[0].removed == ["20240101-000000"]
+    assert res[0].freed == 2000 * 1024
+    assert container.exec_run.call_count == 3
+    assert container.exec_run.call_args_list[0] == call(
+        ["ls", "-1", "/privateer/volumes/bob/data"]
+    )
+    # Generations that are kept are listed first, so that files they
+    # share with the expired ones are not counted as freed
+    assert container.exec_run.call_args_list[1] == call(
+        ["du", "-sk", "--", gens[1], gens[2], gens[0]],
+        workdir="/privateer/volumes/bob/data",
+    )
+    script = (
+        "find 20240101-000000 -mindepth 1 -maxdepth 1 -print0 | "
+        "xargs -0 -r -n 1 -P 8 rm -rf && rm -rf 20240101-000000"
+    )
+    assert container.exec_run.call_args_list[2] == call(
+        ["sh", "-c", script], workdir="/privateer/volumes/bob/data"
+    )
+    out = capsys.readouterr().out
+    assert "Pruning 1 generations of 'data' from 'bob'" in out
+    assert "Freed 2.0 MiB" in out
+
+
+def test_can_list_generations_to_prune(capsys, monkeypatch):
+    cfg = _prune_config()
+    container = MagicMock()
+    container.status = "running"
+    gens = ["20240101-000000", "20240102-000000", "20240103-000000"]
+    container.exec_run.return_value = (0, "\n".join(gens).encode())
+    monkeypatch.setattr(
+        privateer.prune, "check_server", MagicMock(return_value=cfg.servers[0])
+    )
+    monkeypatch.setattr(
+        privateer.prune,
+        "container_if_exists",
+        MagicMock(return_value=container),
+    )
+    assert prune(cfg, "alice", dry_run=True) == []
+    assert container.exec_run.call_count == 1
+    out = capsys.readouterr().out
+    assert out == (
+        "Would prune generations of 'data' from 'bob':\n  20240101-000000\n"
+    )
+
+
+def test_prune_requires_running_server(monkeypatch):
+    cfg = _prune_config()
+    monkeypatch.setattr(
+        privateer.prune, "check_server", MagicMock(return_value=cfg.servers[0])
+    )
+    monkeypatch.setattr(
+        privateer.prune, "container_if_exists", MagicMock(return_value=None)
+    )
+    with pytest.raises(Exception, match="Server 'alice' is not running"):
+        prune(cfg, "alice")
@@ -1,11 +1,12 @@
-from unittest.mock import MagicMock, call
+from unittest.mock import ANY, MagicMock, call
 
 import docker
+import pytest
 import vault_dev
 
 import privateer.config
 import privateer.restore
-from privateer.config import read_config
+from privateer.config import Transfer, read_config
 from privateer.configure import configure
 from privateer.keys import keygen_all
 from privateer.restore import restore
@@ -29,7 +30,8 @@ def test_can_print_instructions_to_run_restore(capsys, managed_docker):
             "  docker run --rm "
             f"-v {vol}:/privateer/keys:ro -v data:/privateer/volumes/data "
             f"mrcide/privateer-client:{cfg.tag} "
-            "rsync -av --delete alice:/privateer/volumes/bob/data/ "
+            "rsync -av --delete --stats --info=progress2 "
+            "alice:/privateer/volumes/bob/data/ "
             "/privateer/volumes/data/"
         )
         assert cmd in lines
@@ -55,6 +57,8 @@ def test_can_run_restore(monkeypatch, managed_docker):
             "rsync",
             "-av",
             "--delete",
+            "--stats",
+            "--info=progress2",
             "alice:/privateer/volumes/bob/data/",
             "/privateer/volumes/data/",
         ]
@@ -71,7 +75,12 @@ def test_can_run_restore(monkeypatch, managed_docker):
         ]
         assert mock_run.call_count == 1
         assert mock_run.call_args == call(
-            "Restore", image, command=command, mounts=mounts
+            "Restore",
+            image,
+            command=command,
+            mounts=mounts,
+            follow=ANY,
+            log_file=None,
         )
 
 
@@ -93,7 +102,8 @@ def test_restore_from_local_volume(capsys, managed_docker):
             "  docker run --rm "
             f"-v {vol}:/privateer/keys:ro -v other:/privateer/volumes/other "
             f"mrcide/privateer-client:{cfg.tag} "
-            "rsync -av --delete alice:/privateer/local/other/ "
+            "rsync -av --delete --stats --info=progress2 "
+            "alice:/privateer/local/other/ "
             "/privateer/volumes/other/"
         )
         assert cmd in lines
@@ -122,7 +132,8 @@ def test_restore_from_alternative_source(capsys, managed_docker):
             "  docker run --rm "
             f"-v {vol_dan}:/privateer/keys:ro -v data:/privateer/volumes/data "
             f"mrcide/privateer-client:{cfg.tag} "
-            "rsync -av --delete carol:/privateer/volumes/bob/data/ "
+            "rsync -av --delete --stats --info=progress2 "
+            "carol:/privateer/volumes/bob/data/ "
             "/privateer/volumes/data/"
         )
         assert cmd in lines
@@ -137,7 +148,8 @@ def test_restore_from_alternative_source(capsys, managed_docker):
             f"-v {vol_dan}:/privateer/keys:ro "
             "-v other:/privateer/volumes/other "
             f"mrcide/privateer-client:{cfg.tag} "
-            "rsync -av --delete carol:/privateer/local/other/ "
+            "rsync -av --delete --stats --info=progress2 "
+            "carol:/privateer/local/other/ "
             "/privateer/volumes/other/"
         )
         assert cmd in lines
@@ -161,7 +173,55 @@ def test_can_restore_to_other_volume(capsys, managed_docker):
             "  docker run --rm "
             f"-v {vol}:/privateer/keys:ro -v other:/privateer/volumes/other "
             f"mrcide/privateer-client:{cfg.tag} "
-            "rsync -av --delete alice:/privateer/volumes/bob/data/ "
+            "rsync -av --delete --stats --info=progress2 "
+            "alice:/privateer/volumes/bob/data/ "
             "/privateer/volumes/other/"
         )
         assert cmd in lines
+
+
+def test_restore_uses_transfer_settings(monkeypatch):
+    cfg = read_config("example/simple.json")
+    cfg.volumes[0].transfer = Transfer(compress="zstd", whole_file=True)
+    mock_check = MagicMock(return_value=cfg.clients[0])
+    mock_run = MagicMock()
+    monkeypatch.setattr(privateer.restore, "check", mock_check)
+    monkeypatch.setattr(
+        privateer.restore, "run_container_with_command", mock_run
+    )
+    restore(cfg, "bob", "data")
+    assert mock_run.call_args[1]["command"] == [
+        "rsync",
+        "-av",
+        "--delete",
+        "--stats",
+        "--info=progress2",
+        "--compress",
+        "--compress-choice=zstd",
+        "--whole-file",
+        "alice:/privateer/volumes/bob/data/",
+        "/privateer/volumes/data/",
+    ]
+
+
+def test_restore_validates_generation(monkeypatch):
+    cfg = read_config("example/simple.json")
+    cfg.volumes[0].generations = True
+    mock_check = MagicMock(return_value=cfg.clients[0])
+    mock_run = MagicMock()
+    monkeypatch.setattr(privateer.restore, "check", mock_check)
+    monkeypatch.setattr(
+        privateer.restore, "run_container_with_command", mock_run
+    )
+    for generation in ["../../alice", "2024-01-01", "latest/.."]:
+        msg = f"Invalid generation '{generation}'"
+        with pytest.raises(Exception, match=msg):
+            restore(cfg, "bob", "data", generation=generation)
+    assert mock_run.call_count == 0
+    restore(cfg, "bob", "data", generation="latest")
+    restore(cfg, "bob", "data", generation="20240101-120000")
+    src = [x[1]["command"][-2] for x in mock_run.call_args_list]
+    assert src == [
+        "alice:/privateer/volumes/bob/data/latest/",
+        "alice:/privateer/volumes/bob/data/20240101-120000/",
+    ]
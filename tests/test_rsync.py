@@ -0,0 +1,119 @@
+import sys
+
+from privateer.rsync import (
+    RsyncMonitor,
+    TransferProgress,
+    TransferStats,
+    parse_progress,
+    parse_stats,
+)
+
+STATS = """sending incremental file list
+data/a
+
+Number of files: 1,234 (reg: 1,000, dir: 234)
+Number of created files: 1
+Number of deleted files: 0
+Number of regular files transferred: 12
+Total file size: 1,234,567 bytes
+Total transferred file size: 4,567 bytes
+Literal data: 4,567 bytes
+Matched data: 0 bytes
+File list size: 0
+File list generation time: 0.001 seconds
+File list transfer time: 0.000 seconds
+Total bytes sent: 5,000
+Total bytes received: 120
+
+sent 5,000 bytes  received 120 bytes  10,240.00 bytes/sec
+total size is 1,234,567  speedup is 241.13
+"""
+
+
+def test_can_parse_progress():
+    line = "  1,234,567  45%   12.34MB/s    0:01:23 (xfr#12, to-chk=34/100)"
+    assert parse_progress(line) == TransferProgress(
+        transferred=1234567, percent=45, rate="12.34MB/s", eta="0:01:23"
+    )
+    assert parse_progress("sending incremental file list") is None
+    assert parse_progress("data/a") is None
+
+
+def test_can_format_progress():
+    p = TransferProgress(
+        transferred=1536, percent=5, rate="1.00MB/s", eta="0:00:10"
+    )
+    assert str(p) == "1.5 KiB (5%), 1.00MB/s, ETA 0:00:10"
+
+
+def test_can_parse_stats():
+    stats = parse_stats(STATS)
+    assert stats == TransferStats(
+        files_transferred=12,
+        total_size=1234567,
+        transferred_size=4567,
+        bytes_sent=5000,
+        bytes_received=120,
+        speedup=1234567 / 5120,
+    )
+    assert str(stats) == (
+        "12 files transferred, 4.9 KiB sent, 120 B received (speedup 241.13)"
+    )
+
+
+def test_stats_are_summed_over_several_runs():
+    stats = parse_stats(STATS + "\r\n" + STATS)
+    assert stats.files_transferred == 24
+    assert stats.bytes_sent == 10000
+    assert stats.speedup == 1234567 / 5120
+
+
+def test_no_stats_if_none_in_output():
+    assert parse_stats("") is None
+    assert (
+        parse_stats("rsync error: some files could not be transferred") is None
+    )
+
+
+def test_can_print_progress_without_terminal(capsys):
+    monitor = RsyncMonitor(interval=3600)
+    monitor("data/a")
+    monitor("     32,768   0%    0.00kB/s    0:00:00 (xfr#1, to-chk=5/7)")
+    monitor("     65,536  50%    1.00MB/s    0:00:01 (xfr#2, to-chk=4/7)")
+    monitor.finish()
+    out = capsys.readouterr().out
+    assert out == "  32.0 KiB (0%), 0.00kB/s, ETA 0:00:00\n"
+    assert monitor.stats() is None
+
+
+def test_can_print_labelled_progress_on_terminal(capsys, monkeypatch):
+    lines = [
+        "     32,768   0%    0.00kB/s    0:00:00 (xfr#1, to-chk=5/7)",
+        "     65,536  50%    1.00MB/s    0:00:01 (xfr#2, to-chk=4/7)",
+    ]
+    monkeypatch.setattr(sys.stdout, "isatty", lambda: True)
+    monitor = RsyncMonitor(label="data -> alice")
+    for line in lines:
+        monitor(line)
+    monitor.finish()
+    out = capsys.readouterr().out
+    assert out == (
+        "\r  [data -> alice] 32.0 KiB (0%), 0.00kB/s, ETA 0:00:00\033[K"
+        "\r  [data -> alice] 64.0 KiB (50%), 1.00MB/s, ETA 0:00:01\033[K\n"
+    )
+
+    monitor = RsyncMonitor(label="data -> alice", live=False, interval=3600)
+    for line in lines:
+        monitor(line)
+    monitor.finish()
+    out = capsys.readouterr().out
+    assert out == "  [data -> alice] 32.0 KiB (0%), 0.00kB/s, ETA 0:00:00\n"
+
+
+def test_monitor_collects_stats_as_it_goes(capsys):
+    monitor = RsyncMonitor(quiet=True)
+    for line in STATS.split("\n"):
+        monitor("  1,024 100%  1.00MB/s    0:00:00 (xfr#1, to-chk=0/1)")
+        monitor(line)
+    assert monitor.stats() == parse_stats(STATS)
+    assert capsys.readouterr().out == ""
@@ -37,15 +37,15 @@ def test_can_create_command():
 
 
 def test_can_launch_container(monkeypatch):
-    mock_docker = MagicMock()
-    client = mock_docker.from_env.return_value
+    mock_docker_client = MagicMock()
+    client = mock_docker_client.return_value
     mock_exists = MagicMock()
     mock_exists.return_value = False
     mock_ensure_image = MagicMock()
     mounts = Mock()
     ports = Mock()
     command = Mock()
-    monkeypatch.setattr(privateer.service, "docker", mock_docker)
+    monkeypatch.setattr(privateer.service, "docker_client", mock_docker_client)
     monkeypatch.setattr(privateer.service, "container_exists", mock_exists)
     monkeypatch.setattr(privateer.service, "ensure_image", mock_ensure_image)
     service_start(
@@ -55,7 +55,7 @@ def test_can_launch_container(monkeypatch):
     assert mock_exists.call_args == call("nm")
     assert mock_ensure_image.call_count == 1
     assert mock_ensure_image.call_args == call("img")
-    assert mock_docker.from_env.call_count == 1
+    assert mock_docker_client.call_count == 1
     assert client.containers.run.call_count == 1
     assert client.containers.run.call_args == call(
         "img",
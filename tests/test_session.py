@@ -0,0 +1,102 @@
+from types import SimpleNamespace
+from unittest.mock import MagicMock, call
+
+import docker
+
+from privateer.session import (
+    DockerCall,
+    DockerSession,
+    current_session,
+    docker_client,
+    docker_session,
+)
+
+
+def mock_from_env(monkeypatch):
+    mock = MagicMock()
+    mock.return_value.api.hooks = {"response": []}
+    monkeypatch.setattr(docker, "from_env", mock)
+    return mock
+
+
+def test_session_creates_one_client(monkeypatch):
+    from_env = mock_from_env(monkeypatch)
+    session = DockerSession()
+    assert session.client is from_env.return_value
+    assert session.client is from_env.return_value
+    assert from_env.call_count == 1
+    assert from_env.return_value.api.hooks["response"] == [session._record]
+    session.close()
+    assert from_env.return_value.close.call_count == 1
+
+
+def test_session_remembers_images(monkeypatch, capsys):
+    client = mock_from_env(monkeypatch).return_value
+    client.images.get.side_effect = docker.errors.ImageNotFound("x")
+    session = DockerSession()
+    session.ensure_image("alpine")
+    session.ensure_image("alpine")
+    assert client.images.get.mock_calls == [call("alpine")]
+    assert client.images.pull.mock_calls == [call("alpine")]
+    assert capsys.readouterr().out == "Pulling alpine\n"
+
+
+def test_session_lists_volumes_once(monkeypatch):
+    client = mock_from_env(monkeypatch).return_value
+    client.volumes.list.return_value = [
+        SimpleNamespace(name="a"),
+        SimpleNamespace(name="b"),
+    ]
+    client.volumes.get.side_effect = docker.errors.NotFound("x")
+    session = DockerSession()
+    assert session.volume_exists("a")
+    assert session.volume_exists("b")
+    assert not session.volume_exists("c")
+    assert client.volumes.list.call_count == 1
+    assert client.volumes.get.mock_calls == [call("c")]
+
+    session.create_volume("c")
+    assert session.volume_exists("c")
+    assert client.volumes.create.mock_calls == [call("c")]
+    assert client.volumes.get.call_count == 1
+
+
+def test_session_confirms_missing_volumes(monkeypatch):
+    client = mock_from_env(monkeypatch).return_value
+    client.volumes.list.return_value = []
+    session = DockerSession()
+    assert session.volume_exists("a")
+    assert session.volume_exists("a")
+    assert client.volumes.get.mock_calls == [call("a")]
+
+
+def test_session_is_shared_within_block(monkeypatch):
+    from_env = mock_from_env(monkeypatch)
+    assert current_session() is not current_session()
+    with docker_session() as session:
+        assert current_session() is session
+        assert docker_client() is from_env.return_value
+        assert docker_client() is from_env.return_value
+    assert from_env.call_count == 1
+    assert from_env.return_value.close.call_count == 1
+    assert current_session() is not session
+
+
+def test_session_summarises_calls():
+    session = DockerSession()
+
+    def response(method, url, seconds):
+        request = SimpleNamespace(method=method, url=url)
+        elapsed = SimpleNamespace(total_seconds=lambda: seconds)
+        return SimpleNamespace(request=request, elapsed=elapsed)
+
+    url = "http+docker://localhost/v1.43/volumes"
+    session._record(response("GET", url, 0.5))
+    session._record(response("GET", f"{url}?filters=x", 0.25))
+    session._record(response("POST", f"{url}/create", 2))
+    assert session.calls[0] == DockerCall("GET", "/volumes", 0.5)
+    assert session.summary() == [
+        "3 docker requests",
+        "     2.000s    1 x POST /volumes/create",
+        "     0.750s    2 x GET /volumes",
+    ]
@@ -0,0 +1,103 @@
+import hashlib
+import os
+
+import pytest
+
+from privateer.split import (
+    CHECKSUMS,
+    MANIFEST,
+    SplitWriter,
+    read_manifest,
+    split_chunks,
+)
+
+
+def write_split(path, data, **kwargs):
+    writer = SplitWriter(path, **kwargs)
+    for i in range(0, len(data), 7000):
+        writer.write(data[i : i + 7000])
+    writer.close()
+    return writer.manifest
+
+
+@pytest.mark.parametrize("compress", [None, "gzip", "zstd"])
+def test_can_round_trip_split_stream(tmp_path, compress):
+    data = os.urandom(250000)
+    path = tmp_path / "export"
+    manifest = write_split(
+        path, data, chunk_size=100000, compress=compress, threads=2
+    )
+    assert [x.raw_size for x in manifest.chunks] == [100000, 100000, 50000]
+    for chunk in manifest.chunks:
+        contents = (path / chunk.file).read_bytes()
+        assert chunk.size == len(contents)
+        assert chunk.sha256 == hashlib.sha256(contents).hexdigest()
+    assert read_manifest(path) == manifest
+    assert b"".join(split_chunks(path, threads=2)) == data
+
+
+def test_split_writes_checksums_file(tmp_path):
+    path = tmp_path / "export"
+    manifest = write_split(path, b"x" * 25, chunk_size=10, compress="gzip")
+    assert [x.file for x in manifest.chunks] == [
+        "chunk-00000.gz",
+        "chunk-00001.gz",
+        "chunk-00002.gz",
+    ]
+    lines = (path / CHECKSUMS).read_text().splitlines()
+    assert lines == [f"{x.sha256}  {x.file}" for x in manifest.chunks]
+    assert sorted(os.listdir(path)) == sorted(
+        [CHECKSUMS, MANIFEST, *(x.file for x in manifest.chunks)]
+    )
+
+
+def test_can_index_files(tmp_path):
+    writer = SplitWriter(tmp_path / "export", chunk_size=1024)
+    writer.add_file("./", 0)
+    writer.add_file("./a", 512)
+    writer.add_file("./b", 2048)
+    writer.close()
+    files = read_manifest(tmp_path / "export").files
+    assert [(x.name, x.chunk) for x in files] == [
+        ("./", 0),
+        ("./a", 0),
+        ("./b", 2),
+    ]
+
+
+def test_uncompressed_chunks_are_not_sniffed(tmp_path):
+    # A chunk boundary can fall anywhere in the stream, so a chunk may
+    # start with bytes that look like a compression header
+    data = b"\x1f\x8b" + os.urandom(10) + b"\x28\xb5\x2f\xfd" + os.urandom(10)
+    path = tmp_path / "export"
+    write_split(path, data, chunk_size=12)
+    assert b"".join(split_chunks(path)) == data
+
+
+def test_corrupt_chunk_is_detected(tmp_path):
+    data = os.urandom(30000)
+    path = tmp_path / "export"
+    write_split(path, data, chunk_size=10000)
+    with (path / "chunk-00002").open("r+b") as f:
+        f.write(b"corrupt")
+    chunks = split_chunks(path, threads=1)
+    assert next(chunks) == data[:10000]
+    assert next(chunks) == data[10000:20000]
+    msg = "Chunk 'chunk-00002' is corrupt"
+    with pytest.raises(Exception, match=msg):
+        next(chunks)
+
+
+def test_missing_chunks_are_detected_before_reading(tmp_path):
+    path = tmp_path / "export"
+    write_split(path, os.urandom(30000), chunk_size=10000)
+    os.unlink(path / "chunk-00001")
+    msg = "Missing chunks from '.+': 'chunk-00001'"
+    with pytest.raises(Exception, match=msg):
+        split_chunks(path)
+
+
+def test_error_if_manifest_missing(tmp_path):
+    msg = "is not a split export"
+    with pytest.raises(Exception, match=msg):
+        read_manifest(tmp_path)
@@ -1,3 +1,5 @@
+import gzip
+import hashlib
 import os
 import tarfile
 from unittest.mock import MagicMock, call
@@ -6,6 +8,8 @@ import docker
 import pytest
 import vault_dev
 
+import privateer.compress
+import privateer.split
 import privateer.tar
 import privateer.util
 from privateer.config import read_config
@@ -14,8 +18,8 @@ from privateer.keys import keygen_all
 from privateer.tar import (
     export_tar,
     export_tar_local,
+    export_tar_remote,
     import_tar,
-    take_ownership,
 )
 
 
@@ -28,9 +32,8 @@ def test_can_print_instructions_for_exporting_local_vol(managed_docker, capsys):
     assert "Command to manually run export:" in lines
     assert "(pay attention to the final '.' in the above command!)" in lines
     cmd = (
-        f"  docker run --rm "
-        f"-v {os.getcwd()}:/export -v {vol}:/privateer:ro "
-        f"-w /privateer ubuntu tar -cpvf /export/{os.path.basename(path)} ."
+        f"  docker run --rm -v {vol}:/privateer:ro "
+        f"-w /privateer ubuntu tar -cpf - . > {path}"
     )
     assert cmd in lines
 
@@ -41,6 +44,7 @@ def test_can_export_local_volume(tmp_path, managed_docker):
     path = export_tar_local(vol, to_dir=tmp_path)
     assert len(os.listdir(tmp_path)) == 1
     assert os.listdir(tmp_path)[0] == os.path.basename(path)
+    assert os.stat(path).st_uid == os.geteuid()
     with tarfile.open(path, "r") as f:
         assert f.getnames() == [".", "./test"]
 
@@ -65,10 +69,8 @@ def test_can_print_instructions_for_export_volume(managed_docker, capsys):
     assert "Command to manually run export:" in lines
     assert "(pay attention to the final '.' in the above command!)" in lines
     cmd = (
-        f"  docker run --rm "
-        f"-v {os.getcwd()}:/export -v {vol_data}:/privateer:ro "
-        "-w /privateer/bob/data "
-        f"ubuntu tar -cpvf /export/{os.path.basename(path)} ."
+        f"  docker run --rm -v {vol_data}:/privateer:ro "
+        f"-w /privateer/bob/data ubuntu tar -cpf - . > {path}"
     )
     assert cmd in lines
 
@@ -92,12 +94,21 @@ def test_can_export_managed_volume(monkeypatch, managed_docker):
     call_args = mock_tar_create.call_args
     path = os.path.abspath("")
     mounts = [
-        docker.types.Mount("/export", path, type="bind"),
         docker.types.Mount("/privateer", vol, type="volume", read_only=True),
     ]
     tarfile = call_args[0][3]
     src = "/privateer/bob/data"
-    assert call_args == call(mounts, src, path, tarfile, False)
+    assert call_args == call(
+        mounts,
+        src,
+        path,
+        tarfile,
+        False,
+        compress=None,
+        threads=None,
+        split=None,
+        snapshot=None,
+    )
 
 
 def test_can_export_local_managed_volume(monkeypatch, managed_docker):
@@ -123,11 +134,123 @@ def test_can_export_local_managed_volume(monkeypatch, managed_docker):
     assert mock_tar_create.call_count == 0
     assert mock_tar_local.call_count == 1
     assert mock_tar_local.call_args == call(
-        vol_other, to_dir=None, dry_run=False
+        vol_other,
+        to_dir=None,
+        compress=None,
+        threads=None,
+        split=None,
+        incremental=False,
+        dry_run=False,
     )
     assert path == mock_tar_local.return_value
 
 
+def test_can_export_volume_from_server(tmp_path, monkeypatch, capsys):
+    cfg = read_config("example/simple.json")
+    mock_check = MagicMock(return_value=cfg.clients[0])
+    monkeypatch.setattr(privateer.tar, "check_client", mock_check)
+
+    def run(_display, _image, dest, *, checksum, **_kwargs):
+        with open(dest, "wb") as f:
+            f.write(b"data")
+        checksum(b"data")
+        return 4
+
+    mock_run = MagicMock(side_effect=run)
+    monkeypatch.setattr(privateer.tar, "run_container_to_file", mock_run)
+    path = export_tar_remote(cfg, "bob", "data", to_dir=tmp_path)
+    assert mock_check.call_args == call(cfg, "bob", quiet=True, verify=True)
+    assert os.path.dirname(path) == str(tmp_path)
+    assert os.path.basename(path).startswith("bob-data-")
+    assert path.endswith(".tar")
+    kwargs = mock_run.call_args.kwargs
+    assert mock_run.call_args.args[1] == "mrcide/privateer-client:latest"
+    assert kwargs["command"] == [
+        "ssh",
+        "-C",
+        "alice",
+        "tar -cpf - -C /privateer/volumes/bob/data .",
+    ]
+    assert kwargs["mounts"] == [
+        docker.types.Mount(
+            "/privateer/keys", "privateer_keys", type="volume", read_only=True
+        ),
+    ]
+    assert kwargs["compress"] is None
+    digest = hashlib.sha256(b"data").hexdigest()
+    with open(f"{path}.sha256") as f:
+        assert f.read() == f"{digest}  {os.path.basename(path)}\n"
+    out = capsys.readouterr().out
+    assert f"Tar file ready at '{path}' (4 B)" in out
+
+
+def test_can_print_instructions_for_export_from_server(
+    tmp_path, monkeypatch, capsys
+):
+    cfg = read_config("example/simple.json")
+    mock_check = MagicMock(return_value=cfg.clients[0])
+    monkeypatch.setattr(privateer.tar, "check_client", mock_check)
+    mock_run = MagicMock()
+    monkeypatch.setattr(privateer.tar, "run_container_to_file", mock_run)
+    path = export_tar_remote(
+        cfg, "bob", "data", to_dir=tmp_path, compress="zstd", dry_run=True
+    )
+    assert path.endswith(".tar.zst")
+    assert mock_run.call_count == 0
+    lines = capsys.readouterr().out.strip().split("\n")
+    assert lines[2] == (
+        "  docker run --rm -v privateer_keys:/privateer/keys:ro "
+        "mrcide/privateer-client:latest ssh -C alice "
+        "'tar -cpf - -C /privateer/volumes/bob/data .' "
+        f"| zstd -T0 > {path}"
+    )
+    name = os.path.basename(path)
+    assert lines[3] == (
+        f"  (cd {tmp_path} && sha256sum {name}) > {path}.sha256"
+    )
+    assert os.listdir(tmp_path) == []
+
+
+def test_export_from_server_compresses_with_gzip_on_server(
+    tmp_path, monkeypatch, capsys
+):
+    cfg = read_config("example/simple.json")
+    mock_check = MagicMock(return_value=cfg.clients[0])
+    monkeypatch.setattr(privateer.tar, "check_client", mock_check)
+
+    def run(_display, _image, dest, *, checksum, **_kwargs):
+        with open(dest, "wb") as f:
+            f.write(b"data")
+        checksum(b"data")
+        return 4
+
+    mock_run = MagicMock(side_effect=run)
+    monkeypatch.setattr(privateer.tar, "run_container_to_file", mock_run)
+    path = export_tar_remote(
+        cfg, "bob", "data", to_dir=tmp_path, compress="gzip"
+    )
+    assert path.endswith(".tar.gz")
+    kwargs = mock_run.call_args.kwargs
+    assert kwargs["command"] == [
+        "ssh",
+        "alice",
+        "tar -czpf - -C /privateer/volumes/bob/data .",
+    ]
+    assert kwargs["compress"] is None
+    out = capsys.readouterr().out
+    assert f"Tar file ready at '{path}' (4 B compressed on 'alice')" in out
+
+    path = export_tar_remote(
+        cfg, "bob", "data", to_dir=tmp_path, compress="gzip", dry_run=True
+    )
+    lines = capsys.readouterr().out.strip().split("\n")
+    assert lines[2] == (
+        "  docker run --rm -v privateer_keys:/privateer/keys:ro "
+        "mrcide/privateer-client:latest ssh alice "
+        f"'tar -czpf - -C /privateer/volumes/bob/data .' > {path}"
+    )
+
+
 def test_throw_if_local_volume_does_not_exist(managed_docker):
     vol = managed_docker("volume")
     msg = f"Volume '{vol}' does not exist"
@@ -159,6 +282,300 @@ def test_import_volume(managed_docker, tmp_path):
     assert privateer.util.string_from_volume(dest, "test") == "hello"
 
 
+@pytest.mark.parametrize("compress", ["gzip", "zstd"])
+def test_import_compressed_volume(managed_docker, tmp_path, compress):
+    src = managed_docker("volume")
+    dest = managed_docker("volume")
+    privateer.util.string_to_volume("hello", src, "test")
+    path = export_tar_local(src, to_dir=tmp_path, compress=compress)
+    assert path.endswith(".tar.gz" if compress == "gzip" else ".tar.zst")
+    assert privateer.compress.detect_compression(path) == compress
+    import_tar(dest, path)
+    assert privateer.util.string_from_volume(dest, "test") == "hello"
+
+
+def test_instructions_to_import_compressed_volume(
+    tmp_path, monkeypatch, capsys
+):
+    monkeypatch.setattr(
+        privateer.tar, "volume_exists", MagicMock(return_value=False)
+    )
+    path = str(tmp_path / "data.tar.gz")
+    with gzip.open(path, "wb") as f:
+        f.write(b"")
+    import_tar("dest", path, dry_run=True)
+    lines = capsys.readouterr().out.strip().split("\n")
+    cmd = (
+        f"  gzip -dc {path} | docker run -i --rm -v dest:/privateer "
+        "-w /privateer ubuntu tar -xpf -"
+    )
+    assert "  docker volume create dest" in lines
+    assert cmd in lines
+
+
+def test_can_export_split_volume(tmp_path, monkeypatch, capsys):
+    data = os.urandom(3000)
+    output = [
+        (data[:1000], None),
+        (None, b"block 0: ./\nblock 1: ./a"),
+        (None, b"\nblock 5: ./b\n"),
+        (data[1000:], None),
+    ]
+    mock_output = MagicMock(return_value=iter(output))
+    monkeypatch.setattr(privateer.tar, "container_output", mock_output)
+    monkeypatch.setattr(
+        privateer.tar, "volume_exists", MagicMock(return_value=True)
+    )
+    path = export_tar_local("vol", to_dir=tmp_path, split=1)
+    assert os.path.basename(path).startswith("vol-")
+    assert os.path.isdir(path)
+    assert mock_output.call_args.kwargs["command"] == [
+        "tar",
+        "-cpvRf",
+        "-",
+        ".",
+    ]
+    manifest = privateer.split.read_manifest(path)
+    assert manifest.compress is None
+    assert [x.raw_size for x in manifest.chunks] == [3000]
+    assert [(x.name, x.offset) for x in manifest.files] == [
+        ("./", 0),
+        ("./a", 512),
+        ("./b", 2560),
+    ]
+    assert b"".join(privateer.split.split_chunks(path)) == data
+    out = capsys.readouterr().out
+    assert f"Split tar file ready at '{path}' (2.9 KiB)" in out
+
+
+def test_failed_split_export_is_removed(tmp_path, monkeypatch):
+    def output(*_args, **_kwargs):
+        yield b"abc", None
+        msg = "Export failed"
+        raise Exception(msg)
+
+    monkeypatch.setattr(privateer.tar, "container_output", output)
+    monkeypatch.setattr(
+        privateer.tar, "volume_exists", MagicMock(return_value=True)
+    )
+    with pytest.raises(Exception, match="Export failed"):
+        export_tar_local("vol", to_dir=tmp_path, split=1)
+    assert os.listdir(tmp_path) == []
+
+
+def test_instructions_to_import_split_volume(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(
+        privateer.tar, "volume_exists", MagicMock(return_value=False)
+    )
+    path = tmp_path / "export"
+    writer = privateer.split.SplitWriter(path, chunk_size=10, compress="zstd")
+    writer.write(b"x" * 25)
+    writer.close()
+    import_tar("dest", str(path), dry_run=True)
+    lines = capsys.readouterr().out.strip().split("\n")
+    cmd = (
+        f"  cat {path}/chunk-* | zstd -dc | docker run -i --rm "
+        "-v dest:/privateer -w /privateer ubuntu tar -xpf -"
+    )
+    assert f"  (cd {path} && sha256sum -c SHA256SUMS)" in lines
+    assert cmd in lines
+
+
+@pytest.mark.parametrize("compress", [None, "zstd"])
+def test_import_split_volume(managed_docker, tmp_path, compress):
+    src = managed_docker("volume")
+    dest = managed_docker("volume")
+    privateer.util.string_to_volume("hello", src, "test")
+    path = export_tar_local(src, to_dir=tmp_path, compress=compress, split=1)
+    manifest = privateer.split.read_manifest(path)
+    assert "./test" in [x.name for x in manifest.files]
+    import_tar(dest, path)
+    assert privateer.util.string_from_volume(dest, "test") == "hello"
+
+
+def _mock_tar_to_file(*, fail=False):
+    container = MagicMock()
+
+    def run(_display, _image, dest, *, before=None, after=None, **_kwargs):
+        if before:
+            before(container)
+        with open(dest, "wb") as f:
+            f.write(b"data")
+        if fail:
+            os.unlink(dest)
+            msg = "Export failed"
+            raise Exception(msg)
+        if after:
+            after(container)
+        return 4
+
+    return MagicMock(side_effect=run), container
+
+
+def test_can_export_incremental_volume(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(
+        privateer.tar, "volume_exists", MagicMock(return_value=True)
+    )
+    mock_bytes = MagicMock(side_effect=[b"level0", b"level1"])
+    monkeypatch.setattr(privateer.tar, "bytes_from_container", mock_bytes)
+    mock_run, container = _mock_tar_to_file()
+    monkeypatch.setattr(privateer.tar, "run_container_to_file", mock_run)
+
+    snapshot = tmp_path / "vol.snar"
+    snar = "/tmp/privateer.snar"  # noqa: S108
+    path = export_tar_local("vol", to_dir=tmp_path, incremental=True)
+    assert not os.path.basename(path).endswith("-incremental.tar")
+    kwargs = mock_run.call_args.kwargs
+    assert kwargs["command"] == [
+        "tar",
+        "-cpf",
+        "-",
+        f"--listed-incremental={snar}",
+        "--no-check-device",
+        ".",
+    ]
+    assert container.put_archive.call_count == 0
+    assert mock_bytes.call_args == call(container, snar)
+    assert snapshot.read_bytes() == b"level0"
+    out = capsys.readouterr().out
+    assert f"Updated snapshot '{snapshot}'" in out
+
+    path = export_tar_local("vol", to_dir=tmp_path, incremental=True)
+    assert os.path.basename(path).endswith("-incremental.tar")
+    assert container.put_archive.call_count == 1
+    dest, data = container.put_archive.call_args[0]
+    assert dest == os.path.dirname(snar)
+    with tarfile.open(fileobj=data) as t:
+        assert t.getnames() == ["privateer.snar"]
+        assert t.extractfile("privateer.snar").read() == b"level0"
+    assert snapshot.read_bytes() == b"level1"
+
+
+def test_cant_export_volume_with_generations_incrementally(
+    tmp_path, monkeypatch
+):
+    cfg = read_config("example/simple.json")
+    cfg.volumes[0].generations = True
+    monkeypatch.setattr(
+        privateer.tar, "check", MagicMock(return_value=cfg.servers[0])
+    )
+    mock_create = MagicMock()
+    monkeypatch.setattr(privateer.tar, "_run_tar_create", mock_create)
+    msg = "Can't export 'data' incrementally, as it keeps generations"
+    with pytest.raises(Exception, match=msg):
+        export_tar(cfg, "alice", "data", to_dir=tmp_path, incremental=True)
+    assert mock_create.call_count == 0
+    assert os.listdir(tmp_path) == []
+
+    export_tar(cfg, "alice", "data", to_dir=tmp_path)
+    assert mock_create.call_count == 1
+    assert mock_create.call_args.kwargs["snapshot"] is None
+
+
+def test_failed_incremental_export_keeps_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        privateer.tar, "volume_exists", MagicMock(return_value=True)
+    )
+    mock_run, _ = _mock_tar_to_file(fail=True)
+    monkeypatch.setattr(privateer.tar, "run_container_to_file", mock_run)
+    snapshot = tmp_path / "vol.snar"
+    snapshot.write_bytes(b"level0")
+    with pytest.raises(Exception, match="Export failed"):
+        export_tar_local("vol", to_dir=tmp_path, incremental=True)
+    assert os.listdir(tmp_path) == ["vol.snar"]
+    assert snapshot.read_bytes() == b"level0"
+
+
+def test_can_print_instructions_for_incremental_export(
+    tmp_path, monkeypatch, capsys
+):
+    monkeypatch.setattr(
+        privateer.tar, "volume_exists", MagicMock(return_value=True)
+    )
+    export_tar_local("vol", to_dir=tmp_path, incremental=True, dry_run=True)
+    lines = capsys.readouterr().out.strip().split("\n")
+    assert lines[2].startswith(
+        f"  docker run --rm -v vol:/privateer:ro -v {tmp_path}:/snapshot "
+        "-w /privateer ubuntu tar -cpf - "
+        "--listed-incremental=/snapshot/vol.snar --no-check-device . > "
+    )
+    assert not (tmp_path / "vol.snar").exists()
+
+
+def test_instructions_to_import_incremental_chain(
+    tmp_path, monkeypatch, capsys
+):
+    monkeypatch.setattr(
+        privateer.tar, "volume_exists", MagicMock(return_value=False)
+    )
+    paths = [str(tmp_path / x) for x in ["a.tar", "b.tar.gz", "c.tar.gz"]]
+    with open(paths[0], "wb") as f:
+        f.write(b"")
+    for p in paths[1:]:
+        with gzip.open(p, "wb") as f:
+            f.write(b"")
+    import_tar("dest", paths[0], incremental=paths[1:], dry_run=True)
+    lines = capsys.readouterr().out.strip().split("\n")
+    assert lines[2:] == [
+        "  docker volume create dest",
+        (
+            f"  docker run --rm -v {paths[0]}:/src.tar:ro -v dest:/privateer "
+            "-w /privateer ubuntu tar -xvpf /src.tar "
+            "--listed-incremental=/dev/null"
+        ),
+        (
+            f"  gzip -dc {paths[1]} | docker run -i --rm -v dest:/privateer "
+            "-w /privateer ubuntu tar -xpf - --listed-incremental=/dev/null"
+        ),
+        (
+            f"  gzip -dc {paths[2]} | docker run -i --rm -v dest:/privateer "
+            "-w /privateer ubuntu tar -xpf - --listed-incremental=/dev/null"
+        ),
+    ]
+
+
+def test_throw_if_incremental_tarfile_does_not_exist(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        privateer.tar, "volume_exists", MagicMock(return_value=False)
+    )
+    mock_session = MagicMock()
+    monkeypatch.setattr(privateer.tar, "current_session", mock_session)
+    full = tmp_path / "full.tar"
+    full.write_bytes(b"")
+    path = str(tmp_path / "inc.tar")
+    msg = f"Input file '{path}' does not exist"
+    with pytest.raises(Exception, match=msg):
+        import_tar("dest", str(full), incremental=[path])
+    assert mock_session.call_count == 0
+
+
+@pytest.mark.parametrize("compress", [None, "zstd"])
+def test_import_incremental_chain(managed_docker, tmp_path, compress):
+    src = managed_docker("volume")
+    dest = managed_docker("volume")
+    privateer.util.strings_to_volume([("a", "1", {}), ("b", "2", {})], src)
+    full = export_tar_local(
+        src, to_dir=tmp_path, compress=compress, incremental=True
+    )
+    assert os.path.exists(tmp_path / f"{src}.snar")
+    docker.from_env().containers.run(
+        "ubuntu",
+        ["sh", "-c", "rm a && echo 3 > c"],
+        mounts=[docker.types.Mount("/privateer", src, type="volume")],
+        working_dir="/privateer",
+        remove=True,
+    )
+    inc = export_tar_local(
+        src, to_dir=tmp_path, compress=compress, incremental=True
+    )
+    assert "-incremental" in os.path.basename(inc)
+    import_tar(dest, full, incremental=[inc])
+    assert privateer.util.string_from_volume(dest, "b") == "2"
+    assert privateer.util.string_from_volume(dest, "c").strip() == "3"
+    with pytest.raises(docker.errors.NotFound):
+        privateer.util.string_from_volume(dest, "a")
+
+
 def test_instructions_to_import_volume(managed_docker, tmp_path, capsys):
     src = managed_docker("volume")
     dest = managed_docker("volume")
@@ -192,35 +609,3 @@ def test_throw_if_tarfile_does_not_exist(tmp_path, managed_docker):
     msg = f"Input file '{path}' does not exist"
     with pytest.raises(Exception, match=msg):
         import_tar(dest, path)
-
-
-def test_can_take_ownership_of_a_file(tmp_path, managed_docker):
-    cl = docker.from_env()
-    mounts = [docker.types.Mount("/src", str(tmp_path), type="bind")]
-    command = ["touch", "/src/newfile"]
-    name = managed_docker("container")
-    cl.containers.run("ubuntu", name=name, mounts=mounts, command=command)
-    path = tmp_path / "newfile"
-    info = os.stat(path)
-    assert info.st_uid == 0
-    assert info.st_gid == 0
-    uid = os.geteuid()
-    gid = os.getegid()
-    cmd = take_ownership("newfile", str(tmp_path), command_only=True)
-    expected = [
-        "docker",
-        "run",
-        "--rm",
-        *privateer.util.mounts_str(mounts),
-        "-w",
-        "/src",
-        "ubuntu",
-        "chown",
-        f"{uid}.{gid}",
-        "newfile",
-    ]
-    assert cmd == expected
-    take_ownership("newfile", str(tmp_path))
-    info = os.stat(path)
-    assert info.st_uid == uid
-    assert info.st_gid == gid
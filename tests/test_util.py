@@ -1,6 +1,10 @@
+import gzip
+import hashlib
+import io
 import os
 import re
 import tarfile
+from unittest.mock import MagicMock, call
 
 import docker
 import pytest
@@ -31,6 +35,49 @@ def test_create_simple_tar_with_permissions():
     assert els[0].mode == 0o600
 
 
+def test_can_create_tar_of_several_strings():
+    files = [
+        ("a", "hello", {"mode": 0o644}),
+        ("b", ["x", "y"], {"uid": 1000}),
+    ]
+    data = privateer.util.strings_to_tar(files, uid=0, gid=0)
+    t = tarfile.open(fileobj=io.BytesIO(data))
+    a, b = t.getmembers()
+    assert (a.name, a.mode, a.uid, a.gid) == ("a", 0o644, 0, 0)
+    assert (b.name, b.mode, b.uid, b.gid) == ("b", 0o600, 1000, 0)
+    assert t.extractfile(a).read() == b"hello"
+    assert t.extractfile(b).read() == b"x\ny\n"
+
+
+def test_can_read_chunks_as_file():
+    reader = privateer.util.ChunkReader(iter([b"abc", b"", b"defg"]))
+    f = io.BufferedReader(reader, buffer_size=2)
+    assert f.read(2) == b"ab"
+    assert f.read() == b"cdefg"
+    assert f.read() == b""
+
+
+def test_can_stream_file_from_container():
+    data = b"0123456789" * 100
+    buf = io.BytesIO()
+    with tarfile.open(mode="w", fileobj=buf) as tar:
+        info = tarfile.TarInfo("file")
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    archive = buf.getvalue()
+    chunks = [archive[i : i + 100] for i in range(0, len(archive), 100)]
+    container = MagicMock()
+    container.get_archive.return_value = (iter(chunks), {})
+    res = list(privateer.util.iter_from_container(container, "/src/file", 300))
+    assert [len(x) for x in res] == [300, 300, 300, 100]
+    assert b"".join(res) == data
+    container.get_archive.assert_called_once_with("/src/file", chunk_size=300)
+
+    container.get_archive.return_value = (iter(chunks), {})
+    with pytest.raises(Exception, match="'/src/other' was not found"):
+        privateer.util.bytes_from_container(container, "/src/other")
+
+
 def test_can_match_values():
     match_value = privateer.util.match_value
     assert match_value(None, "x", "nm") == "x"
@@ -121,6 +168,125 @@ def test_can_run_failing_command(capsys, managed_docker):
     assert lines[2] == "An error occured! Container logs:"
 
 
+def test_can_run_command_into_file(tmp_path):
+    path = tmp_path / "out"
+    size = privateer.util.run_container_to_file(
+        "Test", "alpine", path, command=["sh", "-c", "seq 1 3; echo x >&2"]
+    )
+    assert path.read_text() == "1\n2\n3\n"
+    assert size == 6
+
+
+def test_command_output_is_streamed_to_file(tmp_path, monkeypatch):
+    client = MagicMock()
+    client.api.attach.return_value = iter(
+        [(b"abc", None), (None, b"warning\n"), (b"def", None)]
+    )
+    container = client.containers.create.return_value
+    container.wait.return_value = {"StatusCode": 0}
+    monkeypatch.setattr(privateer.util, "ensure_image", MagicMock())
+    monkeypatch.setattr(
+        privateer.util, "docker_client", MagicMock(return_value=client)
+    )
+    path = tmp_path / "out"
+    size = privateer.util.run_container_to_file(
+        "Test", "alpine", path, command=["true"]
+    )
+    assert size == 6
+    assert path.read_bytes() == b"abcdef"
+    log_config = client.containers.create.call_args.kwargs["log_config"]
+    assert log_config.type == "none"
+    assert client.api.attach.call_args.args == (container.id,)
+    assert container.start.call_count == 1
+    assert container.remove.call_count == 1
+
+
+def test_can_checksum_file_as_it_is_written(tmp_path, monkeypatch):
+    client = MagicMock()
+    client.api.attach.return_value = iter([(b"abc", None), (b"def", None)])
+    container = client.containers.create.return_value
+    container.wait.return_value = {"StatusCode": 0}
+    monkeypatch.setattr(privateer.util, "ensure_image", MagicMock())
+    monkeypatch.setattr(
+        privateer.util, "docker_client", MagicMock(return_value=client)
+    )
+    path = tmp_path / "out.gz"
+    h = hashlib.sha256()
+    size = privateer.util.run_container_to_file(
+        "Test", "alpine", path, compress="gzip", checksum=h.update
+    )
+    assert size == 6
+    assert gzip.decompress(path.read_bytes()) == b"abcdef"
+    assert h.hexdigest() == hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def test_failed_command_removes_partial_file(tmp_path, monkeypatch, capsys):
+    client = MagicMock()
+    client.api.attach.return_value = iter(
+        [(b"abc", None), (None, b"tar: ./x: Cannot open\n")]
+    )
+    container = client.containers.create.return_value
+    container.wait.return_value = {"StatusCode": 2}
+    monkeypatch.setattr(privateer.util, "ensure_image", MagicMock())
+    monkeypatch.setattr(
+        privateer.util, "docker_client", MagicMock(return_value=client)
+    )
+    path = tmp_path / "out"
+    with pytest.raises(Exception, match="Test failed"):
+        privateer.util.run_container_to_file(
+            "Test", "alpine", path, command=["false"]
+        )
+    assert not path.exists()
+    assert container.remove.call_count == 1
+    lines = capsys.readouterr().out.strip().split("\n")
+    assert lines == [
+        "An error occured! Container logs:",
+        "tar: ./x: Cannot open",
+    ]
+
+
+def test_can_stream_input_into_container(monkeypatch):
+    client = MagicMock()
+    container = client.containers.create.return_value
+    container.wait.return_value = {"StatusCode": 0}
+    sock = container.attach_socket.return_value
+    monkeypatch.setattr(privateer.util, "ensure_image", MagicMock())
+    monkeypatch.setattr(
+        privateer.util, "docker_client", MagicMock(return_value=client)
+    )
+    privateer.util.run_container_with_input(
+        "Test", "alpine", iter([b"abc", b"def"]), command=["cat"]
+    )
+    kwargs = client.containers.create.call_args.kwargs
+    assert kwargs["stdin_open"]
+    assert kwargs["stdin_once"]
+    assert sock._sock.sendall.mock_calls == [call(b"abc"), call(b"def")]
+    assert sock._sock.shutdown.call_count == 1
+    assert container.remove.call_count == 1
+
+
+def test_failed_input_command_reports_logs(monkeypatch, capsys):
+    client = MagicMock()
+    container = client.containers.create.return_value
+    container.wait.return_value = {"StatusCode": 0}
+    sock = container.attach_socket.return_value
+    sock._sock.sendall.side_effect = BrokenPipeError()
+    monkeypatch.setattr(privateer.util, "ensure_image", MagicMock())
+    monkeypatch.setattr(
+        privateer.util, "docker_client", MagicMock(return_value=client)
+    )
+    monkeypatch.setattr(
+        privateer.util, "log_tail", MagicMock(return_value=["tar: error"])
+    )
+    with pytest.raises(Exception, match="Test failed"):
+        privateer.util.run_container_with_input(
+            "Test", "alpine", iter([b"abc"]), command=["false"]
+        )
+    out = capsys.readouterr().out
+    assert out == "An error occured! Container logs:\ntar: error\n"
+    assert container.remove.call_count == 1
+
+
 def test_can_detect_if_volume_exists(managed_docker):
     name = managed_docker("volume")
     cl = docker.from_env()
@@ -160,3 +326,55 @@ def test_can_uniquify_list():
     assert privateer.util.unique([]) == []
     assert privateer.util.unique([1, 2, 3]) == [1, 2, 3]
     assert privateer.util.unique([3, 2, 1, 2, 3]) == [3, 2, 1]
+
+
+def test_can_format_bytes():
+    format_bytes = privateer.util.format_bytes
+    assert format_bytes(0) == "0 B"
+    assert format_bytes(1023) == "1023 B"
+    assert format_bytes(1024) == "1.0 KiB"
+    assert format_bytes(1536 * 1024) == "1.5 MiB"
+    assert format_bytes(3 * 1024**5) == "3072.0 TiB"
+
+
+def test_can_split_log_lines():
+    chunks = [b"a\nb", b"c\r  1%\r  2", b"%\n\xc3", b"\xa9\n\n", b"end"]
+    lines = list(privateer.util.log_lines(iter(chunks)))
+    assert lines == [
+        ("a", True),
+        ("bc", False),
+        ("  1%", False),
+        ("  2%", True),
+        ("\u00e9", True),
+        ("", True),
+        ("end", True),
+    ]
+
+
+def test_log_capture_keeps_last_lines():
+    with privateer.util.LogCapture(3) as logs:
+        for i in range(10):
+            logs.add(str(i))
+        assert logs.count == 10
+        assert logs.tail(3) == ["(ommitting 7 lines of logs)", "7", "8", "9"]
+        assert logs.tail(2) == ["(ommitting 8 lines of logs)", "8", "9"]
+    with privateer.util.LogCapture(3) as logs:
+        logs.add("a")
+        assert logs.tail(3) == ["a"]
+
+
+def test_log_capture_can_write_rotating_log_file(tmp_path):
+    path = tmp_path / "out.log"
+    with privateer.util.LogCapture(
+        2, path=path, max_bytes=20, backups=2
+    ) as logs:
+        for i in range(20):
+            logs.add(f"line {i}")
+    assert logs.tail(1) == ["(ommitting 19 lines of logs)", "line 19"]
+    assert path.read_text().split("\n")[-2] == "line 19"
+    files = sorted(x.name for x in tmp_path.iterdir())
+    assert files == ["out.log", "out.log.1", "out.log.2"]
+
+
+def test_log_file_path():
+    assert privateer.util.log_file_path(None, "a") is None
@@ -1,8 +1,18 @@
+import os
+import stat
+import time
 from unittest.mock import MagicMock, call
 
+import hvac
+
 import privateer.vault
 from privateer.util import transient_envvar
-from privateer.vault import _get_vault_token, vault_client
+from privateer.vault import (
+    _cached_vault_token,
+    _get_vault_token,
+    vault_client,
+    vault_logout,
+)
 
 
 def test_pass_back_given_token():
@@ -33,13 +43,114 @@ def test_prompt_if_no_tokens_found(monkeypatch):
         assert _get_vault_token(None) == "foo"
 
 
-def test_can_use_github_auth(monkeypatch):
-    token = f"ghp_{'x' * 36}"
+def mock_github_login(monkeypatch, lease_duration=3600):
     mock_client = MagicMock()
+    mock_client.return_value.auth.github.login.return_value = {
+        "auth": {
+            "client_token": "vault-token",
+            "lease_duration": lease_duration,
+        }
+    }
     monkeypatch.setattr(privateer.vault.hvac, "Client", mock_client)
+    return mock_client
+
+
+def test_can_use_github_auth(monkeypatch, tmp_path):
+    monkeypatch.setenv("PRIVATEER_CACHE_DIR", str(tmp_path))
+    token = f"ghp_{'x' * 36}"
+    mock_client = mock_github_login(monkeypatch)
     client = vault_client("https://vault.example.com:8200", token)
     assert mock_client.call_count == 1
     assert mock_client.call_args == call("https://vault.example.com:8200")
     assert client == mock_client.return_value
     assert client.auth.github.login.call_count == 1
     assert client.auth.github.login.call_args == call(token)
+
+
+def test_github_login_is_cached(monkeypatch, tmp_path, capsys):
+    monkeypatch.setenv("PRIVATEER_CACHE_DIR", str(tmp_path))
+    token = f"ghp_{'x' * 36}"
+    addr = "https://vault.example.com:8200"
+    mock_client = mock_github_login(monkeypatch)
+    vault_client(addr, token)
+    path = tmp_path / "vault-tokens.json"
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    assert _cached_vault_token(addr) == "vault-token"
+    assert _cached_vault_token("https://other.example.com") is None
+
+    # Second client reuses the token, and does not prompt
+    monkeypatch.setattr("builtins.input", MagicMock(side_effect=Exception))
+    with transient_envvar(
+        {"VAULT_TOKEN": None, "VAULT_AUTH_GITHUB_TOKEN": None}
+    ):
+        vault_client(addr)
+    assert mock_client.call_count == 2
+    assert mock_client.call_args == call(addr, token="vault-token")
+    assert mock_client.return_value.auth.github.login.call_count == 1
+
+    # An explicit vault token is always used as given
+    vault_client(addr, "s.other")
+    assert mock_client.call_args == call(addr, token="s.other")
+
+    vault_logout(addr)
+    assert _cached_vault_token(addr) is None
+    vault_logout(addr)
+    assert capsys.readouterr().out == (
+        "logging into vault using github\n"
+        f"Removed cached vault token for '{addr}'\n"
+        f"No cached vault token for '{addr}'\n"
+    )
+
+
+def test_refused_cached_token_is_replaced(monkeypatch, tmp_path, capsys):
+    monkeypatch.setenv("PRIVATEER_CACHE_DIR", str(tmp_path))
+    token = f"ghp_{'x' * 36}"
+    addr = "https://vault.example.com:8200"
+    mock_client = mock_github_login(monkeypatch)
+    client = mock_client.return_value
+    vault_client(addr, token)
+    assert client.auth.github.login.call_count == 1
+
+    # The token is revoked on the server, so the vault refuses it
+    client.auth.token.lookup_self.side_effect = hvac.exceptions.Forbidden()
+    assert vault_client(addr, token) == client
+    assert client.auth.token.lookup_self.call_count == 1
+    assert client.auth.github.login.call_count == 2
+    assert _cached_vault_token(addr) == "vault-token"
+    assert capsys.readouterr().out == (
+        "logging into vault using github\n"
+        "cached vault token was refused, logging in again\n"
+        "logging into vault using github\n"
+    )
+
+    # Without a GitHub token to log in with, we fall back on a prompt
+    mock_input = MagicMock(return_value="s.token")
+    monkeypatch.setattr("builtins.input", mock_input)
+    with transient_envvar(
+        {"VAULT_TOKEN": None, "VAULT_AUTH_GITHUB_TOKEN": None}
+    ):
+        vault_client(addr)
+    assert mock_input.call_count == 1
+    assert mock_client.call_args == call(addr, token="s.token")
+    assert _cached_vault_token(addr) is None
+
+
+def test_expired_tokens_are_not_used(monkeypatch, tmp_path):
+    monkeypatch.setenv("PRIVATEER_CACHE_DIR", str(tmp_path))
+    addr = "https://vault.example.com:8200"
+    mock_github_login(monkeypatch, lease_duration=3600)
+    vault_client(addr, f"ghp_{'x' * 36}")
+    assert _cached_vault_token(addr) == "vault-token"
+    now = time.time()
+    monkeypatch.setattr(privateer.vault.time, "time", lambda: now + 3590)
+    assert _cached_vault_token(addr) is None
+
+
+def test_tokens_without_ttl_do_not_expire(monkeypatch, tmp_path):
+    monkeypatch.setenv("PRIVATEER_CACHE_DIR", str(tmp_path))
+    addr = "https://vault.example.com:8200"
+    mock_github_login(monkeypatch, lease_duration=0)
+    vault_client(addr, f"ghp_{'x' * 36}")
+    now = time.time()
+    monkeypatch.setattr(privateer.vault.time, "time", lambda: now + 1e9)
+    assert _cached_vault_token(addr) == "vault-token"
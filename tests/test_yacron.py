@@ -1,7 +1,10 @@
+import json
+import shlex
+
 import pytest
 
 from privateer.backup import backup_command
-from privateer.config import read_config
+from privateer.config import Transfer, read_config
 from privateer.util import current_timezone_name
 from privateer.yacron import _validate_yacron_yaml, generate_yacron_yaml
 
@@ -16,7 +19,10 @@ def test_can_generate_yacron_yaml():
         f'  timezone: "{current_timezone_name()}"',
         "jobs:",
         '  - name: "job-1"',
-        f"    command: \"{' '.join(backup_command('bob', 'data1', 'alice'))}\"",
+        (
+            '    command: "rsync -av --delete --stats '
+            '/privateer/volumes/data1 alice:/privateer/volumes/bob"'
+        ),
         '    schedule: "@daily"',
     ]
     assert _validate_yacron_yaml(res)
@@ -45,13 +51,54 @@ def test_can_add_web_interface():
         "    - http://0.0.0.0:8080",
         "jobs:",
         '  - name: "job-1"',
-        f"    command: \"{' '.join(backup_command('bob', 'data1', 'alice'))}\"",
+        (
+            '    command: "rsync -av --delete --stats '
+            '/privateer/volumes/data1 alice:/privateer/volumes/bob"'
+        ),
         '    schedule: "@daily"',
     ]
     assert _validate_yacron_yaml(res)
     assert res == expected
 
 
+def test_can_schedule_backups_with_generations():
+    cfg = read_config("example/schedule.json")
+    cfg.clients[0].schedule.port = None
+    cfg.clients[0].schedule.jobs.pop()
+    cfg.volumes[0].generations = True
+    res = generate_yacron_yaml(cfg, "bob")
+    assert _validate_yacron_yaml(res)
+    cmd = backup_command(
+        "bob", "data1", "alice", generations=True, reporting=False
+    )
+    assert res[4] == f"    command: {json.dumps(shlex.join(cmd))}"
+
+
+def test_can_schedule_parallel_backups():
+    cfg = read_config("example/schedule.json")
+    cfg.clients[0].schedule.port = None
+    cfg.clients[0].schedule.jobs.pop()
+    cfg.volumes[0].parallel = 2
+    res = generate_yacron_yaml(cfg, "bob")
+    assert _validate_yacron_yaml(res)
+    cmd = backup_command("bob", "data1", "alice", parallel=2, reporting=False)
+    assert res[4] == f"    command: {json.dumps(shlex.join(cmd))}"
+
+
+def test_can_schedule_backups_with_transfer_settings():
+    cfg = read_config("example/schedule.json")
+    cfg.clients[0].schedule.port = None
+    cfg.clients[0].schedule.jobs.pop()
+    transfer = Transfer(compress="zstd", exclude=["a b"])
+    cfg.volumes[0].transfer = transfer
+    res = generate_yacron_yaml(cfg, "bob")
+    assert _validate_yacron_yaml(res)
+    cmd = backup_command(
+        "bob", "data1", "alice", transfer=transfer, reporting=False
+    )
+    assert res[4] == f"    command: {json.dumps(shlex.join(cmd))}"
+
+
 def test_can_check_yacron_config_is_valid():
     valid = [
         "jobs:",